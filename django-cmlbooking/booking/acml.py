@@ -0,0 +1,78 @@
+"""
+Async counterpart of the email helper in cml.py, used by the async views
+when running under ASGI. HTTP calls go through a shared httpx.AsyncClient
+so a single worker can have many requests in flight. CML itself is only
+called from the background jobs, see jobs.py.
+"""
+import asyncio
+import base64
+import os
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import logging
+logger = logging.getLogger(__name__)
+
+BREVO_API_URL = "https://api.brevo.com/v3/smtp/email"
+BREVO_BACKEND = "anymail.backends.brevo.EmailBackend"
+
+# One client per event loop, connections are reused between requests
+_clients = {}
+
+def _client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        timeout = httpx.Timeout(settings.CML_TIMEOUT, connect=settings.CML_CONNECT_TIMEOUT)
+        client = httpx.AsyncClient(verify=False, timeout=timeout)
+        _clients[loop] = client
+    return client
+
+async def SendEmail(email, title, content, attachments=None):
+    """
+    Send an email without blocking the event loop.
+
+    With the Brevo backend the message is posted straight to the Brevo API,
+    any other EMAIL_BACKEND is run through cml.SendEmail in a worker thread.
+
+    Returns True or False.
+    """
+    if settings.EMAIL_BACKEND != BREVO_BACKEND:
+        from . import cml
+        return await sync_to_async(cml.SendEmail, thread_sensitive=False)(email, title, content, attachments)
+
+    to_list = [email] if isinstance(email, str) else list(email)
+    payload = {
+        "sender": {"email": settings.DEFAULT_FROM_EMAIL},
+        "to": [{"email": address} for address in to_list],
+        "subject": title,
+        "htmlContent": content,
+        "textContent": "Denne e-posten har HTML-innhold. Åpne i en HTML-kompatibel klient.",
+    }
+
+    bcc = getattr(settings, "ANYMAIL_BCC_EMAIL", None)
+    if bcc and (bcc not in to_list):
+        payload["bcc"] = [{"email": bcc}]
+
+    if attachments:
+        payload["attachment"] = []
+        for path in attachments:
+            if not os.path.exists(path):
+                logger.warning("SendEmail: Vedlegg finnes ikke: %s", path)
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            payload["attachment"].append({"name": os.path.basename(path), "content": base64.b64encode(data).decode()})
+
+    head = {"api-key": settings.ANYMAIL["BREVO_API_KEY"], "Accept": "application/json"}
+    try:
+        r = await _client().post(BREVO_API_URL, headers=head, json=payload)
+    except httpx.HTTPError as e:
+        logger.exception("SendEmail: Brevo error: %s", e)
+        return False
+
+    if r.status_code in (200, 201, 202):
+        logger.info("SendEmail OK -> to=%s subj='%s'", to_list, title)
+        return True
+    logger.error("SendEmail: Brevo returned %s %s", r.status_code, r.text[:200])
+    return False
@@ -1,17 +1,105 @@
 from django.contrib import admin
-from .models import Booking, VerifiedEmail, Maintenance
+from .models import Booking, VerifiedEmail, Maintenance, CmlJob, CmlCapability, Teardown, TeardownLab, LabCheckpoint, PendingAlert, DailyStats, SlotStats
+from . import rollups
+from .export import ExportAdminMixin
 
-class BookingAdmin(admin.ModelAdmin):
+class BookingAdmin(ExportAdminMixin, admin.ModelAdmin):
     fields = ['timeslot', 'email', 'cancelcode', 'password']
+    export_fields = ['id', 'timeslot', 'email', 'created', 'modified']
+    export_date_field = 'timeslot'
+    list_display = ['timeslot', 'email', 'created']
+    list_filter = ['timeslot']
+    date_hierarchy = 'timeslot'
+    search_fields = ['email']
 
 admin.site.register(Booking, BookingAdmin)
 
-class VerifiedEmailAdmin(admin.ModelAdmin):
+class VerifiedEmailAdmin(ExportAdminMixin, admin.ModelAdmin):
     fields = ['email', 'verified']
+    export_fields = ['id', 'email', 'verified', 'created', 'modified']
+    export_date_field = 'created'
 
 admin.site.register(VerifiedEmail, VerifiedEmailAdmin)
 
-class MaintenanceAdmin(admin.ModelAdmin):
-    fields = ['start', 'end', 'reason']
+class MaintenanceAdmin(ExportAdminMixin, admin.ModelAdmin):
+    fields = ['start', 'end', 'reason', 'recurrence', 'repeat_until']
+    export_fields = ['id', 'start', 'end', 'reason', 'recurrence', 'repeat_until', 'created', 'modified']
+    export_date_field = 'start'
+    list_display = ['start', 'end', 'recurrence', 'repeat_until', 'reason']
+    list_filter = ['recurrence']
 
-admin.site.register(Maintenance, MaintenanceAdmin)
\ No newline at end of file
+admin.site.register(Maintenance, MaintenanceAdmin)
+
+class CmlJobAdmin(ExportAdminMixin, admin.ModelAdmin):
+    fields = ['kind', 'status', 'email', 'booking', 'error', 'started', 'heartbeat', 'finished']
+    export_fields = ['reference', 'kind', 'status', 'email', 'booking_id', 'error', 'created', 'started', 'finished']
+    export_date_field = 'created'
+    readonly_fields = ['started', 'heartbeat', 'finished']
+    list_display = ['reference', 'kind', 'status', 'email', 'created', 'finished']
+    list_filter = ['kind', 'status']
+
+admin.site.register(CmlJob, CmlJobAdmin)
+
+class CmlCapabilityAdmin(admin.ModelAdmin):
+    fields = ['name', 'variant']
+    list_display = ['name', 'variant', 'modified']
+
+admin.site.register(CmlCapability, CmlCapabilityAdmin)
+
+class TeardownLabInline(admin.TabularInline):
+    model = TeardownLab
+    fields = ['lab', 'exported', 'stopped', 'wiped', 'deleted', 'modified']
+    readonly_fields = ['modified']
+    extra = 0
+
+class TeardownAdmin(admin.ModelAdmin):
+    fields = ['email', 'password_restored', 'users_logged_out', 'email_sent', 'errors', 'heartbeat', 'finished']
+    readonly_fields = ['heartbeat', 'finished']
+    list_display = ['email', 'created', 'finished', 'password_restored', 'email_sent']
+    inlines = [TeardownLabInline]
+
+admin.site.register(Teardown, TeardownAdmin)
+
+class LabCheckpointAdmin(admin.ModelAdmin):
+    fields = ['email', 'lab', 'modified']
+    readonly_fields = ['modified']
+    list_display = ['lab', 'email', 'modified', 'saved']
+
+admin.site.register(LabCheckpoint, LabCheckpointAdmin)
+
+class PendingAlertAdmin(admin.ModelAdmin):
+    fields = ['source', 'code', 'lab', 'message', 'count', 'first_seen', 'last_seen', 'sent']
+    readonly_fields = ['first_seen', 'last_seen', 'sent']
+    list_display = ['source', 'code', 'lab', 'count', 'first_seen', 'last_seen', 'sent']
+    list_filter = ['source', 'code']
+
+admin.site.register(PendingAlert, PendingAlertAdmin)
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    # Rollups are maintained by rollups.py only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class DailyStatsAdmin(ReadOnlyAdmin):
+    change_list_template = 'admin/booking/dailystats/dashboard.html'
+    list_display = ['date', 'bookings', 'cancellations', 'teardowns', 'teardown_failures', 'average_teardown_seconds']
+    date_hierarchy = 'date'
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {**(extra_context or {}), 'dashboard': rollups.Dashboard()}
+        return super().changelist_view(request, extra_context)
+
+admin.site.register(DailyStats, DailyStatsAdmin)
+
+class SlotStatsAdmin(ReadOnlyAdmin):
+    list_display = ['date', 'hour', 'bookings', 'cancellations']
+    list_filter = ['hour']
+    date_hierarchy = 'date'
+
+admin.site.register(SlotStats, SlotStatsAdmin)
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""
+Failure alerts to the admin (SENDGRID_BCC_EMAIL).
+
+CleanUp and CreateTempUser report their error_trace here instead of
+emailing the admin on every failure. Entries are deduplicated by source,
+error code and lab: repeats only increase the count of the pending alert.
+The scheduler sends all pending alerts as one digest every
+ALERT_DIGEST_MINUTES, so a CML outage gives one email per window instead of
+one or two per booking.
+
+Critical errors, which leave CML with a temporary admin password or users
+logged in, are still sent right away.
+"""
+import re
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.html import format_html, format_html_join
+from . import clock
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('alerts_reported_total', 'Errors reported to the admin alerts by source and severity')
+metrics.Describe('alerts_emails_sent_total', 'Admin alert emails sent by kind')
+
+# (source, error code) sent right away instead of in the digest
+CRITICAL = {
+    ('CleanUp', '08'),          # UpdateUserPassword failed, temporary password still active
+    ('CleanUp', '09'),          # GetToken failed after the password restore
+    ('CleanUp', '10'),          # LogAllUsersOut failed, the user is still logged in
+    ('CreateTempUser', '03'),   # UpdateUserPassword failed, the user got no access
+}
+
+ERROR_CODE = re.compile(r'^(\d+):\s*(.*)$', re.S)
+LAB_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.I)
+
+def Parse(entry):
+    """
+    Split an error_trace entry like '05: StopLab failed for <lab>' into
+    (code, lab, message)
+    """
+    match = ERROR_CODE.match(entry)
+    code, message = match.groups() if match else ('', entry)
+    lab = LAB_ID.search(message)
+    return code, lab.group(0) if lab else '', message
+
+def _Send(title, alerts):
+    from .cml import SendEmail
+    rows = format_html_join(
+        '\n', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{} - {}</td></tr>',
+        ((a.source, a.code, a.lab, a.message, a.count,
+          timezone.localtime(a.first_seen).strftime('%d.%m %H:%M'),
+          timezone.localtime(a.last_seen).strftime('%d.%m %H:%M')) for a in alerts)
+    )
+    body = format_html(
+        '<table border="1" cellpadding="4"><tr><th>Kilde</th><th>Kode</th><th>Lab</th><th>Feil</th><th>Antall</th><th>Tidsrom</th></tr>\n{}\n</table>',
+        rows,
+    )
+    return SendEmail(settings.SENDGRID_BCC_EMAIL, title, body)
+
+def Report(source, error_trace):
+    """
+    Record the errors of a failed CleanUp or CreateTempUser. Critical errors
+    are sent right away, the rest waits for the digest.
+    """
+    from booking.models import PendingAlert
+
+    if not settings.SENDGRID_BCC_EMAIL or not error_trace:
+        return
+
+    now = clock.Now()
+    critical = []
+    for entry in error_trace:
+        code, lab, message = Parse(entry)
+        if (source, code) in CRITICAL or not settings.ALERT_DIGEST_MINUTES:
+            metrics.Increment('alerts_reported_total', source=source, severity='critical')
+            critical.append(PendingAlert(source=source, code=code, lab=lab, message=message, first_seen=now, last_seen=now))
+            continue
+
+        metrics.Increment('alerts_reported_total', source=source, severity='digest')
+        updated = PendingAlert.objects.filter(source=source, code=code, lab=lab, sent__isnull=True).update(count=F('count') + 1, last_seen=now)
+        if not updated:
+            PendingAlert.objects.create(source=source, code=code, lab=lab, message=message, first_seen=now, last_seen=now)
+
+    if critical:
+        sent = _Send(f'Community Network - {source} failed!', critical)
+        if sent:
+            metrics.Increment('alerts_emails_sent_total', kind='critical')
+        else:
+            logger.error("Report: Could not send critical alert for %s, it is sent with the next digest", source)
+        for alert in critical:
+            alert.sent = now if sent else None
+        PendingAlert.objects.bulk_create(critical)
+
+def SendDigest():
+    """
+    Send all pending alerts as one email. Run by the scheduler every
+    ALERT_DIGEST_MINUTES.
+    """
+    from booking.models import PendingAlert
+
+    alerts = list(PendingAlert.objects.filter(sent__isnull=True).order_by('first_seen'))
+    if not alerts or not settings.SENDGRID_BCC_EMAIL:
+        return
+
+    total = sum(a.count for a in alerts)
+    if _Send(f'Community Network - {total} feil siste {settings.ALERT_DIGEST_MINUTES} minutter', alerts):
+        PendingAlert.objects.filter(pk__in=[a.pk for a in alerts]).update(sent=clock.Now())
+        metrics.Increment('alerts_emails_sent_total', kind='digest')
+        logger.info("SendDigest: Sent %s alerts (%s errors)", len(alerts), total)
+    else:
+        logger.error("SendDigest: Could not send the digest, retrying next time")
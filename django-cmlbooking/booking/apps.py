@@ -1,11 +1,52 @@
+import os
+import sys
+
 from django.apps import AppConfig
 from django.conf import settings
 
+# manage.py commands that serve requests and therefore need the scheduler.
+# Every other command (migrate, shell, check, ...) starts without it.
+SCHEDULER_COMMANDS = ('runserver',)
+
+# WSGI/ASGI servers recognised by their program name. Servers started
+# otherwise (e.g. mod_wsgi) set SCHEDULER_SERVER in their environment.
+SERVER_PROGRAMS = ('gunicorn', 'daphne', 'uvicorn', 'hypercorn', 'uwsgi')
+
+def _Program():
+    # Name of the program, also when started as python -m <module>
+    path = sys.argv[0] if sys.argv else ''
+    name = os.path.basename(path)
+    if name == '__main__.py':
+        name = os.path.basename(os.path.dirname(path))
+    return name
+
+def RunsServer():
+    """
+    Return True if this process is an application server and not a short
+    lived management command, test run or script
+    """
+    if settings.SCHEDULER_SERVER or _Program() in SERVER_PROGRAMS:
+        return True
+
+    if _Program() not in ('manage.py', 'django-admin'):
+        return False
+    if len(sys.argv) < 2 or sys.argv[1] not in SCHEDULER_COMMANDS:
+        return False
+
+    # The runserver autoreloader imports the project twice, only the
+    # child process serving requests should run the scheduler
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
 class BookingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'booking'
 
     def ready(self):
-        from . import scheduler
-        if settings.SCHEDULER_AUTOSTART:
-        	scheduler.start()
+        # Connect the signals that push calendar changes to live streams
+        # and count new bookings in the rollups
+        from . import live
+        from . import rollups
+
+        if settings.SCHEDULER_AUTOSTART and RunsServer():
+            from . import scheduler
+            scheduler.start()
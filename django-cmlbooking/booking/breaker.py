@@ -0,0 +1,105 @@
+"""
+Circuit breaker for the CML API.
+
+After CML_BREAKER_THRESHOLD consecutive failures (connection errors,
+timeouts or 502/503/504 responses) the breaker opens and every CML call
+fails fast with CircuitOpenError. While open, a background thread probes
+CML every CML_BREAKER_RESET_SECONDS and closes the breaker as soon as CML
+answers again.
+"""
+import threading
+import time
+from django.conf import settings
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+metrics.Describe('cml_circuit_open', 'Whether the CML circuit breaker is open (1) or closed (0)')
+metrics.Describe('cml_circuit_opened_total', 'Number of times the CML circuit breaker has opened')
+metrics.Describe('cml_requests_total', 'CML API requests by outcome')
+metrics.Describe('cml_request_seconds', 'Duration of CML API requests')
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling CML while the breaker is open
+    """
+
+class CircuitBreaker:
+    def __init__(self, name, probe, failure_threshold, reset_timeout):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+        self._prober = None
+        metrics.SetGauge(f'{name}_circuit_open', 0)
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def Check(self):
+        """
+        Raise CircuitOpenError if calls are currently not allowed
+        """
+        if self.state == OPEN:
+            metrics.Increment(f'{self.name}_requests_total', outcome='rejected')
+            raise CircuitOpenError(f'{self.name} circuit breaker is open since {time.ctime(self.opened_at)}')
+
+    def RecordSuccess(self):
+        with self._lock:
+            self.failures = 0
+            if self.state == OPEN:
+                logger.warning("CircuitBreaker: %s is reachable again, closing breaker", self.name)
+                self.state = CLOSED
+                self.opened_at = None
+                metrics.SetGauge(f'{self.name}_circuit_open', 0)
+
+    def RecordFailure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CLOSED and self.failures >= self.failure_threshold:
+                logger.error("CircuitBreaker: %s failed %s times in a row, opening breaker", self.name, self.failures)
+                self.state = OPEN
+                self.opened_at = time.time()
+                metrics.SetGauge(f'{self.name}_circuit_open', 1)
+                metrics.Increment(f'{self.name}_circuit_opened_total')
+                self._StartProber()
+
+    def _StartProber(self):
+        if self._prober and self._prober.is_alive():
+            return
+        self._prober = threading.Thread(target=self._Probe, name=f'{self.name}-breaker-probe', daemon=True)
+        self._prober.start()
+
+    def _Probe(self):
+        while self.state == OPEN:
+            time.sleep(self.reset_timeout)
+            try:
+                ok = self.probe()
+            except Exception as e:
+                logger.info("CircuitBreaker: probe of %s failed: %s", self.name, e)
+                ok = False
+            if ok:
+                self.RecordSuccess()
+
+def ProbeCml():
+    """
+    Cheap unauthenticated request to see if CML answers at all
+    """
+    import requests
+    r = requests.get(settings.CML_API_BASE_URL + settings.CML_PROBE_PATH, verify=False, timeout=settings.CML_CONNECT_TIMEOUT)
+    return r.status_code < 500
+
+cml_breaker = CircuitBreaker(
+    'cml',
+    probe=ProbeCml,
+    failure_threshold=settings.CML_BREAKER_THRESHOLD,
+    reset_timeout=settings.CML_BREAKER_RESET_SECONDS,
+)
@@ -0,0 +1,92 @@
+"""
+Cache of which CML API endpoint variant our CML build accepts.
+
+Some CML operations exist in several variants across CML releases, see
+LogAllUsersOut and UpdateUserPassword in cml.py and the lab summaries of
+the poller. The first call walks all
+variants and records the one that worked, later calls go straight to it.
+Entries expire after CML_CAPABILITY_TTL_HOURS and are dropped as soon as the
+recorded variant stops working.
+"""
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from booking.models import CmlCapability
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('cml_capability_probes_total', 'Number of times all variants of a CML endpoint were probed')
+
+# In-memory copy so the hot path does not hit the database: name -> (variant, expires)
+_cache = {}
+_lock = threading.Lock()
+
+def Get(name):
+    """
+    Return the recorded variant for name, or None if unknown or expired
+    """
+    with _lock:
+        cached = _cache.get(name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    ttl = timedelta(hours=settings.CML_CAPABILITY_TTL_HOURS)
+    capability = CmlCapability.objects.filter(name=name, modified__gte=timezone.now()-ttl).first()
+    if not capability:
+        return None
+
+    expires = capability.modified.timestamp() + ttl.total_seconds()
+    with _lock:
+        _cache[name] = (capability.variant, expires)
+    return capability.variant
+
+def Set(name, variant):
+    """
+    Record the variant that worked for name
+    """
+    with _lock:
+        cached = _cache.get(name)
+        _cache[name] = (variant, time.time() + settings.CML_CAPABILITY_TTL_HOURS * 3600)
+    if cached and cached[0] == variant:
+        return
+    CmlCapability.objects.update_or_create(name=name, defaults={'variant': variant})
+    logger.info("Capabilities: %s uses variant %s", name, variant)
+
+def Forget(name):
+    """
+    Drop the recorded variant for name, the next call probes all variants
+    """
+    with _lock:
+        _cache.pop(name, None)
+    CmlCapability.objects.filter(name=name).delete()
+    logger.warning("Capabilities: recorded variant for %s stopped working, re-probing", name)
+
+def TryVariants(name, variants, call, accepted):
+    """
+    Call the recorded variant of name first, then the remaining variants in
+    order until one is accepted. Records the accepted variant.
+
+    variants: list of variant keys, in probe order
+    call: function(variant) returning a response
+    accepted: function(response) returning True if the variant worked
+
+    Returns the response of the last call made.
+    """
+    known = Get(name)
+    if known not in variants:
+        known = None
+        metrics.Increment('cml_capability_probes_total', capability=name)
+
+    ordered = ([known] if known else []) + [v for v in variants if v != known]
+    for variant in ordered:
+        r = call(variant)
+        if accepted(r):
+            Set(name, variant)
+            return r
+        if variant == known:
+            Forget(name)
+            metrics.Increment('cml_capability_probes_total', capability=name)
+    return r
@@ -0,0 +1,86 @@
+"""
+Central clock for the booking logic.
+
+The views, the scheduler jobs, the background CML jobs and teardowns
+(deadline, heartbeats and staleness), the poller, retention, rollups,
+alerts, the calendar feed and the live calendar ask this module for the
+current time instead of calling datetime.now(), date.today(),
+timezone.now() or time.time() directly. The created and modified
+timestamps of the models are taken from it too (models.ClockDateTimeField).
+Tests and the simulate command install a SimulatedClock to run at a fixed
+time or faster than real time.
+
+Timing that protects real resources stays on wall time: the rate limiter,
+the circuit breaker, the CML capability cache, the health checks, lab file
+ages and the APScheduler triggers.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+class Clock:
+    """
+    Real time
+    """
+    def Time(self):
+        return time.time()
+
+class SimulatedClock(Clock):
+    """
+    Clock starting at start (an aware datetime) and running speed times
+    faster than real time. Speed 0 stops the clock, it then only moves with
+    Advance and Set.
+    """
+    def __init__(self, start, speed=1.0):
+        self._lock = threading.Lock()
+        self.speed = speed
+        self._start = start.timestamp()
+        self._origin = time.monotonic()
+
+    def Time(self):
+        with self._lock:
+            return self._start + (time.monotonic() - self._origin) * self.speed
+
+    def Set(self, when):
+        with self._lock:
+            self._start = when.timestamp()
+            self._origin = time.monotonic()
+
+    def Advance(self, seconds):
+        with self._lock:
+            self._start += seconds
+
+_clock = Clock()
+
+def Install(clock):
+    """
+    Use another clock in all threads. Returns the previous clock.
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+@contextmanager
+def Using(clock):
+    previous = Install(clock)
+    try:
+        yield clock
+    finally:
+        Install(previous)
+
+def Time():
+    # Seconds since the epoch, like time.time()
+    return _clock.Time()
+
+def Now():
+    # Aware UTC datetime, like timezone.now()
+    return datetime.fromtimestamp(Time(), tz=timezone.utc)
+
+def LocalNow():
+    # Naive local datetime, like datetime.now()
+    return datetime.fromtimestamp(Time())
+
+def Today():
+    # Local date, like date.today()
+    return LocalNow().date()
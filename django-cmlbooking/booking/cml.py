@@ -4,18 +4,64 @@ import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 import os
 import base64
-from django.template.loader import render_to_string
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, ContentId
+from . import alerts
+from . import clock
+from . import emails
 from django.conf import settings
 import logging
 logger = logging.getLogger(__name__)
 import mimetypes
-from django.core.mail import EmailMultiAlternatives
-from anymail.exceptions import AnymailError
-import zipfile
-import tempfile
 import time
+from datetime import timedelta
+from . import metrics
+from . import poller
+from .breaker import CircuitOpenError, cml_breaker
+
+class _Snippet:
+    """
+    Lazily rendered start of a response body for log messages. The body is
+    only decoded if the log record is actually formatted.
+    """
+    __slots__ = ('response',)
+
+    def __init__(self, response):
+        self.response = response
+
+    def __str__(self):
+        return self.response.text[:200]
+
+def _request(method, url, **kwargs):
+    """
+    Send a request to the CML API through the circuit breaker.
+
+    Fails fast with CircuitOpenError while CML is considered down.
+    Connection errors, timeouts and 502/503/504 responses count as failures.
+    Read timeouts of calls with a caller supplied (shortened) timeout do not.
+    """
+    kwargs.setdefault('verify', False)
+    own_timeout = kwargs.get('timeout') is not None
+    if not own_timeout:
+        kwargs['timeout'] = (settings.CML_CONNECT_TIMEOUT, settings.CML_TIMEOUT)
+    cml_breaker.Check()
+
+    started = time.monotonic()
+    try:
+        r = requests.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        if not (own_timeout and isinstance(e, requests.exceptions.ReadTimeout)):
+            cml_breaker.RecordFailure()
+        metrics.Increment('cml_requests_total', outcome='error')
+        raise
+    finally:
+        metrics.Observe('cml_request_seconds', time.monotonic() - started)
+
+    if r.status_code in (502, 503, 504):
+        cml_breaker.RecordFailure()
+        metrics.Increment('cml_requests_total', outcome='error')
+    else:
+        cml_breaker.RecordSuccess()
+        metrics.Increment('cml_requests_total', outcome='ok')
+    return r
 
 def GetToken(username, password):
     """
@@ -27,8 +73,8 @@ def GetToken(username, password):
     """
     api_url = "authenticate"
     payload = { "username": username, "password": password }
-    r = requests.post(settings.CML_API_BASE_URL+api_url, json=payload, verify=False)
-    logger.info(f"GetToken: {r.status_code}")
+    r = _request('POST', settings.CML_API_BASE_URL+api_url, json=payload)
+    logger.info("GetToken: %s", r.status_code)
     token = r.text.strip().strip('"').strip("'")
     return token, r.status_code
 
@@ -42,25 +88,57 @@ def GetListOfAllLabs(token):
     """
     api_url = "labs?show_all=true"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.get(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"GetListOfAllLabs: {r.status_code}")
+    r = _request('GET', settings.CML_API_BASE_URL+api_url, headers=head)
+    logger.info("GetListOfAllLabs: %s", r.status_code)
+    return r.json(), r.status_code
+
+def GetLabTiles(token):
+    """
+    Return the summary of all labs in one call, a dict keyed by lab id with
+    'state', 'modified' and 'node_count' among others
+
+    Status codes:
+      Success: 200
+      Not available in this CML version: 404
+    """
+    api_url = "populate_lab_tiles?show_all=true"
+    head = {'Authorization': f'Bearer {token}'}
+    r = _request('GET', settings.CML_API_BASE_URL+api_url, headers=head)
+    logger.info("GetLabTiles: %s", r.status_code)
+    if r.status_code != 200:
+        return None, r.status_code
+    return r.json().get('lab_tiles', {}), r.status_code
+
+def GetLabInfo(token, labId, timeout=None):
+    """
+    Return the details of a given lab, including its 'modified' timestamp
+
+    Status codes:
+      Success: 200
+      Failure: any other values
+    """
+    api_url = f"labs/{labId}"
+    head = {'Authorization': f'Bearer {token}'}
+    r = _request('GET', settings.CML_API_BASE_URL+api_url, headers=head, timeout=timeout)
+    logger.info("GetLabInfo: %s", r.status_code)
     return r.json(), r.status_code
 
-def GetNodesInLab(token, labId):
+def GetNodesInLab(token, labId, timeout=None, data=False):
     """
-    Return a list of all nodes in a given lab
+    Return a list of all nodes in a given lab. With data, a list of node
+    objects (including the node state) instead of node ids.
 
     Status codes:
       Success: 200
       Failure: any other values
     """
-    api_url = f"labs/{labId}/nodes?data=false"
+    api_url = f"labs/{labId}/nodes?data={'true' if data else 'false'}"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.get(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"GetNodesInLab: {r.status_code}")
+    r = _request('GET', settings.CML_API_BASE_URL+api_url, headers=head, timeout=timeout)
+    logger.info("GetNodesInLab: %s", r.status_code)
     return r.json(), r.status_code
 
-def GetNodeConfig(token, labId, node):
+def GetNodeConfig(token, labId, node, timeout=None):
     """
     Extract node config for a given node in a given lab
 
@@ -70,11 +148,11 @@ def GetNodeConfig(token, labId, node):
     """
     api_url = f"labs/{labId}/nodes/{node}/extract_configuration"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.put(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"GetNodeConfig: {r.status_code}")
+    r = _request('PUT', settings.CML_API_BASE_URL+api_url, headers=head, timeout=timeout)
+    logger.info("GetNodeConfig: %s", r.status_code)
     return r.json(), r.status_code
 
-def DownloadLab(token, labId):
+def DownloadLab(token, labId, timeout=None):
     """
     Download a given lab
 
@@ -84,8 +162,8 @@ def DownloadLab(token, labId):
     """
     api_url = f"labs/{labId}/download"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.get(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"DownloadLab: {r.status_code}")
+    r = _request('GET', settings.CML_API_BASE_URL+api_url, headers=head, timeout=timeout)
+    logger.info("DownloadLab: %s", r.status_code)
     return r.text, r.status_code
 
 def SaveLab(labId, labFile):
@@ -97,7 +175,7 @@ def SaveLab(labId, labFile):
         os.mkdir(labs_directory)
     with open(f'{os.path.join(labs_directory, labId)}.yaml', 'w') as file:
         file.write(labFile)
-    logger.info(f"SaveLab: {labId}")
+    logger.info("SaveLab: %s", labId)
 
 def _zip_attachments(file_paths, zip_basename="cml_vedlegg"):
     """
@@ -107,18 +185,21 @@ def _zip_attachments(file_paths, zip_basename="cml_vedlegg"):
 
     We use the system temp dir so we don't pollute the project tree.
     """
+    import tempfile
+    import zipfile
+
     ts = int(time.time())
     zip_path = os.path.join(tempfile.gettempdir(), f"{zip_basename}_{ts}.zip")
 
     with zipfile.ZipFile(zip_path, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
         for p in file_paths or []:
             if not os.path.exists(p):
-                logger.warning(f"_zip_attachments: file not found, skipping: {p}")
+                logger.warning("_zip_attachments: file not found, skipping: %s", p)
                 continue
             # arcname strips directories so recipients see clean filenames inside the ZIP
             zf.write(p, arcname=os.path.basename(p))
 
-    logger.info(f"_zip_attachments: built {zip_path}")
+    logger.info("_zip_attachments: built %s", zip_path)
     return zip_path
 
 def StopLab(token, labId):
@@ -131,8 +212,8 @@ def StopLab(token, labId):
     """
     api_url = f"labs/{labId}/stop"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.put(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"StopLab: {r.status_code}")
+    r = _request('PUT', settings.CML_API_BASE_URL+api_url, headers=head)
+    logger.info("StopLab: %s", r.status_code)
     return r.status_code
 
 def WipeLab(token, labId):
@@ -145,8 +226,8 @@ def WipeLab(token, labId):
     """
     api_url = f"labs/{labId}/wipe"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.put(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"WipeLab: {r.status_code}")
+    r = _request('PUT', settings.CML_API_BASE_URL+api_url, headers=head)
+    logger.info("WipeLab: %s", r.status_code)
     return r.status_code
 
 def DeleteLab(token, labId):
@@ -159,15 +240,15 @@ def DeleteLab(token, labId):
     """
     api_url = f"labs/{labId}"
     head = {'Authorization': f'Bearer {token}'}
-    r = requests.delete(settings.CML_API_BASE_URL+api_url, headers=head, verify=False)
-    logger.info(f"DeleteLab: {r.status_code}")
+    r = _request('DELETE', settings.CML_API_BASE_URL+api_url, headers=head)
+    logger.info("DeleteLab: %s", r.status_code)
     return r.status_code
 
 def GetAdminId(token):
     api_url = "users/admin/id"
     head = {'Authorization': f'Bearer {token}', 'Accept': 'application/json'}
-    r = requests.get(settings.CML_API_BASE_URL + api_url, headers=head, verify=False, timeout=10)
-    logger.info(f"GetAdminId: {r.status_code} body={r.text[:200]}")
+    r = _request('GET', settings.CML_API_BASE_URL + api_url, headers=head)
+    logger.info("GetAdminId: %s body=%s", r.status_code, _Snippet(r))
     admin_id = None
     try:
         data = r.json()
@@ -180,45 +261,50 @@ def GetAdminId(token):
         admin_id = r.text.strip().strip('"').strip("'")
     return admin_id, r.status_code
 
+# Variants of the logout endpoint seen across CML builds, in probe order:
+# key: (method, path, json body)
+LOGOUT_VARIANTS = {
+    # Current path
+    'delete_query': ('DELETE', 'logout?clear_all_sessions=true', None),
+    # Fallbacks seen in the wild
+    'post_body': ('POST', 'logout', {"clear_all_sessions": True}),
+    'post_query': ('POST', 'logout?clear_all_sessions=true', None),
+    # Rare
+    'users_logout': ('POST', 'users/logout', {"clear_all_sessions": True}),
+}
+
+# Variants of the user update endpoint: key: path
+PASSWORD_VARIANTS = {
+    # No trailing slash (preferred by docs)
+    'no_slash': 'users/{userId}',
+    # Trailing slash (compat)
+    'trailing_slash': 'users/{userId}/',
+}
+
 def LogAllUsersOut(token):
     """
     Clears sessions and logs out everyone (admin-triggered).
-    Tries DELETE first (current impl), then POST fallbacks used by some CML builds.
+    Tries the variant recorded for our CML build first, then the remaining
+    variants in LOGOUT_VARIANTS, see capabilities.TryVariants.
 
     Returns:
       200 on success (even if underlying endpoint returns 204),
       otherwise the last HTTP status code.
     """
+    from . import capabilities
+
     base = settings.CML_API_BASE_URL.rstrip('/')
     head = {'Authorization': f'Bearer {token}', 'Accept': 'application/json', 'Content-Type': 'application/json'}
 
-    # 1) Current path: DELETE /logout?clear_all_sessions=true
-    url1 = f"{base}/logout?clear_all_sessions=true"
-    r1 = requests.delete(url1, headers=head, verify=False, timeout=10)
-    logger.info(f"LogAllUsersOut DELETE -> {url1} : {r1.status_code} {r1.text[:200]}")
-    if r1.status_code in (200, 204):
-        return 200
-
-    # 2) Fallbacks seen in the wild (POST)
-    candidates = [
-        ("post", f"{base}/logout", {"clear_all_sessions": True}),
-        ("post", f"{base}/logout?clear_all_sessions=true", None),  # no body
-    ]
-    for method, url, body in candidates:
-        resp = getattr(requests, method)(url, headers=head, json=body, verify=False, timeout=10)
-        logger.info(f"LogAllUsersOut {method.upper()} -> {url} : {resp.status_code} {resp.text[:200]}")
-        if resp.status_code in (200, 204):
-            return 200
-
-    # 3) As a last resort, try /users/logout (rare)
-    url3 = f"{base}/users/logout"
-    r3 = requests.post(url3, headers=head, json={"clear_all_sessions": True}, verify=False, timeout=10)
-    logger.info(f"LogAllUsersOut POST -> {url3} : {r3.status_code} {r3.text[:200]}")
-    if r3.status_code in (200, 204):
-        return 200
-
-    # Return the last status code if none succeeded
-    return r3.status_code if 'r3' in locals() else r1.status_code
+    def call(variant):
+        method, path, body = LOGOUT_VARIANTS[variant]
+        url = f"{base}/{path}"
+        r = _request(method, url, headers=head, json=body)
+        logger.info("LogAllUsersOut %s -> %s : %s %s", method, url, r.status_code, _Snippet(r))
+        return r
+
+    r = capabilities.TryVariants('logout', list(LOGOUT_VARIANTS), call, lambda r: r.status_code in (200, 204))
+    return 200 if r.status_code in (200, 204) else r.status_code
 
 def UpdateUserPassword(token, userId, oldpw, newpw):
     """
@@ -229,11 +315,13 @@ def UpdateUserPassword(token, userId, oldpw, newpw):
     - For admin users the API allows setting a new password by providing an
       empty old password. Therefore the 'oldpw' argument is intentionally not
       used in the payload below.
-    - We try WITHOUT trailing slash first (as per docs). If that returns 404,
-      we retry WITH a trailing slash for compatibility with some deployments.
+    - Some deployments only accept the URL WITH a trailing slash. The variant
+      our CML build accepts (anything but 404) is recorded, see
+      capabilities.TryVariants.
 
     Returns: HTTP status code from the final API call.
     """
+    from . import capabilities
 
     base = settings.CML_API_BASE_URL.rstrip('/')
 
@@ -247,19 +335,17 @@ def UpdateUserPassword(token, userId, oldpw, newpw):
     # Admin path: empty old_password is allowed by the API
     payload = {"password": {"old_password": "", "new_password": newpw}}
 
-    # 1) No trailing slash (preferred by docs)
-    url = f"{base}/users/{userId}"
-    r = requests.patch(url, headers=headers, json=payload, verify=False, timeout=10)
-    logger.info(f"UpdateUserPassword -> {url} : {r.status_code} {r.text[:200]}")
-    if r.status_code != 404:
-        return r.status_code
+    def call(variant):
+        url = f"{base}/{PASSWORD_VARIANTS[variant].format(userId=userId)}"
+        r = _request('PATCH', url, headers=headers, json=payload)
+        logger.info("UpdateUserPassword -> %s : %s %s", url, r.status_code, _Snippet(r))
+        return r
 
-    # 2) Retry with trailing slash (compat)
-    url2 = url + "/"
-    r2 = requests.patch(url2, headers=headers, json=payload, verify=False, timeout=10)
-    logger.info(f"UpdateUserPassword (trailing slash) -> {url2} : {r2.status_code} {r2.text[:200]}")
-    return r2.status_code
+    r = capabilities.TryVariants('update_user', list(PASSWORD_VARIANTS), call, lambda r: r.status_code != 404)
+    return r.status_code
 
+# Legacy SendGrid implementation, kept for reference. The sendgrid SDK is no
+# longer imported.
 #def SendEmail(email, title, content, attachments=None):
 #    """
 #    Sends an email with input title and content. Attachment is optional.
@@ -328,6 +414,9 @@ def SendEmail(email, title, content, attachments=None, reply_to=None, bcc_email=
 
         Returns True or False.
         """
+        # Loaded on first use, the mail stack is only needed when sending
+        from django.core.mail import EmailMultiAlternatives
+        from anymail.exceptions import AnymailError
 
         try:
                 to_list = [email] if isinstance(email, str) else list(email)
@@ -353,7 +442,7 @@ def SendEmail(email, title, content, attachments=None, reply_to=None, bcc_email=
                 if attachments:
                         for path in attachments:
                                 if not os.path.exists(path):
-                                        logger.warning(f"SendEmail: Vedlegg finnes ikke: {path}")
+                                        logger.warning("SendEmail: Vedlegg finnes ikke: %s", path)
                                         continue
                                 filename = os.path.basename(path)
                                 mime, _ = mimetypes.guess_type(filename)
@@ -365,131 +454,350 @@ def SendEmail(email, title, content, attachments=None, reply_to=None, bcc_email=
 
                 sent = msg.send()
                 if sent == 1:
-                        logger.info(f"SendEmail OK -> to={to_list} subj='{title}' tags={tags}")
+                        logger.info("SendEmail OK -> to=%s subj='%s' tags=%s", to_list, title, tags)
                         return True
                 else:
-                        logger.error(f"SendEmail: msg.send() returned {sent} (expected 1)")
+                        logger.error("SendEmail: msg.send() returned %s (expected 1)", sent)
                         return False
         except AnymailError as e:
-                logger.exception(f"SendEmail: Anymail/Brevo-errror: {e}")
+                logger.exception("SendEmail: Anymail/Brevo-errror: %s", e)
                 return False
         except Exception as e:
-                logger.exception(f"SendEmail: error: {e}")
+                logger.exception("SendEmail: error: %s", e)
                 return False
 
 
-def CleanUp(email, temp_password):
+metrics.Describe('cml_teardown_seconds', 'Duration of lab teardowns')
+metrics.Describe('cml_teardown_overruns_total', 'Teardowns that finished after their deadline')
+metrics.Describe('cml_teardown_overrun_seconds', 'How far past the deadline overrunning teardowns finished')
+metrics.Describe('cml_teardown_exports_skipped_total', 'Lab exports skipped to meet the teardown deadline')
+metrics.Describe('cml_lab_downloads_skipped_total', 'Lab downloads skipped because the lab was unchanged since the last checkpoint')
+
+class _ExportBudgetSpent(Exception):
+    pass
+
+def _ExportLab(token, lab, timeout, checkpoint=None, nodes=None, budget=None):
+    """
+    Extract running node configs and save the lab to file. Best effort,
+    every call is limited to timeout seconds.
+
+    budget is a function returning the seconds left for the export. It is
+    asked before every call, the call timeout is capped to what is left and
+    the export stops when nothing is left.
+
+    nodes are the ids of the nodes to extract configs from, if already known
+    (see poller). Otherwise all nodes of the lab are listed first.
+
+    With a checkpoint (LabCheckpoint) the download is skipped if the lab is
+    unchanged since the checkpoint was saved, and the checkpoint is updated
+    after a new download.
+
+    Returns a list of errors, empty on success.
+    """
+    def Timeout():
+        # Timeout of the next call
+        if budget is None:
+            return timeout
+        left = budget()
+        if left <= 0:
+            raise _ExportBudgetSpent()
+        connect, read = timeout or (settings.CML_CONNECT_TIMEOUT, settings.CML_TIMEOUT)
+        return (min(connect, left), min(read, left))
+
+    errors = []
+    try:
+        if nodes is None:
+            nodes, statuscode = GetNodesInLab(token, lab, timeout=Timeout())
+        else:
+            statuscode = 200
+        if statuscode != 200:
+            logger.warning("CleanUp: GetNodesInLab FAILED for %s, contiuneing without it.", lab)
+            errors.append(f"02: GetNodesInLab FAILED for {lab}, contiuneing without it.")
+            nodes = []
+
+        for node in nodes:
+            # Note! Extract of config only works if node is running,
+            #       so non-running nodes will not be part of lab export
+            nodeconfig, statuscode = GetNodeConfig(token, lab, node, timeout=Timeout())
+            if statuscode != 200:
+                # Do not treat this as a hard failure. We can still Stop/Wipe/Delete the lab.
+                logger.warning("CleanUp: GetNodeConfig not available for %s, continuing without it.", lab)
+                break
+
+        # Compare after the config extraction, as extracted configs are part of the lab
+        modified = None
+        if checkpoint is not None:
+            info, statuscode = GetLabInfo(token, lab, timeout=Timeout())
+            if statuscode == 200 and isinstance(info, dict):
+                modified = info.get('modified')
+            lab_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'labs/', f"{lab}.yaml")
+            if modified and modified == checkpoint.modified and os.path.exists(lab_path):
+                logger.info("CleanUp: Lab %s unchanged since checkpoint %s, skipping download", lab, checkpoint.saved)
+                metrics.Increment('cml_lab_downloads_skipped_total')
+                return errors
+
+        downloadlab, statuscode = DownloadLab(token, lab, timeout=Timeout())
+        if statuscode == 200:
+            SaveLab(lab, downloadlab)
+            if modified:
+                checkpoint.modified = modified
+                checkpoint.save()
+        else:
+            logger.error("CleanUp: DownloadLab FAILED for lab %s.", lab)
+            errors.append(f"04: DownloadLab failed for {lab}")
+    except (_ExportBudgetSpent, requests.exceptions.RequestException, ValueError) as e:
+        # A call cut short by the capped timeout also ends at the deadline
+        if budget is not None and budget() <= 0:
+            logger.warning("CleanUp: Teardown deadline near, stopped export of lab %s", lab)
+            errors.append(f"13: Export stopped for {lab}, teardown deadline reached")
+            metrics.Increment('cml_teardown_exports_skipped_total')
+        else:
+            logger.error("CleanUp: Export of lab %s FAILED: %s", lab, e)
+            errors.append(f"04: DownloadLab failed for {lab}")
+    return errors
+
+def BootedNodes(snapshot, lab):
+    """
+    Ids of the nodes of a lab that were booted at the last poll. None if the
+    snapshot does not know the lab, nodes with unknown state are included.
+    """
+    if snapshot is None or lab not in snapshot['labs'] or snapshot['labs'][lab]['nodes'] is None:
+        return None
+    return [node for node, state in snapshot['labs'][lab]['nodes'].items() if state in ('BOOTED', None)]
+
+def _RecordTeardown(started, deadline):
+    # Teardown duration and deadline overrun metrics
+    finished = clock.Time()
+    metrics.Observe('cml_teardown_seconds', finished - started)
+    if finished > deadline:
+        logger.warning("CleanUp: Finished %.0f seconds after the deadline", finished - deadline)
+        metrics.Increment('cml_teardown_overruns_total')
+        metrics.Observe('cml_teardown_overrun_seconds', finished - deadline)
+
+def _Finished(teardown):
+    # Finished without errors, with the admin password restored and the users logged out
+    return teardown.finished and not teardown.errors and teardown.password_restored and teardown.users_logged_out
+
+def _ClaimTeardown(email, temp_password):
+    """
+    Get the persisted progress for this cleanup and mark it as running.
+
+    A finished cleanup (see _Finished) is returned without claiming it.
+    Returns None if the cleanup is running elsewhere (heartbeat newer than
+    CML_TEARDOWN_STALE_MINUTES).
+    """
+    from django.db.models import Q
+    from booking.models import Teardown
+
+    teardown, created = Teardown.objects.get_or_create(password=temp_password, defaults={'email': email})
+    if _Finished(teardown):
+        return teardown
+
+    now = clock.Now()
+    stale = now - timedelta(minutes=settings.CML_TEARDOWN_STALE_MINUTES)
+    claimed = Teardown.objects.filter(pk=teardown.pk).filter(Q(heartbeat__isnull=True) | Q(heartbeat__lt=stale)).update(heartbeat=now)
+    if not claimed:
+        logger.warning("CleanUp: Cleanup for %s is already running, skipping", email)
+        return None
+
+    if not created:
+        logger.info("CleanUp: Resuming cleanup for %s started %s", email, teardown.created)
+    return teardown
+
+def _Progress(obj, **fields):
+    # Persist teardown progress flags right away, and keep the heartbeat fresh
+    for name, value in fields.items():
+        setattr(obj, name, value)
+    obj.save(update_fields=list(fields) + ['modified'])
+    if 'heartbeat' not in fields:
+        teardown = getattr(obj, 'teardown', obj)
+        type(teardown).objects.filter(pk=teardown.pk).update(heartbeat=clock.Now())
+
+def CleanUp(email, temp_password, deadline=None):
     """
     Clean up labs when timeslot has reached the end
+
+    The cleanup works against a deadline (epoch seconds), normally the start
+    of the next timeslot. Defaults to CML_TEARDOWN_BUDGET_SECONDS from now.
+    The steps that free resources and restore credentials always run, in
+    this order: stop labs, restore the admin password, wipe and delete labs,
+    log out all users. Lab exports are best effort and only run as long as
+    the time left covers the estimated cost of those steps.
+
+    Progress is stored per booking and per lab (Teardown, TeardownLab), so
+    a retried or interrupted cleanup skips the steps that are already done.
+
+    Errors reaching CML (open circuit breaker, connection errors and
+    timeouts) end the attempt with error 14. The claim is released, so
+    ResumeTeardowns picks the cleanup up again once CML is back.
+
+    Returns the list of fatal errors, empty on success or if the cleanup
+    already finished. Returns None if the cleanup is running elsewhere, the
+    lab is then not cleaned up yet.
     """
+    started = clock.Time()
+    if deadline is None:
+        deadline = started + settings.CML_TEARDOWN_BUDGET_SECONDS
+
+    teardown = _ClaimTeardown(email, temp_password)
+    if teardown is None:
+        return None
+    if _Finished(teardown):
+        logger.info("CleanUp: Cleanup for %s already finished, nothing to do", email)
+        return []
+
+    error_trace = []
+    try:
+        return _CleanUp(email, temp_password, teardown, started, deadline, error_trace)
+    except (CircuitOpenError, requests.exceptions.RequestException) as e:
+        logger.error("CleanUp: CML not reachable, cleanup for %s interrupted: %s", email, e)
+        error_trace.append(f"14: CML not reachable: {e}")
+        alerts.Report('CleanUp', error_trace)
+        _Progress(teardown, errors='\n'.join(error_trace), heartbeat=None)
+        _RecordTeardown(started, deadline)
+        return error_trace
+
+def _CleanUp(email, temp_password, teardown, started, deadline, error_trace):
+    # The steps of CleanUp, errors are appended to error_trace as they happen
+    from booking.models import LabCheckpoint
+    from . import rollups
+
     # Authenticate and get all labs
-    logger.info(f"CleanUp: Starting cleanup")
+    logger.info("CleanUp: Starting cleanup, %.0f seconds until deadline", deadline - started)
 
     # Try to authenticate with the temporary password first.
     token, statuscode = GetToken(settings.CML_USERNAME, temp_password)
     used_pw = temp_password  # Track which password was effectively used.
 
-    # If temp login failed (e.g. temp was never set), fall back to the original admin password.
+    # If temp login failed (e.g. temp was never set, or already restored), fall back to the original admin password.
     if statuscode != 200 or not token:
         logger.warning("CleanUp: temp password login failed, retrying with original admin password")
         token, statuscode = GetToken(settings.CML_USERNAME, settings.CML_PASSWORD)
         used_pw = settings.CML_PASSWORD
 
-    error_trace = []
-
     # Authenticated
     if not statuscode == 200:
-        logger.error(f"CleanUp: GetToken FAILED! Not authenticated!")
+        logger.error("CleanUp: GetToken FAILED! Not authenticated!")
         error_trace.append("01: GetToken failed! Not authenticated!")
-        if (settings.SENDGRID_BCC_EMAIL):
-            SendEmail(settings.SENDGRID_BCC_EMAIL, 'Community Network - CleanUp failed!', f'CleanUp failed. Error reason: { error_trace }')
-        return
+        alerts.Report('CleanUp', error_trace)
+        _Progress(teardown, errors='\n'.join(error_trace), heartbeat=None)
+        _RecordTeardown(started, deadline)
+        return error_trace
     else:
+        # Logged in with the original password, the temporary one is not active
+        if used_pw != temp_password and not teardown.password_restored:
+            _Progress(teardown, password_restored=True)
+
         labs, statuscode = GetListOfAllLabs(token)
-        
-        # Loop through all labs, save config, stop and delete labs
-        userlabs = []
+        if statuscode != 200:
+            logger.error("CleanUp: GetListOfAllLabs FAILED!")
+            error_trace.append("12: GetListOfAllLabs failed!")
+            labs = []
+
+        # Recent poller state, used to only extract configs from booted nodes
+        snapshot = poller.Snapshot(max_age=2 * settings.CML_POLL_SECONDS) if settings.CML_POLL_SECONDS else None
+
+        # Progress per lab, labs deleted by an earlier attempt are no longer listed by CML
+        progress = {lab: teardown.labs.get_or_create(lab=lab)[0] for lab in labs}
+
+        def ExportBudget():
+            # Seconds left for exports after reserving time for the essential
+            # steps: stop, wipe and delete per lab plus password restore,
+            # re-authentication, logout and the teardown email
+            reserve = settings.CML_TEARDOWN_STEP_SECONDS * (3 * len(labs) + 4)
+            return deadline - clock.Time() - reserve
+
+        # 1) Best effort: export labs while there is time for it
         for lab in labs:
-            nodes, statuscode = GetNodesInLab(token, lab)
-            if statuscode != 200:
-                logger.warning(f"CleanUp: GetNodesInLab FAILED for {lab}, contiuneing without it.")
-                error_trace.append(f"02: GetNodesInLab FAILED for {lab}, contiuneing without it.")
-                nodes = []  # ensure downstream code doesn't crash if it loops nodes
+            if progress[lab].exported:
+                continue
+            if ExportBudget() <= 0:
+                logger.warning("CleanUp: Teardown deadline near, skipping export of lab %s", lab)
+                error_trace.append(f"13: Export skipped for {lab}, teardown deadline reached")
+                metrics.Increment('cml_teardown_exports_skipped_total')
+                continue
+            checkpoint = LabCheckpoint.objects.filter(password=temp_password, lab=lab).first()
+            # Every call of the export is capped to the budget left at that point
+            errors = _ExportLab(token, lab, None, checkpoint, BootedNodes(snapshot, lab), budget=ExportBudget)
+            error_trace.extend(errors)
+            if not any(e.startswith(("04:", "13:")) for e in errors):
+                _Progress(progress[lab], exported=True)
+
+        # 2) Free resources: stop all labs
+        ok_codes = (200, 202, 204)
+        for lab in labs:
+            if progress[lab].stopped:
+                continue
+            statuscode = StopLab(token, lab)
+            if statuscode not in ok_codes:
+                logger.error("CleanUp: StopLab FAILED for lab %s.", lab)
+                error_trace.append(f"05: StopLab failed for {lab}")
             else:
-                for node in nodes:
-                    # Note! Extract of config only works if node is running,
-                    #       so non-running nodes will not be part of lab export
-                    nodeconfig, statuscode = GetNodeConfig(token, lab,node)
-                    if statuscode != 200:
-                        # Do not treat this as a hard failure. We can still Stop/Wipe/Delete the lab.
-                        logger.warning(f"CleanUp: GetNodeConfig not available for {lab}, continuing without it.")
-                        nodes = []  # ensure downstream code doesn't crash if it loops nodes
-                    else:
-                        # proceed if you actually use 'nodes' later
-                        pass
-
-                # Append lab to list of labs
-                userlabs.append(lab)
-
-                # Download and save lab
-                downloadlab, statuscode = DownloadLab(token, lab)
-                if statuscode == 200:
-                    SaveLab(lab, downloadlab)
-                else:
-                    logger.error(f"CleanUp: DownloadLab FAILED for lab {lab}.")
-                    error_trace.append(f"04: DownloadLab failed for {lab}")
-                
-                # Stop, wipe and delete lab
-                ok_codes = (200, 202, 204)
-                statuscode = StopLab(token, lab)
-                if statuscode not in ok_codes:
-                    logger.error(f"CleanUp: StopLab FAILED for lab {lab}.")
-                    error_trace.append(f"05: StopLab failed for {lab}")
-
-                statuscode = WipeLab(token, lab)
-                if statuscode not in ok_codes:
-                    logger.error(f"CleanUp: WipeLab FAILED for lab {lab}.")
-                    error_trace.append(f"05: WipeLab failed for {lab}")
+                _Progress(progress[lab], stopped=True)
 
-                statuscode = DeleteLab(token, lab)
-                if statuscode not in ok_codes:
-                    logger.error(f"CleanUp: DeleteLab FAILED for lab {lab}.")
-                    error_trace.append(f"06: DeleteLab failed for {lab}")
-        
-        # Get admin id
-        adminid, statuscode = GetAdminId(token)
-        if not statuscode == 200:
-            error_trace.append("07: GetAdminId failed!")
-            logger.error(f"CleanUp: GetAdminId FAILED!")
-        else:
-            # Only attempt to restore if the temp password was actually active.
-            if used_pw == temp_password:
+        # 3) Restore credentials. Only attempt to restore if the temp password was actually active.
+        if used_pw == temp_password and not teardown.password_restored:
+            adminid, statuscode = GetAdminId(token)
+            if not statuscode == 200:
+                error_trace.append("07: GetAdminId failed!")
+                logger.error("CleanUp: GetAdminId FAILED!")
+            else:
                 statuscode = UpdateUserPassword(token, adminid, temp_password, settings.CML_PASSWORD)
                 if statuscode not in (200, 204):
                     error_trace.append("08: UpdateUserPassword failed!")
-                    logger.error(f"CleanUp: UpdateUserPassword FAILED! status={statuscode}")
+                    logger.error("CleanUp: UpdateUserPassword FAILED! status=%s", statuscode)
                 else:
-                    # Password restored OK → re-authenticate and log out all users (clear sessions)
+                    _Progress(teardown, password_restored=True)
+                    # Password restored OK → re-authenticate with the original password
                     token, statuscode = GetToken(settings.CML_USERNAME, settings.CML_PASSWORD)
                     if statuscode != 200:
                         error_trace.append("09: GetToken FAILED after changing password!")
                         logger.error("CleanUp: GetToken FAILED after changing password!")
-                    else:
-                        statuscode = LogAllUsersOut(token)
-                        if statuscode != 200:
-                            error_trace.append("10: LogAllUsersOut FAILED after changing password!")
-                            logger.error("CleanUp: LogAllUsersOut FAILED after changing password!")
+
+        # 4) Wipe and delete all labs
+        for lab in labs:
+            if not progress[lab].wiped:
+                statuscode = WipeLab(token, lab)
+                if statuscode not in ok_codes:
+                    logger.error("CleanUp: WipeLab FAILED for lab %s.", lab)
+                    error_trace.append(f"05: WipeLab failed for {lab}")
+                else:
+                    _Progress(progress[lab], wiped=True)
+
+            if progress[lab].deleted:
+                continue
+            statuscode = DeleteLab(token, lab)
+            if statuscode not in ok_codes:
+                logger.error("CleanUp: DeleteLab FAILED for lab %s.", lab)
+                error_trace.append(f"06: DeleteLab failed for {lab}")
+            else:
+                _Progress(progress[lab], deleted=True)
+                poller.Forget(lab)
+
+        # 5) Log out all users (clear sessions). This also ends our own session, so it runs last.
+        if teardown.password_restored and not teardown.users_logged_out and not any(e.startswith("09:") for e in error_trace):
+            statuscode = LogAllUsersOut(token)
+            if statuscode != 200:
+                error_trace.append("10: LogAllUsersOut FAILED after changing password!")
+                logger.error("CleanUp: LogAllUsersOut FAILED after changing password!")
+            else:
+                _Progress(teardown, users_logged_out=True)
+
+        _RecordTeardown(started, deadline)
+
         # --- ALWAYS send teardown email to the user (with any saved lab YAMLs) ---
+        # Includes labs exported by earlier attempts of this cleanup
+        userlabs = list(teardown.labs.filter(exported=True).values_list('lab', flat=True))
         labs_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'labs/')
         lab_files = []
-        if userlabs:
+        if userlabs and not teardown.email_sent:
             for lab in userlabs:
                 # YAML files are saved as <lab_id>.yaml
                 lab_path = os.path.join(labs_directory, f"{lab}.yaml")
                 if os.path.exists(lab_path):
                     lab_files.append(lab_path)
                 else:
-                    logger.warning(f"CleanUp: expected lab file missing: {lab_path}")
+                    logger.warning("CleanUp: expected lab file missing: %s", lab_path)
 
         # Brevo rejects .yaml attachments. Zip everything into one archive.
         zip_path = None
@@ -499,28 +807,31 @@ def CleanUp(email, temp_password):
                 zip_path = _zip_attachments(lab_files, zip_basename="cml_konfig")
                 attachments = [zip_path]  # send one .zip file
 
-            context = {
-                'cml_url': settings.CML_URL,
-                'booking_url': settings.BOOKING_URL,
-            }
-            body = render_to_string('booking/email_teardown.html', context)
-            ok = SendEmail(
-                email,
-                'Community Network - CML reservasjon er utløpt',
-                body,
-                attachments=attachments
-            )
-            if not ok:
-                error_trace.append("11: SendEmail FAILED after cleanup!")
-                logger.error("CleanUp: SendEmail FAILED after cleanup!")
+            if not teardown.email_sent:
+                context = {
+                    'cml_url': settings.CML_URL,
+                    'booking_url': settings.BOOKING_URL,
+                }
+                body = emails.Render('booking/email_teardown.html', context)
+                ok = SendEmail(
+                    email,
+                    'Community Network - CML reservasjon er utløpt',
+                    body,
+                    attachments=attachments
+                )
+                if not ok:
+                    error_trace.append("11: SendEmail FAILED after cleanup!")
+                    logger.error("CleanUp: SendEmail FAILED after cleanup!")
+                else:
+                    _Progress(teardown, email_sent=True)
         finally:
             # Always clean up the temp zip
             if zip_path and os.path.exists(zip_path):
                 try:
                     os.remove(zip_path)
-                    logger.info(f"CleanUp: removed temp zip: {zip_path}")
+                    logger.info("CleanUp: removed temp zip: %s", zip_path)
                 except Exception as e:
-                    logger.warning(f"CleanUp: failed removing temp zip {zip_path}: {e}")
+                    logger.warning("CleanUp: failed removing temp zip %s: %s", zip_path, e)
 
 #        attachments = []
 #        if userlabs:
@@ -542,53 +853,97 @@ def CleanUp(email, temp_password):
 
     # Only escalate truly fatal issues (ignore 03: GetNodeConfig warnings)
     fatal_errors = [e for e in error_trace if not e.startswith("03: GetNodeConfig")]
-    if fatal_errors and settings.SENDGRID_BCC_EMAIL:
-        SendEmail(
-            settings.SENDGRID_BCC_EMAIL,
-            'Community Network - CleanUp failed!',
-            f'CleanUp failed. Error reason: { fatal_errors }'
-        )
+    # A retry of the password restore or logout is not counted as another teardown
+    retried = teardown.finished is not None
+    _Progress(teardown, errors='\n'.join(fatal_errors) or None, finished=clock.Now(), heartbeat=None)
+    if not retried:
+        rollups.TeardownFinished(teardown)
+    alerts.Report('CleanUp', fatal_errors)
+    return fatal_errors
+
+def CheckpointLabs(email, temp_password):
+    """
+    Save a snapshot of the labs of an ongoing booking, so the teardown only
+    has to download labs that changed after the last checkpoint.
+
+    Logs in with the temporary password of the booking. Labs unchanged since
+    the previous checkpoint are not downloaded again.
+
+    Returns the list of errors, empty on success.
+    """
+    from booking.models import LabCheckpoint
+
+    error_trace = []
+    try:
+        token, statuscode = GetToken(settings.CML_USERNAME, temp_password)
+        if statuscode != 200 or not token:
+            logger.warning("CheckpointLabs: GetToken failed for the booking of %s, no checkpoint", email)
+            return ["01: GetToken failed! Not authenticated!"]
+
+        labs, statuscode = GetListOfAllLabs(token)
+        if statuscode != 200:
+            logger.error("CheckpointLabs: GetListOfAllLabs FAILED!")
+            return ["12: GetListOfAllLabs failed!"]
+
+        for lab in labs:
+            checkpoint, created = LabCheckpoint.objects.get_or_create(password=temp_password, lab=lab, defaults={'email': email})
+            error_trace.extend(_ExportLab(token, lab, None, checkpoint))
+    except (CircuitOpenError, requests.exceptions.RequestException) as e:
+        logger.warning("CheckpointLabs: CML not reachable, checkpoint for %s interrupted: %s", email, e)
+        error_trace.append(f"14: CML not reachable: {e}")
+        return error_trace
+    logger.info("CheckpointLabs: Checkpoint of %s labs for %s done, %s errors", len(labs), email, len(error_trace))
+    return error_trace
 
 def CreateTempUser(email, temp_password):
     """
     Create an temporary password and send the credentials via email
+
+    Errors reaching CML (open circuit breaker, connection errors and
+    timeouts) are reported as error 06, like the other failures.
+
+    Returns the list of errors, empty on success.
     """
-    logger.info(f"CreateTempUser: Creating user for {email}")
+    logger.info("CreateTempUser: Creating user for %s", email)
     error_trace = []
 
-    # Get token and update username
-    token, statuscode = GetToken(settings.CML_USERNAME, settings.CML_PASSWORD)
+    try:
+        # Get token and update username
+        token, statuscode = GetToken(settings.CML_USERNAME, settings.CML_PASSWORD)
     
-    if statuscode != 200 or not token:
-        logger.error(f"CreateTempUser: GetToken FAILED! Not authenticated!")
-        error_trace.append("01: GetToken failed! Not authenticated!")
-    else:
-        # Authentication OK! Lets get the Admin ID
-        adminid, statuscode = GetAdminId(token)
-        if not statuscode == 200:
-            logger.error(f"CreateTempUser: GetAdminId FAILED!")
-            error_trace.append("02: GetAdminId failed!")
+        if statuscode != 200 or not token:
+            logger.error("CreateTempUser: GetToken FAILED! Not authenticated!")
+            error_trace.append("01: GetToken failed! Not authenticated!")
         else:
-            statuscode = UpdateUserPassword(token, adminid, settings.CML_PASSWORD, temp_password)
+            # Authentication OK! Lets get the Admin ID
+            adminid, statuscode = GetAdminId(token)
             if not statuscode == 200:
-                logger.error(f"CreateTempUser: UpdateUserPassword FAILED!")
-                error_trace.append("03: UpdateUserPassword failed!")
+                logger.error("CreateTempUser: GetAdminId FAILED!")
+                error_trace.append("02: GetAdminId failed!")
             else:
-                # Send email to the user with the login information using template
-                context = {
-                    'username': settings.CML_USERNAME,
-                    'password': temp_password,
-                    'cml_url': settings.CML_URL,
-                    'booking_url': settings.BOOKING_URL,
-                }
-                body = render_to_string('booking/email_setup.html', context)
-
- #               statuscode = SendEmail(email, 'Community Network - CML påloggingsinformasjon', body)
- #               if not statuscode == 202:
-                ok = SendEmail(email, 'Community Network - CML påloggingsinformasjon', body)
-                if not ok:
-                    error_trace.append("04: SendEmail FAILED after creating user!")
-                    logger.error(f"CreateTempUser: SendEmail FAILED after creating user!")
+                statuscode = UpdateUserPassword(token, adminid, settings.CML_PASSWORD, temp_password)
+                if not statuscode == 200:
+                    logger.error("CreateTempUser: UpdateUserPassword FAILED!")
+                    error_trace.append("03: UpdateUserPassword failed!")
+                else:
+                    # Send email to the user with the login information using template
+                    context = {
+                        'username': settings.CML_USERNAME,
+                        'password': temp_password,
+                        'cml_url': settings.CML_URL,
+                        'booking_url': settings.BOOKING_URL,
+                    }
+                    body = emails.Render('booking/email_setup.html', context)
+
+     #               statuscode = SendEmail(email, 'Community Network - CML påloggingsinformasjon', body)
+     #               if not statuscode == 202:
+                    ok = SendEmail(email, 'Community Network - CML påloggingsinformasjon', body)
+                    if not ok:
+                        error_trace.append("04: SendEmail FAILED after creating user!")
+                        logger.error("CreateTempUser: SendEmail FAILED after creating user!")
+    except (CircuitOpenError, requests.exceptions.RequestException) as e:
+        logger.error("CreateTempUser: CML not reachable: %s", e)
+        error_trace.append(f"06: CML not reachable: {e}")
     
     if error_trace:
         # Send email to the user informing that something failed...
@@ -596,15 +951,16 @@ def CreateTempUser(email, temp_password):
             'cml_url': settings.CML_URL,
             'booking_url': settings.BOOKING_URL
         }
-        body = render_to_string('booking/email_error.html', context)
+        body = emails.Render('booking/email_error.html', context)
 
         #statuscode = SendEmail(email, 'Community Network - CML - Noe gikk galt...', body)
         #if not statuscode == 202:
         ok2 = SendEmail(email, 'Community Network - CML - Noe gikk galt...', body)
         if not ok2:
             error_trace.append("05: SendEmail FAILED when sending error email to user!")
-            logger.error(f"CreateTempUser: SendEmail FAILED when sending error email to user!")
+            logger.error("CreateTempUser: SendEmail FAILED when sending error email to user!")
+
+        # Lets drop the admin an alert as well
+        alerts.Report('CreateTempUser', error_trace)
 
-        # Lets drop the admin an email as well
-        if (settings.SENDGRID_BCC_EMAIL):
-            SendEmail(settings.SENDGRID_BCC_EMAIL, 'Community Network - CreateTempUser failed!', f'CreateTempUser failed. Error reason: { error_trace }')
+    return error_trace
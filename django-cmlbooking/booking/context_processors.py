@@ -0,0 +1,23 @@
+import functools
+
+from django.contrib.staticfiles import finders
+
+# Assets downloaded by the vendorstatic command
+VENDORED_ASSETS = [
+    'booking/vendor/bootstrap.min.css',
+    'booking/vendor/jquery.slim.min.js',
+    'booking/vendor/bootstrap.bundle.min.js',
+    'booking/vendor/favicon.png',
+]
+
+@functools.lru_cache(maxsize=None)
+def VendoredAssets():
+    # True if all vendored assets exist, checked once per process
+    return all(finders.find(path) for path in VENDORED_ASSETS)
+
+def Assets(request):
+    """
+    Serve CSS, JavaScript and favicon from our own static files when they
+    have been vendored, else from the CDNs
+    """
+    return {'vendored_assets': VendoredAssets()}
\ No newline at end of file
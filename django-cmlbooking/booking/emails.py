@@ -0,0 +1,92 @@
+"""
+Pre-compiled email bodies.
+
+The email templates only insert plain variables into a large static layout
+(email_base.html). Each template is rendered once with a sentinel in place
+of every variable and split on the sentinels. Sending an email then only
+joins the static parts with the escaped values, the same way the template
+engine renders a variable.
+
+Templates using filters or tags other than extends/block fall back to
+render_to_string. With DEBUG, templates are not cached so edits show up.
+"""
+import re
+import threading
+from django.conf import settings
+from django.template import Context
+from django.template.base import TextNode, VariableNode, render_value_in_context
+from django.template.loader import get_template, render_to_string
+from django.template.loader_tags import BlockNode, ExtendsNode
+import logging
+logger = logging.getLogger(__name__)
+
+SENTINEL = '\x00{}\x00'
+SENTINEL_SPLIT = re.compile('\x00([A-Za-z_][A-Za-z0-9_]*)\x00')
+
+_lock = threading.Lock()
+_compiled = {}
+
+def _Variables(template):
+    """
+    Names of all variables used by a template and the templates it extends.
+    Returns None if the template uses anything but plain variables.
+    """
+    names = set()
+    nodes = list(template.nodelist)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, VariableNode):
+            if node.filter_expression.filters or not isinstance(node.filter_expression.var.var, str):
+                return None
+            names.add(node.filter_expression.var.var)
+        elif isinstance(node, ExtendsNode):
+            # Only a fixed parent template name, not a variable
+            parent = node.parent_name.var
+            if node.parent_name.filters or not isinstance(parent, str):
+                return None
+            nodes.extend(get_template(parent).template.nodelist)
+            nodes.extend(node.nodelist)
+        elif isinstance(node, BlockNode):
+            nodes.extend(node.nodelist)
+        elif not isinstance(node, TextNode):
+            return None
+    return names
+
+def Compile(template_name):
+    """
+    Render the template once with sentinels. Returns the list of parts,
+    alternating static text and variable names, or None if the template
+    cannot be pre-compiled.
+    """
+    template = get_template(template_name)
+    names = _Variables(template.template)
+    if names is None or any('.' in name for name in names):
+        logger.info("Compile: %s can not be pre-compiled, rendering it every time", template_name)
+        return None
+    rendered = template.render({name: SENTINEL.format(name) for name in names})
+    return SENTINEL_SPLIT.split(rendered)
+
+def Render(template_name, context):
+    """
+    Render an email template, drop-in replacement for render_to_string
+    """
+    if settings.DEBUG:
+        return render_to_string(template_name, context)
+
+    if template_name not in _compiled:
+        with _lock:
+            if template_name not in _compiled:
+                _compiled[template_name] = Compile(template_name)
+    parts = _compiled[template_name]
+    if parts is None:
+        return render_to_string(template_name, context)
+
+    # Same conversion and escaping as the template engine
+    render_context = Context(autoescape=True)
+    out = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            out.append(part)
+        else:
+            out.append(render_value_in_context(context.get(part, ''), render_context))
+    return ''.join(out)
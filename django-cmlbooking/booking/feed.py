@@ -0,0 +1,112 @@
+"""
+iCalendar feed with the bookings of one user and the upcoming maintenance.
+
+Calendar clients poll the feed often. The view answers those polls with a
+304 based on State(), which costs one aggregate query per table.
+"""
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from booking.models import Booking, Maintenance
+from .maintenance import MaintenanceIndex
+from . import clock
+from . import tokens
+import logging
+logger = logging.getLogger(__name__)
+
+# Bookings from the last days are kept in the feed, maintenance is
+# included for the coming days
+HISTORY_DAYS = 30
+MAINTENANCE_DAYS = 60
+
+def Bookings(email):
+    since = clock.Now() - timedelta(days=HISTORY_DAYS)
+    return Booking.objects.filter(email__iexact=email, timeslot__gte=since)
+
+def State(email):
+    """
+    (ETag, Last-Modified) of the feed. Deleted rows do not change the
+    latest modified timestamp, so the ETag includes the row counts. The
+    date is included as the maintenance window moves every day.
+    """
+    bookings = Bookings(email).aggregate(latest=Max('modified'), count=Count('id'))
+    maintenance = Maintenance.objects.aggregate(latest=Max('modified'), count=Count('id'))
+    latest = max(filter(None, [bookings['latest'], maintenance['latest']]), default=None)
+    key = f"{email}|{bookings['count']}|{maintenance['count']}|{latest and latest.isoformat()}|{clock.Today()}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32], latest
+
+def _Escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _Time(value):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def _Fold(line):
+    # Lines longer than 75 octets are folded, continuation lines start with a space
+    data = line.encode()
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74
+        # Do not split a multi-byte character
+        while cut and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode())
+        data = data[cut:]
+    parts.append(data.decode())
+    return '\r\n '.join(parts)
+
+def _Event(uid, start, end, summary, description='', url=''):
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{_Time(clock.Now())}',
+        f'DTSTART:{_Time(start)}',
+        f'DTEND:{_Time(end)}',
+        f'SUMMARY:{_Escape(summary)}',
+    ]
+    if description:
+        lines.append(f'DESCRIPTION:{_Escape(description)}')
+    if url:
+        lines.append(f'URL:{url}')
+    lines.append('END:VEVENT')
+    return lines
+
+def Calendar(email):
+    """
+    The feed as text/calendar content
+    """
+    domain = settings.BOOKING_URL.split('//')[-1].strip('/').split('/')[0] or 'cml-booking'
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Community Network//CML booking//NO',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        'X-WR-CALNAME:CML-reservasjoner',
+        f'X-PUBLISHED-TTL:PT{settings.BOOKING_FEED_TTL_MINUTES}M',
+    ]
+
+    for booking in Bookings(email).order_by('timeslot'):
+        cancel_url = f'{settings.BOOKING_URL}cancel/{tokens.MakeCancelToken(booking)}/'
+        lines += _Event(
+            f'booking-{booking.pk}@{domain}',
+            booking.timeslot, booking.timeslot + timedelta(hours=3),
+            'CML-reservasjon',
+            f'Påloggingsinformasjon sendes på e-post når reservasjonen starter.\nCML: {settings.CML_URL}\nKanseller: {cancel_url}',
+            settings.CML_URL,
+        )
+
+    now = clock.Now()
+    maintenance = MaintenanceIndex(now, now + timedelta(days=MAINTENANCE_DAYS))
+    for start, end, window in maintenance.occurrences:
+        lines += _Event(
+            f'maintenance-{window.pk}-{_Time(start)}@{domain}',
+            start, end,
+            'CML-vedlikehold',
+            window.reason,
+        )
+
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_Fold(line) for line in lines) + '\r\n'
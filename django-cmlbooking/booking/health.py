@@ -0,0 +1,128 @@
+"""
+Cached health status for the /healthz and /readyz endpoints.
+
+The checks (database, scheduler, CML) run in a background thread at most
+every HEALTH_CHECK_SECONDS. Requests only read the cached result, so the
+endpoints never run queries or call CML themselves. The result is only
+reported as not ready when a refresh has been running for longer than
+HEALTH_CHECK_TIMEOUT, not because probes are far apart.
+"""
+import threading
+import time
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED
+from django.conf import settings
+from django.db import connection
+from . import poller
+from .breaker import cml_breaker
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_status = None
+# Start of the running refresh, None when no refresh is running
+_refresh_started = None
+
+# Last run of each scheduler job in this process, fed by JobListener
+_jobs = {}
+
+# Scheduler events passed to JobListener
+JOB_EVENTS = EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED
+
+def JobListener(event):
+    """
+    APScheduler listener recording the outcome of each job run
+    """
+    if event.code == EVENT_JOB_MISSED:
+        outcome = 'missed'
+    elif event.exception:
+        outcome = 'error'
+    else:
+        outcome = 'ok'
+    _jobs[event.job_id] = {'status': outcome, 'time': time.time()}
+
+def _CheckDatabase():
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        return {'ok': True}
+    except Exception as e:
+        logger.error("Health: Database check failed: %s", e)
+        return {'ok': False, 'error': str(e)}
+
+def _CheckScheduler():
+    from .scheduler import scheduler
+    status = {'leader': scheduler.running}
+    if scheduler.running:
+        status['jobs'] = dict(_jobs)
+        status['ok'] = not any(job['status'] == 'error' for job in _jobs.values())
+        return status
+
+    # Another process runs the scheduler, use the execution log it writes
+    try:
+        from django_apscheduler.models import DjangoJobExecution
+        last = DjangoJobExecution.objects.order_by('-run_time').values('job_id', 'status', 'run_time').first()
+    except Exception as e:
+        return dict(status, ok=False, error=str(e))
+    if last is None:
+        return dict(status, ok=None)
+    stale = time.time() - last['run_time'].timestamp() > settings.HEALTH_SCHEDULER_STALE_SECONDS
+    status['last_job'] = {'id': last['job_id'], 'status': last['status'], 'time': last['run_time'].isoformat()}
+    status['ok'] = not stale and last['status'] != DjangoJobExecution.ERROR
+    return status
+
+def _CheckCml():
+    snapshot = poller.Snapshot()
+    status = {'breaker_open': cml_breaker.is_open, 'poll_ok': snapshot['ok'], 'polled': snapshot['updated']}
+    if snapshot['error']:
+        status['error'] = snapshot['error']
+    status['ok'] = not cml_breaker.is_open and snapshot['ok'] is not False
+    return status
+
+def _Refresh():
+    global _status, _refresh_started
+    try:
+        status = {
+            'database': _CheckDatabase(),
+            'scheduler': _CheckScheduler(),
+            'cml': _CheckCml(),
+            'checked': time.time(),
+        }
+        # Only the database is required to serve bookings, the others degrade
+        status['ready'] = status['database']['ok']
+        status['degraded'] = not (status['scheduler']['ok'] is not False and status['cml']['ok'])
+        _status = status
+    except Exception as e:
+        logger.exception("Health: Check failed: %s", e)
+    finally:
+        # The thread ends here, do not leave its connection open
+        connection.close()
+        _refresh_started = None
+
+def Status():
+    """
+    Return the cached health status and start a background refresh if it is
+    older than HEALTH_CHECK_SECONDS. Only the very first call waits for the
+    checks to run. While a refresh runs the previous result is returned,
+    as not ready once the refresh has taken longer than
+    HEALTH_CHECK_TIMEOUT (e.g. a hanging database).
+    """
+    global _refresh_started
+    status = _status
+    now = time.time()
+    if status is not None and now - status['checked'] < settings.HEALTH_CHECK_SECONDS:
+        return status
+
+    with _lock:
+        started = _refresh_started
+        if started is None:
+            _refresh_started = now
+    if started is None:
+        worker = threading.Thread(target=_Refresh, name='health-check', daemon=True)
+        worker.start()
+        if status is None:
+            worker.join(settings.HEALTH_CHECK_TIMEOUT)
+            status = _status
+    elif status is not None and now - started > settings.HEALTH_CHECK_TIMEOUT:
+        status = dict(status, ready=False, error=f'Health check has not completed for {now - started:.0f} seconds')
+    return status
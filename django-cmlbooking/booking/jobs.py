@@ -0,0 +1,140 @@
+"""
+Background execution of CML operations started from web requests.
+
+Each operation is stored as a CmlJob row before it is handed to an
+in-process thread pool, so the request can return right away and the user
+can poll the job status. A running job refreshes its heartbeat; queued jobs
+that never ran, and running jobs whose heartbeat stopped with a dead
+process, are picked up again by ResumeJobs.
+
+Lab cleanups keep their own progress in Teardown rows; cleanups that were
+interrupted are finished by ResumeTeardowns.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from booking.models import Booking, CmlJob, Teardown
+from . import clock
+import logging
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.CML_JOB_WORKERS, thread_name_prefix='cmljob')
+
+def SubmitJob(kind, email, password, booking=None):
+    """
+    Store a new job and run it in the background once the surrounding
+    transaction has been committed. Returns the CmlJob.
+    """
+    job = CmlJob.objects.create(kind=kind, email=email, password=password, booking=booking)
+    logger.info("SubmitJob: %s job %s queued for %s", kind, job.reference, email)
+    transaction.on_commit(lambda: _executor.submit(RunJob, job.id))
+    return job
+
+def _Heartbeat(job_id, stop):
+    """
+    Refresh the heartbeat of a running job until stop is set
+    """
+    interval = settings.CML_JOB_STALE_MINUTES * 60 / 3
+    try:
+        while not stop.wait(interval):
+            CmlJob.objects.filter(id=job_id, status=CmlJob.RUNNING).update(heartbeat=clock.Now())
+    finally:
+        connection.close()
+
+def RunJob(job_id):
+    """
+    Claim and run a queued job. Does nothing if another thread or process
+    already claimed it.
+    """
+    close_old_connections()
+    try:
+        now = clock.Now()
+        claimed = CmlJob.objects.filter(id=job_id, status=CmlJob.QUEUED).update(status=CmlJob.RUNNING, started=now, heartbeat=now)
+        if not claimed:
+            return
+
+        job = CmlJob.objects.get(id=job_id)
+        logger.info("RunJob: Running %s job %s for %s", job.kind, job.reference, job.email)
+
+        stop = threading.Event()
+        threading.Thread(target=_Heartbeat, args=(job.id, stop), name=f'cmljob-heartbeat-{job.id}', daemon=True).start()
+        from . import cml
+        try:
+            if job.kind == CmlJob.SETUP:
+                error_trace = cml.CreateTempUser(job.email, job.password)
+            else:
+                error_trace = cml.CleanUp(job.email, job.password)
+                if error_trace is None:
+                    # Running elsewhere, the job is queued again and finished by ResumeJobs once the cleanup is done
+                    logger.info("RunJob: Cleanup for %s is running elsewhere, job %s queued again", job.email, job.reference)
+                    CmlJob.objects.filter(id=job.id).update(status=CmlJob.QUEUED, heartbeat=None, modified=clock.Now())
+                    return
+                # The slot is kept booked until the lab is cleaned up
+                if job.booking_id:
+                    job.booking.delete()
+        except Exception as e:
+            logger.exception("RunJob: %s job %s crashed: %s", job.kind, job.reference, e)
+            error_trace = [f"{type(e).__name__}: {e}"]
+        finally:
+            stop.set()
+
+        job.status = CmlJob.FAILED if error_trace else CmlJob.DONE
+        job.error = '\n'.join(error_trace) if error_trace else None
+        job.finished = clock.Now()
+        # Only the result is written, as the claim, the instance still refers to the booking deleted above
+        CmlJob.objects.filter(id=job.id).update(status=job.status, error=job.error, finished=job.finished, modified=job.finished)
+        logger.info("RunJob: %s job %s finished with status %s", job.kind, job.reference, job.status)
+    finally:
+        close_old_connections()
+
+def ResumeJobs():
+    """
+    Re-queue running jobs without a heartbeat for CML_JOB_STALE_MINUTES
+    (the process running them died) and submit all queued jobs.
+    """
+    stale = clock.Now() - timedelta(minutes=settings.CML_JOB_STALE_MINUTES)
+    # Jobs started before the heartbeat was added only have modified
+    running = CmlJob.objects.filter(status=CmlJob.RUNNING).filter(Q(heartbeat__lt=stale) | Q(heartbeat__isnull=True, modified__lt=stale))
+    requeued = running.update(status=CmlJob.QUEUED)
+    if requeued:
+        logger.warning("ResumeJobs: %s stale running jobs re-queued", requeued)
+
+    for job_id in CmlJob.objects.filter(status=CmlJob.QUEUED).values_list('id', flat=True):
+        _executor.submit(RunJob, job_id)
+
+def ResumeTeardowns():
+    """
+    Finish lab cleanups that were interrupted (no heartbeat for
+    CML_TEARDOWN_STALE_MINUTES), and retry finished cleanups that did not
+    restore the admin password or log out the users. Steps that already
+    succeeded are skipped by cml.CleanUp. Cleanups older than a day are left
+    alone, and nothing is resumed while the next booking is active, as CML
+    then belongs to that user, or while the CML circuit breaker is open.
+    A failing cleanup does not hold up the others.
+    """
+    from .breaker import cml_breaker
+    if cml_breaker.is_open:
+        logger.info("ResumeTeardowns: CML circuit breaker is open, not resuming cleanups")
+        return
+
+    now = clock.Now()
+    stale = now - timedelta(minutes=settings.CML_TEARDOWN_STALE_MINUTES)
+    unfinished = Q(finished__isnull=True) | Q(password_restored=False) | Q(users_logged_out=False)
+    pending = Teardown.objects.filter(unfinished, created__gte=now - timedelta(days=1), modified__lt=stale).exclude(heartbeat__gte=stale)
+    if not pending.exists():
+        return
+
+    from . import cml
+    active = Booking.objects.filter(timeslot__gt=now - timedelta(hours=3), timeslot__lte=now)
+    for teardown in pending:
+        if active.exclude(password=teardown.password).exists():
+            logger.info("ResumeTeardowns: Another booking is active, not resuming cleanup for %s", teardown.email)
+            return
+        logger.warning("ResumeTeardowns: Resuming %s cleanup for %s", 'failed' if teardown.finished else 'interrupted', teardown.email)
+        try:
+            cml.CleanUp(teardown.email, teardown.password)
+        except Exception as e:
+            logger.exception("ResumeTeardowns: Cleanup for %s crashed: %s", teardown.email, e)
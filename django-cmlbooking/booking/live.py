@@ -0,0 +1,200 @@
+"""
+Live calendar updates over server-sent events.
+
+One Broadcaster per event loop computes the slot grid and fans changes out
+to all connected browsers, so the number of open streams does not add any
+database work. The grid is recomputed when:
+  - a Booking or Maintenance is saved or deleted in this process (signals
+    set a dirty flag on every broadcaster),
+  - a slot passes a cutoff (the hour changes, or half past the hour),
+  - every LIVE_REFRESH_SECONDS, to pick up changes made by other processes.
+
+Only slots whose status changed are sent. A 'reload' event is sent when the
+day changes, as the calendar then starts on another day.
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from booking.models import Booking, Maintenance
+from . import clock
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('live_streams', 'Open live calendar streams')
+metrics.Describe('live_grid_updates_total', 'Live calendar grid recomputations by reason')
+
+# Broadcaster per running event loop
+_broadcasters = {}
+
+def CalendarGrid():
+    """
+    Current status of all slots in the calendar, e.g. {'0-9': 'booked'},
+    keyed by day id and slot hour as in the booking URLs
+    """
+    from .views import GetCalendarData
+    grid = {}
+    for dayid, data in GetCalendarData().items():
+        for slot, status in data['bookingdata'].items():
+            grid[f'{dayid}-{slot}'] = status
+    return grid
+
+def _NextCutoff(now):
+    # Slots open and close on the hour and at half past
+    minute = 30 if now.minute < 30 else 60
+    return (now.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=minute) - now).total_seconds() + 1
+
+class Broadcaster:
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscribers = set()
+        self.grid = None
+        self.day = None
+        self.dirty = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.task = None
+
+    def MarkDirty(self):
+        # Called from any thread
+        self.loop.call_soon_threadsafe(self.dirty.set)
+
+    def Subscribe(self):
+        queue = asyncio.Queue(maxsize=settings.LIVE_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        metrics.SetGauge('live_streams', sum(len(b.subscribers) for b in _broadcasters.values()))
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self._Run())
+        return queue
+
+    def Unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        metrics.SetGauge('live_streams', sum(len(b.subscribers) for b in _broadcasters.values()))
+
+    def _Publish(self, event, data):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # Client is not keeping up, let it reload the page instead
+                self.subscribers.discard(queue)
+                logger.info("Broadcaster: Dropped a slow live stream")
+
+    async def _Grid(self):
+        # The current grid, None if it could not be computed
+        try:
+            return await sync_to_async(CalendarGrid)()
+        except Exception as e:
+            logger.exception("Broadcaster: Could not compute calendar: %s", e)
+            return None
+
+    async def _Run(self):
+        """
+        Recompute the grid when needed and publish the changes. Stops when
+        the last subscriber is gone, the next subscriber starts a new task
+        and waits for the grid it computes.
+        """
+        try:
+            # The first grid is retried until it can be computed
+            while self.subscribers:
+                self.grid = await self._Grid()
+                if self.grid is not None:
+                    break
+                await asyncio.sleep(settings.LIVE_RETRY_MS / 1000)
+            self.day = clock.Today()
+            self.ready.set()
+            while self.subscribers:
+                timeout = min(settings.LIVE_REFRESH_SECONDS, _NextCutoff(clock.LocalNow()))
+                try:
+                    await asyncio.wait_for(self.dirty.wait(), timeout)
+                    reason = 'change'
+                except asyncio.TimeoutError:
+                    reason = 'tick'
+                self.dirty.clear()
+
+                grid = await self._Grid()
+                if grid is None:
+                    continue
+
+                if clock.Today() != self.day:
+                    self.day = clock.Today()
+                    self.grid = grid
+                    self._Publish('reload', {})
+                    continue
+
+                metrics.Increment('live_grid_updates_total', reason=reason)
+                changed = {slot: status for slot, status in grid.items() if self.grid.get(slot) != status}
+                self.grid = grid
+                if changed:
+                    logger.debug("Broadcaster: %s slots changed", len(changed))
+                    self._Publish('slots', changed)
+        finally:
+            # Cleared in the same step the task ends in, before Subscribe can run
+            self.ready.clear()
+            self.grid = None
+
+def GetBroadcaster():
+    loop = asyncio.get_running_loop()
+    for known in [l for l in _broadcasters if l.is_closed()]:
+        del _broadcasters[known]
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = Broadcaster(loop)
+    return broadcaster
+
+def _Event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+async def Stream():
+    """
+    Async iterator with the server-sent events for one browser. Starts with
+    the full grid, so changes made after the page was rendered are applied,
+    then only sends changes. Ends after LIVE_MAX_SECONDS, also when no grid
+    could be computed by then, the browser then reconnects by itself.
+    """
+    broadcaster = GetBroadcaster()
+    queue = broadcaster.Subscribe()
+    closing = time.monotonic() + settings.LIVE_MAX_SECONDS
+    try:
+        # All streams share the grid computed by the broadcaster
+        try:
+            await asyncio.wait_for(broadcaster.ready.wait(), settings.LIVE_MAX_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Stream: No calendar grid after %s seconds, closing stream", settings.LIVE_MAX_SECONDS)
+            return
+        grid = broadcaster.grid
+        yield f'retry: {settings.LIVE_RETRY_MS}\n\n'
+        yield _Event('slots', grid)
+
+        while time.monotonic() < closing:
+            if queue not in broadcaster.subscribers and queue.empty():
+                # Dropped for being too slow
+                yield _Event('reload', {})
+                break
+            try:
+                event, data = await asyncio.wait_for(queue.get(), settings.LIVE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Comment line, keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+                continue
+            yield _Event(event, data)
+            if event == 'reload':
+                break
+    finally:
+        broadcaster.Unsubscribe(queue)
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+@receiver(post_save, sender=Maintenance)
+@receiver(post_delete, sender=Maintenance)
+def CalendarChanged(sender, **kwargs):
+    # Wake up the running broadcasters, the grid is recomputed once per
+    # change. Also without subscribers, a client reconnecting before the
+    # task stopped gets the grid of that task.
+    for broadcaster in list(_broadcasters.values()):
+        if broadcaster.task and not broadcaster.task.done() and not broadcaster.loop.is_closed():
+            broadcaster.MarkDirty()
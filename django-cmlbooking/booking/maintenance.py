@@ -0,0 +1,94 @@
+"""
+Maintenance windows as a sorted interval index.
+
+Recurring windows are expanded for the requested date range only, in local
+wall time so a window at 06:00 stays at 06:00 across daylight saving time.
+Overlapping windows are merged, so checking a point in time is a binary
+search over the interval starts.
+"""
+from bisect import bisect_right
+from datetime import timedelta
+from itertools import count
+from django.db.models import Q
+from django.utils import timezone
+from booking.models import Maintenance
+import logging
+logger = logging.getLogger(__name__)
+
+PERIOD_DAYS = {Maintenance.DAILY: 1, Maintenance.WEEKLY: 7}
+
+def Occurrences(maintenance, range_start, range_end):
+    """
+    (start, end) of every occurrence of the maintenance overlapping the range
+    """
+    days = PERIOD_DAYS.get(maintenance.recurrence)
+    if not days:
+        if maintenance.start <= range_end and maintenance.end >= range_start:
+            yield maintenance.start, maintenance.end
+        return
+
+    start = timezone.localtime(maintenance.start).replace(tzinfo=None)
+    duration = maintenance.end - maintenance.start
+    # Skip the occurrences that ended before the range
+    first = max(0, (timezone.localtime(range_start).date() - (start + duration).date()).days // days)
+    for k in count(first):
+        occurrence = start + timedelta(days=k * days)
+        if maintenance.repeat_until and occurrence.date() > maintenance.repeat_until:
+            return
+        occurrence = timezone.make_aware(occurrence)
+        if occurrence > range_end:
+            return
+        if occurrence + duration >= range_start:
+            yield occurrence, occurrence + duration
+
+class MaintenanceIndex:
+    """
+    All maintenance between range_start and range_end, loaded with a single
+    query
+    """
+    def __init__(self, range_start, range_end):
+        self.range_start = range_start.astimezone()
+        self.range_end = range_end.astimezone()
+
+        rows = Maintenance.objects.filter(start__lte=self.range_end).filter(
+            Q(end__gte=self.range_start) |
+            (~Q(recurrence=Maintenance.NONE) & (Q(repeat_until__isnull=True) | Q(repeat_until__gte=timezone.localtime(self.range_start).date())))
+        ).order_by('start')
+
+        self.occurrences = []
+        for maintenance in rows:
+            for start, end in Occurrences(maintenance, self.range_start, self.range_end):
+                self.occurrences.append((start, end, maintenance))
+        self.occurrences.sort(key=lambda o: o[0])
+
+        # Merge overlapping windows
+        self.starts = []
+        self.ends = []
+        for start, end, _ in self.occurrences:
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def Blocked(self, date):
+        """
+        True if the point in time is within a maintenance window
+        """
+        date = date.astimezone()
+        if not self.range_start <= date <= self.range_end:
+            logger.warning("Blocked: %s is outside the index range, loading it on its own", date)
+            return MaintenanceIndex(date, date).Blocked(date)
+        i = bisect_right(self.starts, date) - 1
+        return i >= 0 and date <= self.ends[i]
+
+    def Messages(self, start, end):
+        """
+        Reasons of the maintenance starting between start and end, once per
+        reason
+        """
+        messages = []
+        for occurrence, _, maintenance in self.occurrences:
+            if start <= occurrence <= end and maintenance.reason not in messages:
+                messages.append(maintenance.reason)
+        return messages
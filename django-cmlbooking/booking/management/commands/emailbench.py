@@ -0,0 +1,52 @@
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+from booking import emails
+
+# Context of each email template, as used by the views and cml.py
+CONTEXTS = {
+    'booking/email_info.html': {
+        'booking_date': date(2025, 1, 1),
+        'timeslot_from': '09',
+        'timeslot_to': '12',
+        'cancelcode': 'WzEsMTc1NTAwMDAwMF0:1ulZ2x:cancel-token',
+        'feed_token': 'InVzZXJAZXhhbXBsZS5jb20i:feed-token',
+    },
+    'booking/email_verification.html': {'verificationcode': 'InVzZXJAZXhhbXBsZS5jb20i:1ulZ2x:token'},
+    'booking/email_setup.html': {'username': 'admin', 'password': '0123456789abcdef0123456789abcdef'},
+    'booking/email_teardown.html': {},
+    'booking/email_error.html': {},
+}
+
+class Command(BaseCommand):
+    help = 'Benchmark email rendering: render_to_string against the pre-compiled bodies in booking/emails.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=2000, help='Renders per template and method (default 2000)')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        # The pre-compiled bodies are bypassed with DEBUG
+        settings.DEBUG = False
+
+        self.stdout.write(f"{'template':<34} {'render_to_string/s':>19} {'precompiled/s':>14} {'speedup':>8}")
+        for name, context in CONTEXTS.items():
+            context = dict(context, cml_url=settings.CML_URL, booking_url=settings.BOOKING_URL)
+            if emails.Render(name, context) != render_to_string(name, context):
+                self.stderr.write(self.style.ERROR(f'{name}: pre-compiled body differs from render_to_string'))
+
+            started = time.perf_counter()
+            for i in range(count):
+                render_to_string(name, context)
+            before = count / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for i in range(count):
+                emails.Render(name, context)
+            after = count / (time.perf_counter() - started)
+
+            self.stdout.write(f'{name:<34} {before:19.0f} {after:14.0f} {after / before:7.1f}x')
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Python snippet run in a fresh interpreter. It does what a new web worker
+# does before serving its first request: set up Django and load the URLconf
+# (which imports all views).
+WORKER_STARTUP = '''
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+'''
+
+class Command(BaseCommand):
+    help = 'Profile import time of a cold worker start and report the cost per module'
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', help='Extra modules to import after worker startup, e.g. booking.cml')
+        parser.add_argument('--top', type=int, default=25, help='Number of modules to list (default 25)')
+        parser.add_argument('--sort', choices=['cumulative', 'self'], default='cumulative', help='Sort modules by cumulative or self time')
+        parser.add_argument('--budget', type=float, default=None, help='Fail if total import time exceeds this many milliseconds')
+        parser.add_argument('--with-scheduler', action='store_true', help='Also start APScheduler like a web worker would')
+
+    def handle(self, *args, **options):
+        code = WORKER_STARTUP + ''.join(f'import {module}\n' for module in options['modules'])
+
+        env = os.environ.copy()
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'cmlbooking.settings')
+        if not options['with_scheduler']:
+            env['SCHEDULER_AUTOSTART'] = 'False'
+
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True, text=True)
+        wall = (time.perf_counter() - started) * 1000
+
+        if proc.returncode != 0:
+            raise CommandError(f'Worker startup failed:\n{proc.stderr[-2000:]}')
+
+        modules = []
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|', 2)
+            modules.append((name.rstrip(), int(own), int(cumulative)))
+
+        total = sum(own for _, own, _ in modules) / 1000
+        key = 2 if options['sort'] == 'cumulative' else 1
+        ranked = sorted(modules, key=lambda m: m[key], reverse=True)[:options['top']]
+
+        self.stdout.write(f"{'self [ms]':>10} {'cumul [ms]':>11}  module")
+        for name, own, cumulative in ranked:
+            self.stdout.write(f'{own / 1000:10.1f} {cumulative / 1000:11.1f}  {name}')
+
+        self.stdout.write('')
+        self.stdout.write(f'Modules imported: {len(modules)}')
+        self.stdout.write(f'Total import time: {total:.1f} ms')
+        self.stdout.write(f'Interpreter wall time: {wall:.1f} ms')
+
+        if options['budget'] is not None:
+            if total > options['budget']:
+                raise CommandError(f"Import time {total:.1f} ms exceeds budget of {options['budget']:.1f} ms")
+            self.stdout.write(self.style.SUCCESS(f"Within budget of {options['budget']:.1f} ms"))
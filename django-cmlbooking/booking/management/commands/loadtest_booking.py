@@ -0,0 +1,171 @@
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, F
+from django.test import Client
+
+from booking import clock, simulation, tokens
+from booking.metrics import Percentile
+from booking.models import Booking, VerifiedEmail
+
+SLOTS = [0, 3, 6, 9, 12, 15, 18, 21]
+ACTIONS = ['calendar', 'slot', 'book', 'verify', 'cancel']
+DEFAULT_MIX = 'calendar=50,slot=25,book=15,verify=5,cancel=5'
+
+def ParseMix(mix):
+    """
+    Parse a mix like 'calendar=50,book=10' into a dict of weights
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in ACTIONS:
+            raise CommandError(f"Unknown action '{name}' in --mix, use {', '.join(ACTIONS)}")
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight '{weight}' for {name} in --mix")
+    if sum(weights.values()) <= 0:
+        raise CommandError('--mix needs at least one action with a positive weight')
+    return weights
+
+class Command(BaseCommand):
+    help = ('Drive concurrent calendar, booking, verification and cancel requests through the URL routes, against a '
+            'test database and the CML stand-in, and report throughput, latency, errors and invariant violations')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=20, help='Concurrent clients (default 20)')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run (default 30)')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Weights of the request kinds (default {DEFAULT_MIX})')
+        parser.add_argument('--emails', type=int, default=300, help='Synthetic users (default 300)')
+        parser.add_argument('--verified', type=float, default=0.7, help='Share of the users verified before the run (default 0.7)')
+        parser.add_argument('--latency', type=float, default=0.02, help='Stand-in delay per CML request in seconds (default 0.02)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable request sequences')
+
+    def handle(self, *args, **options):
+        weights = ParseMix(options['mix'])
+        if options['workers'] < 1 or options['emails'] < 1:
+            raise CommandError('--workers and --emails must be at least 1')
+        self.options = options
+        self.actions = list(weights)
+        self.weights = [weights[name] for name in self.actions]
+        self.emails = [f'load{i}@{simulation.DOMAIN}' for i in range(options['emails'])]
+        self.lock = threading.Lock()
+        self.latency = {name: [] for name in self.actions}
+        self.errors = {}
+        self.statuses = {}
+
+        with simulation.Sandbox(options['latency']):
+            verified = self.emails[:int(len(self.emails) * options['verified'])]
+            VerifiedEmail.objects.bulk_create([VerifiedEmail(email=email, verified=True) for email in verified])
+            # Templates and the URL resolver are loaded before the clock starts
+            Client().get('/')
+
+            started = clock.Time()
+            self.deadline = time.perf_counter() + options['duration']
+            workers = [threading.Thread(target=self.Worker, args=(i,), name=f'loadtest-{i}') for i in range(options['workers'])]
+            wall = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            wall = time.perf_counter() - wall
+
+            if not simulation.WaitForJobs():
+                self.stderr.write(self.style.WARNING('Background jobs still running at the end of the load test'))
+            violations = self.Invariants(started)
+            emails = len(mail.outbox)
+
+        self.Report(wall, violations, emails)
+
+    def Worker(self, number):
+        # Each thread has its own client, session and database connection
+        seed = self.options['seed']
+        rng = random.Random(None if seed is None else seed + number)
+        client = Client(raise_request_exception=False)
+        try:
+            while time.perf_counter() < self.deadline:
+                action = rng.choices(self.actions, self.weights)[0]
+                method, path, data = getattr(self, action.capitalize())(rng)
+                if path is None:
+                    continue
+                start = time.perf_counter()
+                try:
+                    if method == 'POST':
+                        response = client.post(path, data)
+                    else:
+                        response = client.get(path)
+                    status, error = response.status_code, response.status_code >= 400
+                except Exception as e:
+                    status, error = type(e).__name__, True
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.latency[action].append(elapsed)
+                    self.statuses[(action, status)] = self.statuses.get((action, status), 0) + 1
+                    if error:
+                        self.errors[action] = self.errors.get(action, 0) + 1
+        finally:
+            connection.close()
+
+    def Calendar(self, rng):
+        return 'GET', '/', None
+
+    def Slot(self, rng):
+        return 'GET', f'/booking/{rng.randrange(5)}/{rng.choice(SLOTS)}/', None
+
+    def Book(self, rng):
+        # Any slot in the calendar, as from a page that was loaded a while ago
+        return 'POST', f'/booking/{rng.randrange(5)}/{rng.choice(SLOTS)}/', {'email': rng.choice(self.emails)}
+
+    def Verify(self, rng):
+        # The link from the verification email
+        return 'GET', f'/verification/{tokens.MakeVerificationToken(rng.choice(self.emails))}/', None
+
+    def Cancel(self, rng):
+        # The link from the confirmation email of a random booking
+        booking = Booking.objects.order_by('?').first()
+        if booking is None:
+            return 'GET', None, None
+        return 'GET', f'/cancel/{tokens.MakeCancelToken(booking)}/', None
+
+    def Invariants(self, started):
+        """
+        Count the bookings breaking the rules the views are meant to enforce
+        """
+        created = Booking.objects.filter(created__gte=clock.Now() - timedelta(seconds=clock.Time() - started))
+        active = Booking.objects.filter(timeslot__gt=clock.Now() - timedelta(hours=3))
+        return {
+            'double_booked_timeslots': Booking.objects.values('timeslot').annotate(n=Count('id')).filter(n__gt=1).count(),
+            'emails_with_two_active': active.values('email').annotate(n=Count('id')).filter(n__gt=1).count(),
+            'past_slots_booked': created.filter(timeslot__lte=F('created') - timedelta(hours=3)).count(),
+        }
+
+    def Report(self, wall, violations, emails):
+        total = sum(len(values) for values in self.latency.values())
+        errors = sum(self.errors.values())
+        self.stdout.write(f"{total} requests from {self.options['workers']} workers in {wall:.1f}s: "
+                          f"{total / wall:.1f} requests/s, {errors} errors ({errors / max(total, 1):.1%})")
+        self.stdout.write('')
+        self.stdout.write(f"{'action':<10} {'count':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+        for action, values in self.latency.items():
+            if not values:
+                self.stdout.write(f'{action:<10} {0:>6}')
+                continue
+            ms = [value * 1000 for value in values]
+            self.stdout.write(f'{action:<10} {len(ms):>6} {len(ms) / wall:>7.1f} {Percentile(ms, 50):>8.1f} {Percentile(ms, 95):>8.1f} '
+                              f'{Percentile(ms, 99):>8.1f} {max(ms):>8.1f} {self.errors.get(action, 0):>7}')
+        self.stdout.write('')
+        self.stdout.write('Responses')
+        for (action, status), count in sorted(self.statuses.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            self.stdout.write(f'  {action:<10} {status!s:<20} {count}')
+        self.stdout.write(f'  {"emails_sent":<31} {emails}')
+        self.stdout.write('')
+        self.stdout.write('Invariants')
+        for name, count in violations.items():
+            style = self.style.ERROR if count else self.style.SUCCESS
+            self.stdout.write(style(f'  {name:<24} {count}'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from booking import retention
+
+class Command(BaseCommand):
+    help = 'Delete bookings, unverified email addresses, history and lab files past their retention (see RETENTION_* settings)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be removed')
+
+    def handle(self, *args, **options):
+        report = retention.Purge(dry_run=options['dry_run'])
+        verb = 'would be removed' if options['dry_run'] else 'removed'
+        for kind, count in report.items():
+            self.stdout.write(f'{kind:<20} {count:>8} {verb}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from booking import rollups
+
+class Command(BaseCommand):
+    help = 'Recompute the booking and teardown rollups from the bookings and teardowns in the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Days back to recompute (default ROLLUP_RECONCILE_DAYS)')
+
+    def handle(self, *args, **options):
+        rollups.Reconcile(options['days'])
+        self.stdout.write(self.style.SUCCESS('Rollups recomputed'))
@@ -0,0 +1,229 @@
+import contextlib
+import heapq
+import io
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core import mail
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from booking import clock, scheduler, simulation, tokens
+from booking.metrics import Percentile
+from booking.models import Booking, CmlJob, Maintenance, Teardown, VerifiedEmail
+from booking.views import GetCalendarData
+
+SLOTS = [0, 3, 6, 9, 12, 15, 18, 21]
+SLOT_SECONDS = 3 * 3600
+
+class Command(BaseCommand):
+    help = ('Replay synthetic bookings, cancellations and maintenance against the CML stand-in and a test database, '
+            'with time running faster than real time, and report setup and teardown latency and collisions')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Simulated days (default 7)')
+        parser.add_argument('--speed', type=float, default=60, help='Simulated seconds per real second while work is running (default 60). Idle time is skipped.')
+        parser.add_argument('--bookings-per-day', type=int, default=8, help='Booking attempts per simulated day (default 8)')
+        parser.add_argument('--users', type=int, default=30, help='Number of synthetic users (default 30)')
+        parser.add_argument('--cancel-rate', type=float, default=0.2, help='Share of bookings that are cancelled (default 0.2)')
+        parser.add_argument('--stale-rate', type=float, default=0.2, help='Share of attempts picking a random slot instead of a free one (default 0.2)')
+        parser.add_argument('--maintenance', type=int, default=2, help='One-off maintenance windows added during the run, next to a weekly one (default 2)')
+        parser.add_argument('--labs', type=int, default=2, help='Labs each user creates during a slot (default 2)')
+        parser.add_argument('--latency', type=float, default=0.02, help='Stand-in delay per CML request in seconds (default 0.02)')
+        parser.add_argument('--download-latency', type=float, default=0.1, help='Extra stand-in delay per lab download in seconds (default 0.1)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.outcomes = {}
+        self.setup_latency = []
+        self.teardown_latency = []
+        self.lag = []
+        self.collisions = {'teardown_overrun': 0, 'setup_late': 0, 'setup_failed': 0, 'teardown_failed': 0, 'double_booking': 0, 'past_slot_booked': 0}
+        self.users = [f'sim{i}@{simulation.DOMAIN}' for i in range(options['users'])]
+
+        start = datetime.combine(clock.Today() + timedelta(days=1), datetime.min.time()).astimezone()
+        self.sim = clock.SimulatedClock(start, options['speed'])
+        self.events = []
+        self.sequence = 0
+
+        started = time.perf_counter()
+        with simulation.Sandbox(options['latency'], options['download_latency']) as standin, clock.Using(self.sim):
+            self.standin = standin
+            self.client = Client()
+            self.Prepare(start)
+            self.Run()
+            if not simulation.WaitForJobs():
+                self.stderr.write(self.style.WARNING('Background jobs still running at the end of the simulation'))
+            jobs = list(CmlJob.objects.filter(status__in=[CmlJob.DONE, CmlJob.FAILED]).values_list('kind', 'status', 'created', 'finished'))
+            emails = len(mail.outbox)
+            requests = dict(standin.requests)
+        wall = time.perf_counter() - started
+
+        self.Report(wall, jobs, emails, requests)
+
+    def Schedule(self, when, kind, **data):
+        # Events at the same time run in the order they were scheduled
+        self.sequence += 1
+        heapq.heappush(self.events, (when.timestamp() if isinstance(when, datetime) else when, self.sequence, kind, data))
+
+    def Prepare(self, start):
+        days = self.options['days']
+        VerifiedEmail.objects.bulk_create([VerifiedEmail(email=email, verified=True) for email in self.users])
+
+        # Weekly service window on Wednesdays 06:00-09:00
+        wednesday = start + timedelta(days=(2 - start.weekday()) % 7, hours=6)
+        Maintenance.objects.create(start=wednesday, end=wednesday + timedelta(hours=3), reason='Ukentlig service', recurrence=Maintenance.WEEKLY)
+
+        for hour in range(days * 24):
+            self.Schedule(start + timedelta(hours=hour), 'setup')
+            self.Schedule(start + timedelta(hours=hour, minutes=57), 'teardown')
+        for i in range(days * self.options['bookings_per_day']):
+            self.Schedule(start + timedelta(seconds=self.rng.uniform(0, days * 86400)), 'book')
+        for i in range(self.options['maintenance']):
+            self.Schedule(start + timedelta(seconds=self.rng.uniform(0, days * 86400)), 'maintenance')
+        self.end = (start + timedelta(days=days)).timestamp()
+
+    def Run(self):
+        while self.events:
+            when, sequence, kind, data = heapq.heappop(self.events)
+            if when >= self.end:
+                break
+            # Let background jobs run in simulated time, then skip the idle time
+            while self.sim.Time() < when and not simulation.WaitForJobs(timeout=0):
+                time.sleep(0.01)
+            now = self.sim.Time()
+            if when > now:
+                self.sim.Advance(when - now)
+            else:
+                self.lag.append(now - when)
+            getattr(self, kind.capitalize())(when, **data)
+
+    def Outcome(self, name):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+    def Setup(self, when):
+        slot = datetime.fromtimestamp(when).astimezone()
+        booking = Booking.objects.filter(timeslot=slot).first()
+        if booking is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                scheduler.SetUpLab()
+            return
+        if self.sim.Time() - when > 60:
+            self.collisions['setup_late'] += 1
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.SetUpLab()
+        self.setup_latency.append(self.sim.Time() - when)
+        if self.standin.password != booking.password:
+            self.collisions['setup_failed'] += 1
+        else:
+            self.standin.AddLabs(self.options['labs'])
+
+    def Teardown(self, when):
+        started = self.sim.Time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.TearDownLab()
+        # The hour after a slot ended
+        slot = (datetime.fromtimestamp(when).replace(minute=0) - timedelta(hours=2)).astimezone()
+        booking = Booking.objects.filter(timeslot=slot).first()
+        if booking is None:
+            return
+        teardown = Teardown.objects.filter(password=booking.password).first()
+        self.teardown_latency.append(self.sim.Time() - started)
+        if self.sim.Time() > slot.timestamp() + SLOT_SECONDS:
+            self.collisions['teardown_overrun'] += 1
+        if teardown is None or teardown.errors:
+            self.collisions['teardown_failed'] += 1
+
+    def Book(self, when):
+        email = self.rng.choice(self.users)
+        if self.rng.random() < self.options['stale_rate']:
+            day, slot = self.rng.randrange(5), self.rng.choice(SLOTS)
+        else:
+            free = [(day, slot) for day, data in GetCalendarData().items() for slot, status in data['bookingdata'].items() if status == 'free']
+            if not free:
+                self.Outcome('no_free_slot')
+                return
+            day, slot = self.rng.choice(free)
+
+        response = self.client.get(f'/booking/{day}/{slot}/')
+        if response.status_code != 200:
+            self.Outcome('rejected_on_form')
+            return
+
+        before = Booking.objects.count()
+        self.client.post(f'/booking/{day}/{slot}/', {'email': email})
+        booking = Booking.objects.filter(email=email).order_by('-created').first()
+        if Booking.objects.count() == before or booking is None:
+            self.Outcome('rejected_on_submit')
+            return
+
+        self.Outcome('booked')
+        if Booking.objects.filter(timeslot=booking.timeslot).count() > 1:
+            self.collisions['double_booking'] += 1
+        # A slot that already ended gets a lab set up that no teardown cleans up
+        if booking.timeslot.timestamp() + SLOT_SECONDS <= self.sim.Time():
+            self.collisions['past_slot_booked'] += 1
+        if self.rng.random() < self.options['cancel_rate']:
+            # Cancel some time before the slot ends, sometimes during it
+            latest = booking.timeslot.timestamp() + SLOT_SECONDS - 1800
+            if latest > self.sim.Time():
+                self.Schedule(self.rng.uniform(self.sim.Time(), latest), 'cancel', booking=booking.pk)
+
+    def Cancel(self, when, booking):
+        booking = Booking.objects.filter(pk=booking).first()
+        if booking is None:
+            self.Outcome('cancel_gone')
+            return
+        ongoing = booking.timeslot.timestamp() <= self.sim.Time()
+        self.client.get(f'/cancel/{tokens.MakeCancelToken(booking)}/')
+        if ongoing:
+            self.Outcome('cancelled_ongoing')
+        elif Booking.objects.filter(pk=booking.pk).exists():
+            self.Outcome('cancel_failed')
+        else:
+            self.Outcome('cancelled')
+
+    def Maintenance(self, when):
+        start = datetime.fromtimestamp(when).astimezone().replace(minute=0, second=0, microsecond=0) + timedelta(days=self.rng.randint(1, 3))
+        Maintenance.objects.create(start=start, end=start + timedelta(hours=self.rng.choice([1, 3, 6])), reason='Planlagt vedlikehold')
+        self.Outcome('maintenance_added')
+
+    def Report(self, wall, jobs, emails, requests):
+        speed = self.options['speed']
+        simulated = self.options['days'] * 86400
+
+        def Line(name, values):
+            if not values:
+                return f'{name:<24} -'
+            return (f'{name:<24} n={len(values):<5} p50={Percentile(values, 50):8.1f}s '
+                    f'p95={Percentile(values, 95):8.1f}s max={max(values):8.1f}s')
+
+        self.stdout.write(f"Simulated {self.options['days']} days in {wall:.1f}s wall time ({simulated / wall:,.0f}x real time), work at {speed:g}x")
+        self.stdout.write('')
+        self.stdout.write('Latency in simulated seconds')
+        self.stdout.write(Line('setup (scheduled)', self.setup_latency))
+        self.stdout.write(Line('teardown (scheduled)', self.teardown_latency))
+        for kind in (CmlJob.SETUP, CmlJob.CLEANUP):
+            durations = [(finished - created).total_seconds() * speed for k, status, created, finished in jobs if k == kind and finished]
+            self.stdout.write(Line(f'{kind} (background job)', durations))
+        self.stdout.write(Line('event start lag', self.lag))
+        self.stdout.write('')
+        self.stdout.write('Outcomes')
+        for name, count in sorted(self.outcomes.items()):
+            self.stdout.write(f'  {name:<22} {count}')
+        failed_jobs = sum(1 for k, status, created, finished in jobs if status == CmlJob.FAILED)
+        self.stdout.write(f'  {"failed_background_jobs":<22} {failed_jobs}')
+        self.stdout.write(f'  {"emails_sent":<22} {emails}')
+        self.stdout.write('')
+        self.stdout.write('Collisions')
+        for name, count in self.collisions.items():
+            style = self.style.ERROR if count else self.style.SUCCESS
+            self.stdout.write(style(f'  {name:<22} {count}'))
+        self.stdout.write('')
+        self.stdout.write(f'CML stand-in requests: {sum(requests.values())}')
+        for name, count in sorted(requests.items(), key=lambda item: -item[1])[:10]:
+            self.stdout.write(f'  {name:<40} {count}')
@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import os
+import re
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+# Third party assets used by base.html, stored in booking/static/booking/vendor/.
+# The integrity hashes are the ones base.html used with the CDN links.
+ASSETS = [
+    {
+        'url': 'https://cdn.jsdelivr.net/npm/bootstrap@4.6.2/dist/css/bootstrap.min.css',
+        'name': 'bootstrap.min.css',
+        'integrity': 'sha384-xOolHFLEh07PJGoPkLv1IbcEPTNtaed2xpHsD9ESMhqIYd0nLMwNLD69Npy4HI+N',
+    },
+    {
+        'url': 'https://cdn.jsdelivr.net/npm/jquery@3.5.1/dist/jquery.slim.min.js',
+        'name': 'jquery.slim.min.js',
+        'integrity': 'sha384-DfXdz2htPH0lsSSs5nCTpuj/zy4C+OGpamoFVy38MVBnE+IbbVYUew+OrCXaRkfj',
+    },
+    {
+        'url': 'https://cdn.jsdelivr.net/npm/bootstrap@4.6.2/dist/js/bootstrap.bundle.min.js',
+        'name': 'bootstrap.bundle.min.js',
+        'integrity': 'sha384-Fy6S3B9q64WdZWQUiU+q4/2Lc9npb8tCaSX9FK7E8HnRr0Jz8D6OP9dO5Vg3Q9ct',
+    },
+    {
+        'url': 'https://img.icons8.com/3d-fluency/100/000000/calendar--v2.png',
+        'name': 'favicon.png',
+        'integrity': None,
+    },
+]
+
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'static', 'booking', 'vendor')
+
+# The source maps are not vendored, and the manifest storage fails on references to missing files
+SOURCE_MAP = re.compile(rb'\n?(/\*# sourceMappingURL=\S+ \*/|//# sourceMappingURL=\S+)\s*$')
+
+def Integrity(data, algorithm):
+    digest = hashlib.new(algorithm, data).digest()
+    return f'{algorithm}-{base64.b64encode(digest).decode()}'
+
+class Command(BaseCommand):
+    help = 'Download the third party CSS, JavaScript and favicon used by the templates into booking/static'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Download assets that already exist')
+
+    def handle(self, *args, **options):
+        os.makedirs(VENDOR_DIR, exist_ok=True)
+        for asset in ASSETS:
+            path = os.path.join(VENDOR_DIR, asset['name'])
+            if os.path.exists(path) and not options['force']:
+                self.stdout.write(f"{asset['name']}: exists, skipping")
+                continue
+
+            r = requests.get(asset['url'], timeout=30)
+            if r.status_code != 200:
+                raise CommandError(f"{asset['url']} returned {r.status_code}")
+
+            data = r.content
+            if asset['integrity']:
+                algorithm = asset['integrity'].split('-', 1)[0]
+                if Integrity(data, algorithm) != asset['integrity']:
+                    raise CommandError(f"{asset['url']} does not match its integrity hash, not saved")
+                data = SOURCE_MAP.sub(b'\n', data)
+
+            with open(path, 'wb') as file:
+                file.write(data)
+            self.stdout.write(self.style.SUCCESS(f"{asset['name']}: saved {len(data)} bytes"))
+
+        self.stdout.write('Commit booking/static/booking/vendor and run collectstatic to serve the assets locally.')
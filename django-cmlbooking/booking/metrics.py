@@ -0,0 +1,89 @@
+"""
+Minimal in-process metrics registry, exported in the Prometheus text format
+by the /metrics view. Values are per process.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+_help = {}
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def Describe(name, text):
+    # Register the HELP text of a metric
+    _help[name] = text
+
+def Increment(name, value=1, **labels):
+    """
+    Increase a counter
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def SetGauge(name, value, **labels):
+    """
+    Set a gauge to the given value
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def Observe(name, value, **labels):
+    """
+    Add an observation (e.g. a duration in seconds) to a summary
+    """
+    key = _key(name, labels)
+    with _lock:
+        count, total = _summaries.get(key, (0, 0.0))
+        _summaries[key] = (count + 1, total + value)
+
+def GetValue(name, **labels):
+    # Current value of a counter or gauge, 0 if never set
+    key = _key(name, labels)
+    with _lock:
+        return _counters.get(key, _gauges.get(key, 0))
+
+def Percentile(values, percent):
+    """
+    Nearest-rank percentile of a list of numbers, None if it is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+def _format(name, labels, value):
+    if labels:
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+        return f'{name}{{{label_str}}} {value}'
+    return f'{name} {value}'
+
+def Render():
+    """
+    Return all metrics in the Prometheus text exposition format
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        summaries = dict(_summaries)
+
+    lines = []
+    seen = set()
+    for metrics, kind in ((counters, 'counter'), (gauges, 'gauge'), (summaries, 'summary')):
+        for (name, labels), value in sorted(metrics.items()):
+            if name not in seen:
+                seen.add(name)
+                if name in _help:
+                    lines.append(f'# HELP {name} {_help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+            if kind == 'summary':
+                lines.append(_format(f'{name}_count', labels, value[0]))
+                lines.append(_format(f'{name}_sum', labels, value[1]))
+            else:
+                lines.append(_format(name, labels, value))
+    return '\n'.join(lines) + '\n'
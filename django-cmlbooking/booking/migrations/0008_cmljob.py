@@ -0,0 +1,32 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:08
+
+import booking.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_maintenance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CmlJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reference', models.CharField(default=booking.models.random_uuid, editable=False, max_length=50, unique=True)),
+                ('kind', models.CharField(choices=[('setup', 'Oppsett'), ('cleanup', 'Opprydding')], max_length=20)),
+                ('status', models.CharField(choices=[('queued', 'I kø'), ('running', 'Pågår'), ('done', 'Fullført'), ('failed', 'Feilet')], db_index=True, default='queued', max_length=20)),
+                ('email', models.EmailField(max_length=254)),
+                ('password', models.CharField(blank=True, max_length=50, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('booking', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='booking.booking')),
+            ],
+        ),
+    ]
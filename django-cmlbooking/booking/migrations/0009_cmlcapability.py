@@ -0,0 +1,22 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0008_cmljob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CmlCapability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('variant', models.CharField(max_length=50)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
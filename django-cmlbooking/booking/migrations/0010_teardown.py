@@ -0,0 +1,46 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0009_cmlcapability'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Teardown',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('password', models.CharField(max_length=50, unique=True)),
+                ('password_restored', models.BooleanField(default=False)),
+                ('users_logged_out', models.BooleanField(default=False)),
+                ('email_sent', models.BooleanField(default=False)),
+                ('errors', models.TextField(blank=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TeardownLab',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lab', models.CharField(max_length=100)),
+                ('exported', models.BooleanField(default=False)),
+                ('stopped', models.BooleanField(default=False)),
+                ('wiped', models.BooleanField(default=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('teardown', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='labs', to='booking.teardown')),
+            ],
+            options={
+                'unique_together': {('teardown', 'lab')},
+            },
+        ),
+    ]
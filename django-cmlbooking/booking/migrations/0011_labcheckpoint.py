@@ -0,0 +1,27 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_teardown'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('password', models.CharField(max_length=50)),
+                ('lab', models.CharField(max_length=100)),
+                ('modified', models.CharField(blank=True, max_length=50, null=True)),
+                ('saved', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('password', 'lab')},
+            },
+        ),
+    ]
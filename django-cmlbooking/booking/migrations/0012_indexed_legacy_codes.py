@@ -0,0 +1,28 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0011_labcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='booking',
+            name='cancelcode',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='verifiedemail',
+            name='email',
+            field=models.EmailField(db_index=True, max_length=254),
+        ),
+        migrations.AlterField(
+            model_name='verifiedemail',
+            name='verificationcode',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0012_indexed_legacy_codes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=50)),
+                ('code', models.CharField(blank=True, max_length=10)),
+                ('lab', models.CharField(blank=True, max_length=100)),
+                ('message', models.TextField()),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0013_pending_alerts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='maintenance',
+            name='recurrence',
+            field=models.CharField(choices=[('none', 'Ingen'), ('daily', 'Daglig'), ('weekly', 'Ukentlig')], default='none', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='maintenance',
+            name='repeat_until',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0014_maintenance_recurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('bookings', models.PositiveIntegerField(default=0)),
+                ('cancellations', models.PositiveIntegerField(default=0)),
+                ('teardowns', models.PositiveIntegerField(default=0)),
+                ('teardown_failures', models.PositiveIntegerField(default=0)),
+                ('teardown_seconds', models.FloatField(default=0)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'daily stats',
+            },
+        ),
+        migrations.CreateModel(
+            name='SlotStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('bookings', models.PositiveIntegerField(default=0)),
+                ('cancellations', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'slot stats',
+                'unique_together': {('date', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.24 on 2026-10-19 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0015_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cmljob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
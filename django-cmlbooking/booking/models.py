@@ -1,46 +1,256 @@
 from django.db import models
+from django.utils import timezone
+from . import clock
 import uuid
 
 def random_uuid():
     random_uuid = uuid.uuid4().hex
     return random_uuid
 
+class ClockDateTimeField(models.DateTimeField):
+    """
+    DateTimeField taking auto_now and auto_now_add from booking.clock, so
+    the timestamps match the time the jobs compare them with. Migrations see
+    a plain DateTimeField.
+    """
+    def pre_save(self, model_instance, add):
+        if self.auto_now or (self.auto_now_add and add):
+            value = clock.Now()
+            setattr(model_instance, self.attname, value)
+            return value
+        return super().pre_save(model_instance, add)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        return name, 'django.db.models.DateTimeField', args, kwargs
+
 class Booking(models.Model):
     timeslot = models.DateTimeField()
     email = models.EmailField(blank=False)
     password = models.CharField(max_length=50, blank=True, null=True, editable=True)
-    cancelcode = models.CharField(max_length=50, blank=True, null=True, editable=True)
-    created = models.DateTimeField(auto_now_add=True)
-    modified = models.DateTimeField(auto_now=True)
+    # Only used by cancel links sent before signed tokens (see tokens.py)
+    cancelcode = models.CharField(max_length=50, blank=True, null=True, editable=True, db_index=True)
+    created = ClockDateTimeField(auto_now_add=True)
+    modified = ClockDateTimeField(auto_now=True)
     
     def __str__(self):
         return f'{self.timeslot} - {self.email}'
 
     def save(self, *args, **kwargs):
-        self.password = random_uuid()
-        self.cancelcode = random_uuid()
+        # Generate codes once, later saves must not change the password of an ongoing booking
+        if not self.password:
+            self.password = random_uuid()
+        if not self.cancelcode:
+            self.cancelcode = random_uuid()
         super(Booking, self).save(*args, **kwargs)
 
 class VerifiedEmail(models.Model):
-    email = models.EmailField(blank=False)
-    verificationcode = models.CharField(max_length=50, blank=True, null=True, editable=True)
+    email = models.EmailField(blank=False, db_index=True)
+    # Only used by verification links sent before signed tokens (see tokens.py)
+    verificationcode = models.CharField(max_length=50, blank=True, null=True, editable=True, db_index=True)
     verified = models.BooleanField(default=False)
-    created = models.DateTimeField(auto_now_add=True)
-    modified = models.DateTimeField(auto_now=True)
+    created = ClockDateTimeField(auto_now_add=True)
+    modified = ClockDateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.email} - {self.verified}'
 
-    def save(self, *args, **kwargs):
-        self.verificationcode = random_uuid()
-        super(VerifiedEmail, self).save(*args, **kwargs)
-
 class Maintenance(models.Model):
+    """
+    Maintenance window. A recurring window repeats start - end every day or
+    week until repeat_until (inclusive, forever if empty), see maintenance.py.
+    """
+    NONE = 'none'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    RECURRENCE_CHOICES = [
+        (NONE, 'Ingen'),
+        (DAILY, 'Daglig'),
+        (WEEKLY, 'Ukentlig'),
+    ]
+
     start = models.DateTimeField(blank=False)
     end = models.DateTimeField(blank=False)
     reason = models.CharField(max_length=250, blank=True, null=True, editable=True)
-    created = models.DateTimeField(auto_now_add=True)
+    recurrence = models.CharField(max_length=10, choices=RECURRENCE_CHOICES, default=NONE)
+    repeat_until = models.DateField(blank=True, null=True)
+    created = ClockDateTimeField(auto_now_add=True)
+    modified = ClockDateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Maintenance {self.start} - {self.end}'
+
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        from datetime import timedelta
+        if self.start and self.end and self.end <= self.start:
+            raise ValidationError('Slutt må være etter start.')
+        period = {self.DAILY: timedelta(days=1), self.WEEKLY: timedelta(days=7)}.get(self.recurrence)
+        if period and self.start and self.end and self.end - self.start >= period:
+            raise ValidationError('Et gjentakende vedlikehold må være kortere enn perioden det gjentas med.')
+
+class CmlJob(models.Model):
+    """
+    CML operation running in the background on behalf of a web request
+    """
+    SETUP = 'setup'
+    CLEANUP = 'cleanup'
+    KIND_CHOICES = [
+        (SETUP, 'Oppsett'),
+        (CLEANUP, 'Opprydding'),
+    ]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'I kø'),
+        (RUNNING, 'Pågår'),
+        (DONE, 'Fullført'),
+        (FAILED, 'Feilet'),
+    ]
+
+    reference = models.CharField(max_length=50, unique=True, default=random_uuid, editable=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    booking = models.ForeignKey(Booking, blank=True, null=True, on_delete=models.SET_NULL)
+    email = models.EmailField(blank=False)
+    password = models.CharField(max_length=50, blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    started = models.DateTimeField(blank=True, null=True)
+    # Refreshed while the job runs, a running job without it is left behind by a dead process
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    created = ClockDateTimeField(auto_now_add=True)
+    modified = ClockDateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.kind} {self.email} - {self.status}'
+
+    @property
+    def pending(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+class CmlCapability(models.Model):
+    """
+    Which variant of a CML API endpoint the connected CML build accepts
+    """
+    name = models.CharField(max_length=50, unique=True)
+    variant = models.CharField(max_length=50)
     modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return f'Maintenance {self.start} - {self.end}'
\ No newline at end of file
+        return f'{self.name}: {self.variant}'
+
+class Teardown(models.Model):
+    """
+    Progress of the cleanup after a booking, so an interrupted cleanup can
+    be resumed. Identified by the temporary password of the booking.
+    """
+    email = models.EmailField(blank=False)
+    password = models.CharField(max_length=50, unique=True)
+    password_restored = models.BooleanField(default=False)
+    users_logged_out = models.BooleanField(default=False)
+    email_sent = models.BooleanField(default=False)
+    errors = models.TextField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    created = ClockDateTimeField(auto_now_add=True)
+    modified = ClockDateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Teardown {self.email} - {self.created}'
+
+class TeardownLab(models.Model):
+    """
+    Progress of the cleanup of a single lab
+    """
+    teardown = models.ForeignKey(Teardown, related_name='labs', on_delete=models.CASCADE)
+    lab = models.CharField(max_length=100)
+    exported = models.BooleanField(default=False)
+    stopped = models.BooleanField(default=False)
+    wiped = models.BooleanField(default=False)
+    deleted = models.BooleanField(default=False)
+    modified = ClockDateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['teardown', 'lab']
+
+    def __str__(self):
+        return f'{self.lab}'
+
+class LabCheckpoint(models.Model):
+    """
+    Latest snapshot of a lab saved during a booking. The lab file is saved
+    in booking/labs, modified is the lab's 'modified' value in CML when the
+    file was downloaded.
+    """
+    email = models.EmailField(blank=False)
+    password = models.CharField(max_length=50)
+    lab = models.CharField(max_length=100)
+    modified = models.CharField(max_length=50, blank=True, null=True)
+    saved = ClockDateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['password', 'lab']
+
+    def __str__(self):
+        return f'{self.lab} - {self.saved}'
+
+class PendingAlert(models.Model):
+    """
+    Error reported to the admin. Repeats of the same error code for the same
+    lab count on one alert until it is sent with the next digest.
+    """
+    source = models.CharField(max_length=50)
+    code = models.CharField(max_length=10, blank=True)
+    lab = models.CharField(max_length=100, blank=True)
+    message = models.TextField()
+    count = models.PositiveIntegerField(default=1)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.source} {self.code} {self.lab} ({self.count})'
+
+class DailyStats(models.Model):
+    """
+    Bookings, cancellations and teardowns per day, see rollups.py. Bookings
+    and cancellations count on the day of the slot, teardowns on the day
+    they finished.
+    """
+    date = models.DateField(unique=True)
+    bookings = models.PositiveIntegerField(default=0)
+    cancellations = models.PositiveIntegerField(default=0)
+    teardowns = models.PositiveIntegerField(default=0)
+    teardown_failures = models.PositiveIntegerField(default=0)
+    teardown_seconds = models.FloatField(default=0)
+    modified = ClockDateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'daily stats'
+
+    def __str__(self):
+        return f'{self.date}'
+
+    @property
+    def average_teardown_seconds(self):
+        return round(self.teardown_seconds / self.teardowns, 1) if self.teardowns else None
+
+class SlotStats(models.Model):
+    """
+    Bookings and cancellations per slot, see rollups.py
+    """
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    bookings = models.PositiveIntegerField(default=0)
+    cancellations = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['date', 'hour']
+        verbose_name_plural = 'slot stats'
+
+    def __str__(self):
+        return f'{self.date} {self.hour:02}'
@@ -0,0 +1,205 @@
+"""
+Background poller that keeps an in-memory snapshot of the CML server state.
+
+The scheduler calls Poll every CML_POLL_SECONDS. The state, 'modified' and
+'node_count' of all labs come from one lab tiles request (older CML
+versions without it cost one request per lab), and the nodes of a lab are
+only fetched again when one of these changed since the previous poll.
+Readers (calendar, health checks, teardown) use Snapshot and never call CML
+themselves.
+
+The snapshot lives in the process running the scheduler. Other processes
+(further web workers, management commands) never poll, they always see an
+empty snapshot and Unreachable() is False there.
+
+CML does not expose the active user sessions through the API, so the
+snapshot only holds labs and node states.
+"""
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from . import clock
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('cml_poll_seconds', 'Duration of CML state polls')
+metrics.Describe('cml_poll_failures_total', 'CML state polls that failed')
+metrics.Describe('cml_labs', 'Number of labs on the CML server')
+metrics.Describe('cml_nodes_booted', 'Number of booted nodes on the CML server')
+
+# _lock only guards replacing the snapshot, polls are serialized by
+# _polling and talk to CML without holding _lock
+_lock = threading.Lock()
+_polling = threading.Lock()
+_token = None
+
+# Labs forgotten while a poll was running, dropped from its result
+_forgotten = set()
+
+# Replaced as a whole on every poll, readers get a consistent view
+_snapshot = {
+    'labs': {},
+    'updated': None,
+    'ok': None,
+    'error': None,
+}
+
+def Snapshot(max_age=None):
+    """
+    Return the latest snapshot, a dict with:
+      labs: {lab_id: {'state', 'modified', 'node_count', 'nodes': {node_id: state}}}
+      updated: epoch seconds of the last successful poll, None if never
+      ok: True if the last poll succeeded, None if no poll has run
+      error: reason the last poll failed
+
+    With max_age (seconds), returns None if the snapshot is older than that.
+    """
+    snapshot = _snapshot
+    if max_age is not None and (snapshot['updated'] is None or clock.Time() - snapshot['updated'] > max_age):
+        return None
+    return snapshot
+
+def Unreachable():
+    # True if the last poll could not reach CML. Always False in processes
+    # not running the scheduler, see the module docstring
+    return _snapshot['ok'] is False
+
+def Forget(lab):
+    """
+    Remove a lab from the snapshot, e.g. after it was deleted. Does not wait
+    for a running poll, the lab is also dropped from that poll's result.
+    """
+    with _lock:
+        _forgotten.add(lab)
+        labs = dict(_snapshot['labs'])
+        if labs.pop(lab, None) is not None:
+            _Publish(labs, _snapshot['updated'], _snapshot['ok'], _snapshot['error'])
+
+def _Publish(labs, updated, ok, error):
+    global _snapshot
+    _snapshot = {'labs': labs, 'updated': updated, 'ok': ok, 'error': error}
+
+def _Passwords():
+    # The admin password is replaced by the temporary password of the
+    # ongoing booking, so try that one first
+    from booking.models import Booking
+    now = clock.Now()
+    booking = Booking.objects.filter(timeslot__gt=now - timedelta(hours=3), timeslot__lte=now).first()
+    if booking:
+        return [booking.password, settings.CML_PASSWORD]
+    return [settings.CML_PASSWORD]
+
+def _Authenticate():
+    from . import cml
+    global _token
+    for password in _Passwords():
+        token, statuscode = cml.GetToken(settings.CML_USERNAME, password)
+        if statuscode == 200 and token:
+            _token = token
+            return token
+    _token = None
+    return None
+
+def _NodeStates(token, lab):
+    from . import cml
+    nodes, statuscode = cml.GetNodesInLab(token, lab, data=True)
+    if statuscode != 200:
+        return None
+    # With data=true CML returns node objects, older versions only the ids
+    states = {}
+    for node in nodes:
+        if isinstance(node, dict):
+            states[node['id']] = node.get('state')
+        else:
+            states[node] = None
+    return states
+
+def _LabTiles(token):
+    from . import cml
+    return cml.GetLabTiles(token)
+
+def _LabInfos(token):
+    # Lab list and one request per lab, for CML versions without lab tiles
+    from . import cml
+    labs, statuscode = cml.GetListOfAllLabs(token)
+    if statuscode != 200:
+        return None, statuscode
+    summaries = {}
+    for lab in labs:
+        info, statuscode = cml.GetLabInfo(token, lab)
+        # Labs deleted while polling are left out
+        if statuscode == 200 and isinstance(info, dict):
+            summaries[lab] = info
+    return summaries, 200
+
+SUMMARY_VARIANTS = {'tiles': _LabTiles, 'labs': _LabInfos}
+
+def _Summaries(token):
+    # {lab_id: summary} of all labs, with the variant the CML version supports
+    from . import capabilities
+    return capabilities.TryVariants('lab_summaries', list(SUMMARY_VARIANTS), lambda variant: SUMMARY_VARIANTS[variant](token),
+                                    lambda result: result[1] != 404)
+
+def Poll():
+    """
+    Refresh the snapshot. Only labs that changed since the last poll have
+    their nodes fetched again.
+    """
+    from .breaker import CircuitOpenError
+    import requests
+
+    started = time.monotonic()
+    with _polling:
+        previous = _snapshot['labs']
+        try:
+            token = _token or _Authenticate()
+            if token is None:
+                raise PermissionError('GetToken failed, not authenticated')
+
+            summaries, statuscode = _Summaries(token)
+            if statuscode in (401, 403):
+                # Token expired or all sessions were cleared by a teardown
+                token = _Authenticate()
+                if token is None:
+                    raise PermissionError('GetToken failed, not authenticated')
+                summaries, statuscode = _Summaries(token)
+            if statuscode != 200:
+                raise ValueError(f'Listing the labs returned {statuscode}')
+
+            current = {}
+            fetched = 0
+            for lab, info in summaries.items():
+                entry = {
+                    'state': info.get('state'),
+                    'modified': info.get('modified'),
+                    'node_count': info.get('node_count'),
+                }
+                known = previous.get(lab)
+                if known and all(known[k] == entry[k] for k in entry) and known['nodes'] is not None:
+                    entry['nodes'] = known['nodes']
+                else:
+                    entry['nodes'] = _NodeStates(token, lab)
+                    fetched += 1
+                current[lab] = entry
+
+            with _lock:
+                for lab in _forgotten:
+                    current.pop(lab, None)
+                _forgotten.clear()
+                _Publish(current, clock.Time(), True, None)
+            logger.debug("Poll: %s labs, nodes fetched for %s", len(current), fetched)
+            if set(current) != set(previous):
+                logger.info("Poll: Labs on CML changed, now %s labs", len(current))
+        except (CircuitOpenError, PermissionError, ValueError, requests.exceptions.RequestException) as e:
+            logger.warning("Poll: Could not refresh CML state: %s", e)
+            metrics.Increment('cml_poll_failures_total')
+            with _lock:
+                _Publish(_snapshot['labs'], _snapshot['updated'], False, str(e))
+        finally:
+            metrics.Observe('cml_poll_seconds', time.monotonic() - started)
+
+    labs = _snapshot['labs']
+    metrics.SetGauge('cml_labs', len(labs))
+    metrics.SetGauge('cml_nodes_booted', sum(1 for lab in labs.values() for state in (lab['nodes'] or {}).values() if state == 'BOOTED'))
@@ -0,0 +1,142 @@
+"""
+Token bucket rate limiting for the booking, verification and cancel views.
+
+Every client IP has a bucket for GET and one for POST requests. A
+throttled request gets a 429 response with Retry-After before the view runs
+any query or template.
+
+Booking requests that may send an email also use the email budgets, per
+email address and, with a higher limit for clients sharing an address
+behind NAT, per IP. These are charged by the view with TakeEmail once the
+address passed validation, so made up requests can not use up the budget
+of someone else's address.
+
+Buckets are kept in the RATELIMIT_CACHE cache. The default local memory
+cache makes the budgets per process.
+"""
+import asyncio
+import functools
+import math
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('ratelimit_throttled_total', 'Requests rejected by the rate limiter by budget')
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_lock = threading.Lock()
+
+def ParseRate(rate):
+    """
+    Parse a rate like '10/m' or '100/300' (per 300 seconds) into
+    (requests, seconds)
+    """
+    count, period = rate.split('/')
+    seconds = UNITS[period] if period in UNITS else float(period)
+    return int(count), seconds
+
+def Take(key, rate):
+    """
+    Take one token from the bucket. Returns 0 if allowed, else the number of
+    seconds until a token is available.
+    """
+    capacity, seconds = ParseRate(rate)
+    refill = capacity / seconds
+    cache = caches[settings.RATELIMIT_CACHE]
+    with _lock:
+        now = time.time()
+        tokens, stamp = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * refill)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        cache.set(key, (tokens, now), timeout=math.ceil(seconds))
+    return 0 if allowed else (1 - tokens) / refill
+
+def ClientIp(request):
+    """
+    Client address of the request. Behind proxies it is in the header, where
+    each proxy appends the address it received the request from. Entries
+    to the left of the ones added by the trusted proxies come from the
+    client and are ignored, so a made up header does not get a new budget.
+    """
+    if settings.RATELIMIT_IP_HEADER and settings.RATELIMIT_TRUSTED_PROXIES > 0:
+        forwarded = [ip.strip() for ip in request.META.get(settings.RATELIMIT_IP_HEADER, '').split(',') if ip.strip()]
+        # Fewer entries than proxies, the request did not come through all of them
+        if len(forwarded) >= settings.RATELIMIT_TRUSTED_PROXIES:
+            return forwarded[-settings.RATELIMIT_TRUSTED_PROXIES]
+    return request.META.get('REMOTE_ADDR', '')
+
+def _Charge(budgets, path):
+    # Take a token from each budget, returns the seconds to wait if one is exhausted
+    for budget, who, rate in budgets:
+        wait = Take(f'ratelimit:{budget}:{who}', rate)
+        if wait:
+            logger.warning("RateLimit: %s budget exhausted for %s on %s", budget, who, path)
+            metrics.Increment('ratelimit_throttled_total', budget=budget)
+            return wait
+    return 0
+
+def Throttled(wait):
+    """
+    429 response asking the client to retry after wait seconds
+    """
+    response = HttpResponse('For mange forespørsler. Vent litt og prøv igjen.', status=429, content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+def Check(request):
+    """
+    Charge the request to its budgets. Returns a 429 response if one of them
+    is exhausted, else None.
+    """
+    ip = ClientIp(request)
+    if request.method == 'POST':
+        budgets = [('post', f'ip:{ip}', settings.RATELIMIT_POST)]
+    else:
+        budgets = [('get', f'ip:{ip}', settings.RATELIMIT_GET)]
+
+    wait = _Charge(budgets, request.path)
+    return Throttled(wait) if wait else None
+
+def TakeEmail(ip, email, path=''):
+    """
+    Charge a request that sends an email to the email budgets of the client
+    IP and of the email address. Only call this for addresses that passed
+    validation. Returns 0 if allowed, else the number of seconds to wait.
+    """
+    if not settings.RATELIMIT_ENABLED:
+        return 0
+    budgets = [
+        ('email_ip', f'ip:{ip}', settings.RATELIMIT_EMAIL_IP),
+        ('email', f'email:{email.strip().lower()}', settings.RATELIMIT_EMAIL),
+    ]
+    return _Charge(budgets, path)
+
+def Limit(view):
+    """
+    Decorator applying the rate limits to a sync or async view
+    """
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if settings.RATELIMIT_ENABLED:
+                response = Check(request)
+                if response:
+                    return response
+            return await view(request, *args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if settings.RATELIMIT_ENABLED:
+                response = Check(request)
+                if response:
+                    return response
+            return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,121 @@
+"""
+Retention of old rows and lab files, run nightly by the scheduler.
+
+Rows are deleted in batches of RETENTION_BATCH_SIZE, each batch in its own
+short transaction with a pause in between, so the purge never holds the
+database write lock for long. With RETENTION_ARCHIVE_DIR set, every batch is
+appended to a JSON lines file per table and month before it is deleted.
+
+A retention of 0 days keeps the rows of that kind forever.
+"""
+import os
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core import serializers
+from django.db import transaction
+from . import clock
+from . import metrics
+import logging
+logger = logging.getLogger(__name__)
+
+metrics.Describe('retention_deleted_total', 'Rows and lab files removed by the retention job by kind')
+
+LABS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'labs')
+
+# Pause between batches, lets the booking views write in between
+BATCH_PAUSE_SECONDS = 0.1
+
+def Expired():
+    """
+    Querysets of the rows past their retention, by kind
+    """
+    from booking.models import Booking, VerifiedEmail, CmlJob, Teardown, LabCheckpoint, PendingAlert
+
+    now = clock.Now()
+    expired = {}
+    if settings.RETENTION_BOOKING_DAYS:
+        expired['bookings'] = Booking.objects.filter(timeslot__lt=now - timedelta(days=settings.RETENTION_BOOKING_DAYS))
+    if settings.RETENTION_UNVERIFIED_DAYS:
+        expired['unverified_emails'] = VerifiedEmail.objects.filter(verified=False, created__lt=now - timedelta(days=settings.RETENTION_UNVERIFIED_DAYS))
+    if settings.RETENTION_HISTORY_DAYS:
+        cutoff = now - timedelta(days=settings.RETENTION_HISTORY_DAYS)
+        expired['cml_jobs'] = CmlJob.objects.filter(status__in=[CmlJob.DONE, CmlJob.FAILED], modified__lt=cutoff)
+        expired['teardowns'] = Teardown.objects.filter(finished__isnull=False, finished__lt=cutoff)
+        expired['lab_checkpoints'] = LabCheckpoint.objects.filter(saved__lt=cutoff)
+        expired['alerts'] = PendingAlert.objects.filter(sent__isnull=False, sent__lt=cutoff)
+    return expired
+
+def _Archive(kind, rows):
+    os.makedirs(settings.RETENTION_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(settings.RETENTION_ARCHIVE_DIR, f"{kind}-{clock.Today():%Y-%m}.jsonl")
+    with open(path, 'a') as file:
+        file.write(serializers.serialize('jsonl', rows))
+
+def PurgeRows(kind, queryset, dry_run=False):
+    """
+    Delete the rows of the queryset in batches. Returns the number of rows.
+    """
+    if dry_run:
+        return queryset.count()
+
+    removed = 0
+    while True:
+        with transaction.atomic():
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:settings.RETENTION_BATCH_SIZE])
+            if not pks:
+                break
+            batch = queryset.model.objects.filter(pk__in=pks)
+            if settings.RETENTION_ARCHIVE_DIR:
+                _Archive(kind, batch)
+            # Related rows are cascaded or set to null as usual, only the rows of the model are counted
+            removed += batch.delete()[1].get(queryset.model._meta.label, 0)
+        time.sleep(BATCH_PAUSE_SECONDS)
+    return removed
+
+def PurgeLabFiles(dry_run=False):
+    """
+    Delete lab files older than RETENTION_LAB_FILE_HOURS that no unfinished
+    teardown still has to send. Returns the number of files.
+    """
+    from booking.models import TeardownLab
+
+    if not settings.RETENTION_LAB_FILE_HOURS or not os.path.isdir(LABS_DIRECTORY):
+        return 0
+
+    in_use = set(TeardownLab.objects.filter(teardown__finished__isnull=True).values_list('lab', flat=True))
+    cutoff = time.time() - settings.RETENTION_LAB_FILE_HOURS * 3600
+    removed = 0
+    for entry in os.scandir(LABS_DIRECTORY):
+        if not entry.is_file() or entry.stat().st_mtime >= cutoff:
+            continue
+        if os.path.splitext(entry.name)[0] in in_use:
+            continue
+        if not dry_run:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning("PurgeLabFiles: Could not remove %s: %s", entry.path, e)
+                continue
+        removed += 1
+    return removed
+
+def Purge(dry_run=False):
+    """
+    Remove everything past its retention. Returns the number of rows or
+    files removed by kind.
+    """
+    report = {}
+    for kind, queryset in Expired().items():
+        try:
+            report[kind] = PurgeRows(kind, queryset, dry_run)
+        except Exception as e:
+            logger.exception("Purge: Failed removing %s: %s", kind, e)
+    report['lab_files'] = PurgeLabFiles(dry_run)
+
+    if not dry_run:
+        for kind, count in report.items():
+            if count:
+                metrics.Increment('retention_deleted_total', count, kind=kind)
+    logger.info("Purge: %s %s", 'Would remove' if dry_run else 'Removed', ', '.join(f'{count} {kind}' for kind, count in report.items()))
+    return report
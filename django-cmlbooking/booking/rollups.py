@@ -0,0 +1,141 @@
+"""
+Precomputed booking and teardown statistics for the admin dashboard.
+
+DailyStats and SlotStats are updated incrementally when a booking is
+created or cancelled and when a teardown finishes. The nightly Reconcile
+recomputes the last ROLLUP_RECONCILE_DAYS days and all upcoming days from
+the source tables, which fixes counts missed by a crash or changed in the
+admin.
+
+Cancelled bookings are deleted, so cancellations are only counted when they
+happen. A booking counts as booked whether it was cancelled later or not.
+"""
+from datetime import timedelta
+from django.db.models import F, Sum
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.conf import settings
+from booking.models import Booking, CmlJob, DailyStats, SlotStats, Teardown
+from . import clock
+import logging
+logger = logging.getLogger(__name__)
+
+def _Add(model, keys, **deltas):
+    # Atomic increment, the row is created on first use
+    model.objects.get_or_create(**keys)
+    model.objects.filter(**keys).update(**{field: F(field) + value for field, value in deltas.items()})
+
+def _Slot(booking):
+    timeslot = timezone.localtime(booking.timeslot)
+    return timeslot.date(), timeslot.hour
+
+@receiver(post_save, sender=Booking)
+def BookingCreated(sender, instance, created, raw=False, **kwargs):
+    if not created or raw:
+        return
+    day, hour = _Slot(instance)
+    _Add(SlotStats, {'date': day, 'hour': hour}, bookings=1)
+    _Add(DailyStats, {'date': day}, bookings=1)
+
+def BookingCancelled(booking):
+    """
+    Count a booking cancelled by the user. Called by the cancel views, as
+    bookings are also deleted by the cleanup job and the retention job.
+    """
+    day, hour = _Slot(booking)
+    _Add(SlotStats, {'date': day, 'hour': hour}, cancellations=1)
+    _Add(DailyStats, {'date': day}, cancellations=1)
+
+def _TeardownSeconds(teardown):
+    return (teardown.finished - teardown.created).total_seconds()
+
+def TeardownFinished(teardown):
+    """
+    Count a finished teardown, called at the end of CleanUp
+    """
+    _Add(DailyStats, {'date': timezone.localtime(teardown.finished).date()},
+         teardowns=1, teardown_failures=1 if teardown.errors else 0, teardown_seconds=_TeardownSeconds(teardown))
+
+def Reconcile(days=None):
+    """
+    Recompute the rollups from the source tables, from days ago until the
+    last booking. Defaults to ROLLUP_RECONCILE_DAYS. Use a range within the
+    booking retention, as older bookings are no longer in the database.
+    """
+    days = settings.ROLLUP_RECONCILE_DAYS if days is None else days
+    since = clock.Today() - timedelta(days=days)
+
+    # Bookings still in the database, except the ones cancelled while
+    # ongoing, which are only deleted once their cleanup is done
+    booked = {}
+    bookings = Booking.objects.filter(timeslot__date__gte=since).exclude(cmljob__kind=CmlJob.CLEANUP)
+    for timeslot in bookings.values_list('timeslot', flat=True):
+        timeslot = timezone.localtime(timeslot)
+        key = (timeslot.date(), timeslot.hour)
+        booked[key] = booked.get(key, 0) + 1
+
+    # Cancellations can not be recomputed, keep the counted ones
+    slots = {(s.date, s.hour): s for s in SlotStats.objects.filter(date__gte=since)}
+    for key in set(booked) | set(slots):
+        slot = slots.get(key) or SlotStats(date=key[0], hour=key[1])
+        bookings = booked.get(key, 0) + slot.cancellations
+        if slot.pk is None or slot.bookings != bookings:
+            slot.bookings = bookings
+            slot.save()
+
+    teardowns = {}
+    for teardown in Teardown.objects.filter(finished__date__gte=since):
+        day = timezone.localtime(teardown.finished).date()
+        stats = teardowns.setdefault(day, {'teardowns': 0, 'teardown_failures': 0, 'teardown_seconds': 0})
+        stats['teardowns'] += 1
+        stats['teardown_failures'] += 1 if teardown.errors else 0
+        stats['teardown_seconds'] += _TeardownSeconds(teardown)
+
+    totals = SlotStats.objects.filter(date__gte=since).values('date').annotate(booked=Sum('bookings'), cancelled=Sum('cancellations'))
+    daily = {row['date']: row for row in totals}
+    for day in set(daily) | set(teardowns) | set(DailyStats.objects.filter(date__gte=since).values_list('date', flat=True)):
+        DailyStats.objects.update_or_create(date=day, defaults={
+            'bookings': daily[day]['booked'] if day in daily else 0,
+            'cancellations': daily[day]['cancelled'] if day in daily else 0,
+            **teardowns.get(day, {'teardowns': 0, 'teardown_failures': 0, 'teardown_seconds': 0}),
+        })
+    logger.info("Reconcile: Rollups recomputed from %s, %s slots and %s days", since, len(set(booked) | set(slots)), len(daily))
+
+def Dashboard(days=90):
+    """
+    Summary of the last days for the admin dashboard, read from the rollups
+    only
+    """
+    today = clock.Today()
+    since = today - timedelta(days=days - 1)
+    totals = DailyStats.objects.filter(date__gte=since, date__lte=today).aggregate(
+        bookings=Sum('bookings'), cancellations=Sum('cancellations'), teardowns=Sum('teardowns'),
+        teardown_failures=Sum('teardown_failures'), teardown_seconds=Sum('teardown_seconds'),
+    )
+    totals = {name: value or 0 for name, value in totals.items()}
+
+    # Share of the days each slot of the week was booked and not cancelled
+    weekdays = [0] * 7
+    for offset in range(days):
+        weekdays[(since + timedelta(days=offset)).weekday()] += 1
+    used = {}
+    slots = SlotStats.objects.filter(date__gte=since, date__lte=today, bookings__gt=F('cancellations'))
+    for day, hour in slots.values_list('date', 'hour'):
+        used[(day.weekday(), hour)] = used.get((day.weekday(), hour), 0) + 1
+    hours = [0, 3, 6, 9, 12, 15, 18, 21]
+    usage = [
+        {'hour': hour, 'days': [round(100 * used.get((weekday, hour), 0) / weekdays[weekday]) for weekday in range(7)]}
+        for hour in hours
+    ]
+
+    return {
+        'days': days,
+        'bookings': totals['bookings'],
+        'cancellations': totals['cancellations'],
+        'cancellation_rate': round(100 * totals['cancellations'] / totals['bookings'], 1) if totals['bookings'] else None,
+        'teardowns': totals['teardowns'],
+        'teardown_failures': totals['teardown_failures'],
+        'average_teardown_seconds': round(totals['teardown_seconds'] / totals['teardowns'], 1) if totals['teardowns'] else None,
+        'usage': usage,
+    }
@@ -4,12 +4,19 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from django_apscheduler.jobstores import register_events
 from django_apscheduler.models import DjangoJobExecution
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.jobstores.base import JobLookupError
 from django.conf import settings
-from datetime import datetime, date, timedelta
+from datetime import datetime, timedelta
 from django.utils import timezone
-from booking.models import Booking
-from datetime import datetime
-from . import cml
+from booking.models import Booking, Teardown
+from . import alerts
+from . import clock
+from . import jobs
+from . import poller
+from . import retention
+from . import rollups
+from . import health
 
 # Create scheduler to run in a thread inside the application process
 scheduler = BackgroundScheduler(settings.SCHEDULER_CONFIG)
@@ -29,13 +36,14 @@ def delete_old_job_executions(max_age=604_800):
 def GetDateTimeNow(offset=0):
     # To find labs booked X hours ago for cleanup, we need to offset the time
     if offset:
-        delta = timedelta(hours=(datetime.now().hour-offset))
+        delta = timedelta(hours=(clock.LocalNow().hour-offset))
     else:
-        delta = timedelta(hours=datetime.now().hour)
+        delta = timedelta(hours=clock.LocalNow().hour)
 
-    # Get datetime for slot
-    datenow = datetime.combine(date.today(), datetime.min.time())
-    slotnow = datenow.astimezone() + delta
+    # Get datetime for slot. Added to the local wall time, as the views do,
+    # so the slots stay on the hour on the days daylight saving time changes
+    datenow = datetime.combine(clock.Today(), datetime.min.time())
+    slotnow = (datenow + delta).astimezone()
 
     return slotnow
 
@@ -49,6 +57,7 @@ def SetUpLab():
         booking = bookednow.first()
 
         # Create temporary password and send to user
+        from . import cml
         cml.CreateTempUser(booking.email, booking.password)
     else:
         print('SetUpLab: not a booked slot, no setup to be done')
@@ -65,12 +74,31 @@ def TearDownLab():
         # Booking exists, get first (and only...)
         booking = bookednow.first()
 
-        # Clean up after booked session
-        cml.CleanUp(booking.email, booking.password)
+        # Clean up after booked session. The cleanup has to be done before
+        # the next timeslot is set up at the hour
+        from . import cml
+        slotend = booking.timeslot + timedelta(hours=3)
+        deadline = slotend.timestamp() - settings.CML_TEARDOWN_SAFETY_SECONDS
+        cml.CleanUp(booking.email, booking.password, deadline)
     else:
         print('TearDownLab: no booked slot, no cleanup to be done')
 
 
+def CheckpointLab():
+    # See if a booked slot is ongoing. The checkpoint is skipped during the
+    # last minutes of the slot, when the teardown exports the labs anyway
+    now = clock.Now()
+    booking = Booking.objects.filter(timeslot__gt=now - timedelta(hours=3), timeslot__lte=now).first()
+
+    if booking is None:
+        return
+    if now > booking.timeslot + timedelta(hours=3, minutes=-5) or Teardown.objects.filter(password=booking.password).exists():
+        return
+
+    from . import cml
+    cml.CheckpointLabs(booking.email, booking.password)
+
+
 def start():
     # If DEBUG, hook into the apscheduler logger
     if settings.DEBUG:
@@ -98,6 +126,95 @@ def start():
         replace_existing=True
     )
 
+    # Save snapshots of the labs during the booked slot, so the teardown
+    # only has to download labs that changed since the last checkpoint
+    if settings.CML_CHECKPOINT_INTERVAL:
+        scheduler.add_job(
+            CheckpointLab,
+            trigger=IntervalTrigger(minutes=settings.CML_CHECKPOINT_INTERVAL),
+            id="CML_CheckpointLab",
+            max_instances=1,
+            replace_existing=True
+        )
+    else:
+        try:
+            scheduler.remove_job("CML_CheckpointLab")
+        except JobLookupError:
+            pass
+
+    # Keep a snapshot of the CML state for the calendar, health checks and teardown
+    if settings.CML_POLL_SECONDS:
+        scheduler.add_job(
+            poller.Poll,
+            trigger=IntervalTrigger(seconds=settings.CML_POLL_SECONDS),
+            next_run_time=timezone.now(),
+            id="CML_Poll",
+            max_instances=1,
+            replace_existing=True
+        )
+    else:
+        try:
+            scheduler.remove_job("CML_Poll")
+        except JobLookupError:
+            pass
+
+    # Send the failures collected since the last digest to the admin
+    if settings.ALERT_DIGEST_MINUTES:
+        scheduler.add_job(
+            alerts.SendDigest,
+            trigger=IntervalTrigger(minutes=settings.ALERT_DIGEST_MINUTES),
+            id="CML_AlertDigest",
+            max_instances=1,
+            replace_existing=True
+        )
+    else:
+        try:
+            scheduler.remove_job("CML_AlertDigest")
+        except JobLookupError:
+            pass
+
+    # Pick up background CML jobs that were queued but never run, or
+    # left running by a process that died. Runs once at startup as well.
+    scheduler.add_job(
+        jobs.ResumeJobs,
+        trigger=IntervalTrigger(minutes=1),
+        next_run_time=timezone.now(),
+        id="CML_ResumeJobs",
+        max_instances=1,
+        replace_existing=True
+    )
+
+    # Finish lab cleanups that were interrupted, e.g. by a restart during
+    # teardown. Runs once at startup as well.
+    scheduler.add_job(
+        jobs.ResumeTeardowns,
+        trigger=IntervalTrigger(minutes=1),
+        next_run_time=timezone.now(),
+        id="CML_ResumeTeardowns",
+        max_instances=1,
+        replace_existing=True
+    )
+
+    # Recompute the recent booking and teardown statistics, before the
+    # retention job deletes old bookings
+    scheduler.add_job(
+        rollups.Reconcile,
+        trigger=CronTrigger(hour="03", minute="10"),
+        id="CML_Rollups",
+        max_instances=1,
+        replace_existing=True
+    )
+
+    # Delete bookings, email addresses, history and lab files past their
+    # retention. Runs at night, away from the setup and teardown of slots.
+    scheduler.add_job(
+        retention.Purge,
+        trigger=CronTrigger(hour="03", minute="20"),
+        id="CML_Retention",
+        max_instances=1,
+        replace_existing=True
+    )
+
     # Delete old scheduled jobs
     scheduler.add_job(
         delete_old_job_executions, 
@@ -110,5 +227,8 @@ def start():
     # Add the scheduled jobs to the Django admin interface
     register_events(scheduler)
 
+    # Keep the outcome of the last job runs for the readiness endpoint
+    scheduler.add_listener(health.JobListener, health.JOB_EVENTS)
+
     # Run the scheduler
     scheduler.start()
\ No newline at end of file
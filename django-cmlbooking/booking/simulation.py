@@ -0,0 +1,73 @@
+"""
+Sandbox for the simulate and loadtest commands.
+
+Runs the application against a throwaway test database and the CML
+stand-in, with email kept in memory and the rate limiter off, so neither
+the real database, CML nor any mailbox is touched.
+"""
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from booking.models import CmlJob
+from .standin import StandIn
+import logging
+logger = logging.getLogger(__name__)
+
+# Email domain of the synthetic users
+DOMAIN = 'sim.example'
+
+@contextmanager
+def Sandbox(latency=0.0, download_latency=0.0):
+    """
+    Set up the test database and the CML stand-in. Yields the StandIn.
+    """
+    setup_test_environment()
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    previous_test_name = test_settings.get('NAME')
+    directory = None
+    if connection.vendor == 'sqlite':
+        # A file instead of the in-memory default, the background job
+        # threads use their own connections
+        directory = tempfile.mkdtemp(prefix='cmlbooking-sim-')
+        test_settings['NAME'] = os.path.join(directory, 'sim.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    standin = StandIn(settings.CML_USERNAME, settings.CML_PASSWORD, latency, download_latency)
+    url = standin.Start()
+    overrides = override_settings(
+        CML_API_BASE_URL=url,
+        CML_URL=url.split('api/')[0],
+        BOOKING_ALLOWED_DOMAIN=[DOMAIN],
+        RATELIMIT_ENABLED=False,
+        CML_POLL_SECONDS=0,
+        CML_CHECKPOINT_INTERVAL=0,
+        SENDGRID_BCC_EMAIL='',
+    )
+    overrides.enable()
+    try:
+        yield standin
+    finally:
+        overrides.disable()
+        standin.Stop()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = previous_test_name
+        if directory:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+        teardown_test_environment()
+
+def WaitForJobs(timeout=60):
+    """
+    Wait until the background CML jobs are done. Returns False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while CmlJob.objects.filter(status__in=[CmlJob.QUEUED, CmlJob.RUNNING]).exists():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
@@ -0,0 +1,203 @@
+"""
+Local stand-in for the CML API.
+
+Answers the endpoints used by cml.py and the poller from memory,
+with an optional delay per request, so the simulate and loadtest commands
+(and development without a CML server) exercise the real setup and
+teardown code. Not for production use.
+"""
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import logging
+logger = logging.getLogger(__name__)
+
+def _Modified():
+    # CML reports when a lab was last changed as an ISO timestamp
+    return datetime.now(timezone.utc).isoformat()
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug("StandIn: " + format, *args)
+
+    def _Send(self, status, body=None, content_type='application/json'):
+        if body is None:
+            data = b''
+        elif content_type == 'application/json':
+            data = json.dumps(body).encode()
+        else:
+            data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _Handle(self):
+        standin = self.server.standin
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            body = None
+
+        url = urlsplit(self.path)
+        path = url.path.split('/api/v0/', 1)[-1].strip('/')
+        parts = path.split('/')
+        standin.Count(self.command, parts)
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        if path == 'system_information':
+            return self._Send(200, {'version': 'stand-in'})
+        if path == 'authenticate' and self.command == 'POST':
+            token = standin.Authenticate((body or {}).get('username'), (body or {}).get('password'))
+            return self._Send(200, token) if token else self._Send(403, {'description': 'Authentication failed!'})
+
+        if not standin.Authorized(self.headers.get('Authorization', '')):
+            return self._Send(401, {'description': 'No authorization token provided.'})
+
+        if parts[0] == 'logout':
+            standin.LogAllUsersOut()
+            return self._Send(204)
+        if path == 'users/admin/id':
+            return self._Send(200, standin.admin_id)
+        if parts[0] == 'users' and len(parts) == 2 and self.command == 'PATCH':
+            if parts[1] != standin.admin_id:
+                return self._Send(404)
+            standin.SetPassword((body or {}).get('password', {}).get('new_password'))
+            return self._Send(200, {'id': standin.admin_id})
+
+        if path == 'populate_lab_tiles':
+            return self._Send(200, {'lab_tiles': standin.LabTiles()})
+        if parts[0] == 'labs':
+            if len(parts) == 1:
+                return self._Send(200, standin.Labs())
+            lab = standin.Lab(parts[1])
+            if lab is None:
+                return self._Send(404, {'description': 'Lab not found'})
+            if len(parts) == 2 and self.command == 'DELETE':
+                standin.DeleteLab(parts[1])
+                return self._Send(204)
+            if len(parts) == 2:
+                return self._Send(200, {'id': parts[1], 'state': lab['state'], 'modified': lab['modified'], 'node_count': len(lab['nodes'])})
+            if parts[2] == 'nodes' and len(parts) == 3:
+                if 'data=true' in url.query:
+                    return self._Send(200, [{'id': node, 'state': 'BOOTED' if lab['state'] == 'STARTED' else 'STOPPED'} for node in lab['nodes']])
+                return self._Send(200, lab['nodes'])
+            if parts[2] == 'nodes' and parts[-1] == 'extract_configuration':
+                return self._Send(200, 'hostname node')
+            if parts[2] == 'download':
+                if standin.download_latency:
+                    time.sleep(standin.download_latency)
+                return self._Send(200, f"lab:\n  title: {parts[1]}\n  nodes: {len(lab['nodes'])}\n", 'application/x-yaml')
+            if parts[2] in ('stop', 'wipe') and self.command == 'PUT':
+                standin.SetLabState(parts[1], 'STOPPED' if parts[2] == 'stop' else 'DEFINED_ON_CORE')
+                return self._Send(204)
+
+        self._Send(404, {'description': f'Unknown endpoint {self.command} {path}'})
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _Handle
+
+class StandIn:
+    """
+    In-memory CML with one admin user. Start() serves it on a free local
+    port in a background thread and returns the API base URL.
+    """
+    def __init__(self, username, password, latency=0.0, download_latency=0.0):
+        self._lock = threading.Lock()
+        self.username = username
+        self.password = password
+        self.admin_id = str(uuid.uuid4())
+        self.latency = latency
+        self.download_latency = download_latency
+        self.tokens = set()
+        self.labs = {}
+        self.requests = {}
+        self.server = None
+
+    def Start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        threading.Thread(target=self.server.serve_forever, name='cml-standin', daemon=True).start()
+        logger.info("StandIn: Serving the CML API on %s", self.url)
+        return self.url
+
+    def Stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api/v0/'
+
+    def Count(self, method, parts):
+        # Requests per endpoint, with lab and node ids left out
+        key = f"{method} {'/'.join(part if len(part) < 32 else '*' for part in parts)}"
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def Authenticate(self, username, password):
+        with self._lock:
+            if username != self.username or password != self.password:
+                return None
+            token = uuid.uuid4().hex
+            self.tokens.add(token)
+            return token
+
+    def Authorized(self, header):
+        with self._lock:
+            return header.startswith('Bearer ') and header[7:] in self.tokens
+
+    def LogAllUsersOut(self):
+        with self._lock:
+            self.tokens.clear()
+
+    def SetPassword(self, password):
+        with self._lock:
+            self.password = password
+
+    def AddLabs(self, count, nodes=2):
+        """
+        Create running labs, as a user would during a booking. Returns the
+        lab ids.
+        """
+        created = []
+        with self._lock:
+            for i in range(count):
+                lab = str(uuid.uuid4())
+                self.labs[lab] = {'state': 'STARTED', 'modified': _Modified(), 'nodes': [str(uuid.uuid4()) for n in range(nodes)]}
+                created.append(lab)
+        return created
+
+    def Labs(self):
+        with self._lock:
+            return list(self.labs)
+
+    def Lab(self, lab):
+        with self._lock:
+            return self.labs.get(lab)
+
+    def LabTiles(self):
+        with self._lock:
+            return {lab: {'id': lab, 'state': data['state'], 'modified': data['modified'], 'node_count': len(data['nodes'])}
+                    for lab, data in self.labs.items()}
+
+    def SetLabState(self, lab, state):
+        with self._lock:
+            if lab in self.labs:
+                self.labs[lab]['state'] = state
+                self.labs[lab]['modified'] = _Modified()
+
+    def DeleteLab(self, lab):
+        with self._lock:
+            self.labs.pop(lab, None)
@@ -1,3 +1,228 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import date, datetime
+from unittest import mock
 
-# Create your tests here.
+from django.core import signing
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from booking import ratelimit, tokens
+from booking.breaker import CircuitBreaker, CircuitOpenError
+from booking.maintenance import MaintenanceIndex
+from booking.models import Booking, Maintenance
+from booking.views import BookingsForCancelCode
+
+def Local(*args):
+    # Aware datetime in the local time zone
+    return timezone.make_aware(datetime(*args))
+
+def WaitFor(condition, seconds=2):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.reachable = threading.Event()
+        self.probes = 0
+        self.breaker = CircuitBreaker('test', probe=self.Probe, failure_threshold=2, reset_timeout=0.01)
+
+    def Probe(self):
+        self.probes += 1
+        return self.reachable.is_set()
+
+    def tearDown(self):
+        # Let a running prober end
+        self.reachable.set()
+        WaitFor(lambda: not self.breaker.is_open)
+
+    def test_opens_after_threshold(self):
+        self.breaker.RecordFailure()
+        self.breaker.Check()
+        self.assertFalse(self.breaker.is_open)
+
+        self.breaker.RecordFailure()
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.Check()
+
+    def test_success_resets_failures(self):
+        self.breaker.RecordFailure()
+        self.breaker.RecordSuccess()
+        self.breaker.RecordFailure()
+        self.assertFalse(self.breaker.is_open)
+
+    def test_probe_closes_breaker(self):
+        self.breaker.RecordFailure()
+        self.breaker.RecordFailure()
+
+        # Failing probes keep it open
+        self.assertTrue(WaitFor(lambda: self.probes >= 2))
+        self.assertTrue(self.breaker.is_open)
+
+        self.reachable.set()
+        self.assertTrue(WaitFor(lambda: not self.breaker.is_open))
+        self.assertIsNone(self.breaker.opened_at)
+        self.breaker.Check()
+
+    def test_probe_errors_keep_breaker_open(self):
+        self.breaker.probe = mock.Mock(side_effect=OSError('connection refused'))
+        self.breaker.RecordFailure()
+        self.breaker.RecordFailure()
+        self.assertTrue(WaitFor(lambda: self.breaker.probe.call_count >= 2))
+        self.assertTrue(self.breaker.is_open)
+        self.breaker.probe = self.Probe
+
+class TokenTests(TestCase):
+    def test_verification_token(self):
+        token = tokens.MakeVerificationToken('ola@example.com')
+        self.assertEqual(tokens.ReadVerificationToken(token), 'ola@example.com')
+
+    def test_tampered_tokens_are_rejected(self):
+        token = tokens.MakeVerificationToken('ola@example.com')
+        rest = token.split(':', 1)[1]
+        forged = signing.dumps('kari@example.com', salt=tokens.VERIFICATION_SALT).split(':', 1)[0] + ':' + rest
+        self.assertIsNone(tokens.ReadVerificationToken(forged))
+        self.assertIsNone(tokens.ReadVerificationToken(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+        self.assertIsNone(tokens.ReadCancelToken('not-a-token'))
+
+    def test_tokens_are_not_interchangeable(self):
+        booking = Booking.objects.create(email='ola@example.com', timeslot=Local(2030, 1, 7, 9))
+        self.assertIsNone(tokens.ReadCancelToken(tokens.MakeVerificationToken('ola@example.com')))
+        self.assertIsNone(tokens.ReadVerificationToken(tokens.MakeCancelToken(booking)))
+        self.assertIsNone(tokens.ReadVerificationToken(tokens.MakeFeedToken('ola@example.com')))
+
+    @override_settings(BOOKING_VERIFICATION_MAX_AGE=3600, BOOKING_CANCEL_MAX_AGE=3600)
+    def test_tokens_expire(self):
+        booking = Booking.objects.create(email='ola@example.com', timeslot=Local(2030, 1, 7, 9))
+        verification = tokens.MakeVerificationToken('ola@example.com')
+        cancel = tokens.MakeCancelToken(booking)
+        later = time.time() + 3601
+        with mock.patch.object(signing.time, 'time', return_value=later):
+            self.assertIsNone(tokens.ReadVerificationToken(verification))
+            self.assertIsNone(tokens.ReadCancelToken(cancel))
+            # Feed tokens do not expire
+            self.assertEqual(tokens.ReadFeedToken(tokens.MakeFeedToken('Ola@example.com')), 'ola@example.com')
+
+    def test_cancel_token_does_not_match_a_reused_booking_id(self):
+        booking = Booking.objects.create(email='ola@example.com', timeslot=Local(2030, 1, 7, 9))
+        token = tokens.MakeCancelToken(booking)
+        self.assertEqual(list(BookingsForCancelCode(token)), [booking])
+
+        Booking.objects.filter(pk=booking.pk).update(timeslot=Local(2030, 1, 8, 9))
+        self.assertEqual(list(BookingsForCancelCode(token)), [])
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.now = 1000.0
+        patcher = mock.patch.object(ratelimit, 'time', mock.Mock(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.ParseRate('10/m'), (10, 60))
+        self.assertEqual(ratelimit.ParseRate('100/300'), (100, 300.0))
+
+    def test_bucket_refills(self):
+        self.assertEqual(ratelimit.Take('test', '2/10'), 0)
+        self.assertEqual(ratelimit.Take('test', '2/10'), 0)
+        # One token per 5 seconds
+        self.assertAlmostEqual(ratelimit.Take('test', '2/10'), 5)
+
+        self.now += 2.5
+        self.assertAlmostEqual(ratelimit.Take('test', '2/10'), 2.5)
+        self.now += 2.5
+        self.assertEqual(ratelimit.Take('test', '2/10'), 0)
+
+    def test_bucket_does_not_exceed_capacity(self):
+        ratelimit.Take('test', '2/10')
+        self.now += 3600
+        self.assertEqual(ratelimit.Take('test', '2/10'), 0)
+        self.assertEqual(ratelimit.Take('test', '2/10'), 0)
+        self.assertGreater(ratelimit.Take('test', '2/10'), 0)
+
+    def test_buckets_are_separate(self):
+        ratelimit.Take('a', '1/m')
+        self.assertGreater(ratelimit.Take('a', '1/m'), 0)
+        self.assertEqual(ratelimit.Take('b', '1/m'), 0)
+
+    @override_settings(RATELIMIT_ENABLED=True, RATELIMIT_POST='100/m', RATELIMIT_EMAIL='2/h', RATELIMIT_EMAIL_IP='100/h',
+                       BOOKING_ALLOWED_DOMAIN=['example.com'])
+    def test_invalid_requests_do_not_use_the_email_budget(self):
+        for i in range(3):
+            self.client.post('/booking/1/9/', {'email': 'ola@example.org'})
+            self.client.post('/booking/1/9/', {'email': 'ola@'})
+        self.assertEqual(self.client.post('/booking/1/9/', {'email': 'ola@example.com'}).status_code, 302)
+        self.assertEqual(self.client.post('/booking/1/9/', {'email': 'ola@example.com'}).status_code, 302)
+
+        response = self.client.post('/booking/1/9/', {'email': 'ola@example.com'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+class MaintenanceIndexTests(TestCase):
+    def test_one_off_window(self):
+        Maintenance.objects.create(start=Local(2030, 1, 7, 6), end=Local(2030, 1, 7, 8), reason='Oppgradering')
+        index = MaintenanceIndex(Local(2030, 1, 7), Local(2030, 1, 9))
+        self.assertFalse(index.Blocked(Local(2030, 1, 7, 5, 59)))
+        self.assertTrue(index.Blocked(Local(2030, 1, 7, 6)))
+        self.assertTrue(index.Blocked(Local(2030, 1, 7, 8)))
+        self.assertFalse(index.Blocked(Local(2030, 1, 7, 8, 1)))
+        self.assertEqual(index.Messages(Local(2030, 1, 7), Local(2030, 1, 9)), ['Oppgradering'])
+
+    def test_window_started_before_range(self):
+        Maintenance.objects.create(start=Local(2030, 1, 1), end=Local(2030, 1, 8, 12))
+        index = MaintenanceIndex(Local(2030, 1, 7), Local(2030, 1, 9))
+        self.assertTrue(index.Blocked(Local(2030, 1, 7, 0)))
+        self.assertFalse(index.Blocked(Local(2030, 1, 8, 13)))
+
+    def test_overlapping_windows_are_merged(self):
+        Maintenance.objects.create(start=Local(2030, 1, 7, 6), end=Local(2030, 1, 7, 9))
+        Maintenance.objects.create(start=Local(2030, 1, 7, 8), end=Local(2030, 1, 7, 12))
+        Maintenance.objects.create(start=Local(2030, 1, 7, 7), end=Local(2030, 1, 7, 7, 30))
+        index = MaintenanceIndex(Local(2030, 1, 7), Local(2030, 1, 9))
+        self.assertEqual(len(index.starts), 1)
+        self.assertTrue(index.Blocked(Local(2030, 1, 7, 11)))
+        self.assertFalse(index.Blocked(Local(2030, 1, 7, 12, 1)))
+
+    def test_daily_window_over_midnight(self):
+        # The occurrence of the day before the range reaches into it
+        Maintenance.objects.create(start=Local(2030, 1, 1, 22), end=Local(2030, 1, 2, 2), recurrence=Maintenance.DAILY)
+        index = MaintenanceIndex(Local(2030, 1, 10), Local(2030, 1, 12))
+        self.assertTrue(index.Blocked(Local(2030, 1, 10, 1)))
+        self.assertFalse(index.Blocked(Local(2030, 1, 10, 3)))
+        self.assertTrue(index.Blocked(Local(2030, 1, 10, 23)))
+        self.assertTrue(index.Blocked(Local(2030, 1, 11, 0, 30)))
+
+    def test_recurrence_ends_with_repeat_until(self):
+        Maintenance.objects.create(start=Local(2030, 1, 1, 6), end=Local(2030, 1, 1, 7), recurrence=Maintenance.DAILY,
+                                   repeat_until=date(2030, 1, 10))
+        index = MaintenanceIndex(Local(2030, 1, 9), Local(2030, 1, 13))
+        self.assertTrue(index.Blocked(Local(2030, 1, 9, 6, 30)))
+        self.assertTrue(index.Blocked(Local(2030, 1, 10, 6, 30)))
+        self.assertFalse(index.Blocked(Local(2030, 1, 11, 6, 30)))
+
+    def test_repeat_until_before_range(self):
+        Maintenance.objects.create(start=Local(2030, 1, 1, 6), end=Local(2030, 1, 1, 7), recurrence=Maintenance.WEEKLY,
+                                   repeat_until=date(2030, 1, 5))
+        index = MaintenanceIndex(Local(2030, 1, 7), Local(2030, 1, 9))
+        self.assertEqual(index.occurrences, [])
+
+    @override_settings(TIME_ZONE='Europe/Oslo')
+    def test_weekly_window_keeps_wall_time_across_dst(self):
+        # Daylight saving time starts on Sunday 29 March 2026
+        Maintenance.objects.create(start=Local(2026, 3, 23, 6), end=Local(2026, 3, 23, 7), recurrence=Maintenance.WEEKLY)
+        index = MaintenanceIndex(Local(2026, 3, 28), Local(2026, 4, 8))
+        self.assertTrue(index.Blocked(Local(2026, 3, 30, 6, 30)))
+        self.assertFalse(index.Blocked(Local(2026, 3, 30, 5, 30)))
+        self.assertFalse(index.Blocked(Local(2026, 3, 30, 7, 30)))
+        self.assertTrue(index.Blocked(Local(2026, 4, 6, 6)))
+        self.assertFalse(index.Blocked(Local(2026, 4, 1, 6, 30)))
+
+    def test_point_outside_range_is_loaded_on_its_own(self):
+        Maintenance.objects.create(start=Local(2030, 2, 1, 6), end=Local(2030, 2, 1, 7))
+        index = MaintenanceIndex(Local(2030, 1, 7), Local(2030, 1, 9))
+        self.assertTrue(index.Blocked(Local(2030, 2, 1, 6, 30)))
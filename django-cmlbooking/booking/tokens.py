@@ -0,0 +1,55 @@
+"""
+Signed, expiring tokens for the verification and cancellation links.
+
+The tokens carry the email address or the booking, signed with SECRET_KEY,
+so a link can be checked without a stored random code. Links sent before
+the tokens were introduced still carry the stored codes, the views fall
+back to a lookup of those.
+"""
+from django.conf import settings
+from django.core import signing
+
+VERIFICATION_SALT = 'booking.verification'
+CANCEL_SALT = 'booking.cancel'
+
+def MakeVerificationToken(email):
+    return signing.dumps(email, salt=VERIFICATION_SALT)
+
+def ReadVerificationToken(token):
+    """
+    Return the email address of a valid verification token, else None
+    """
+    try:
+        return signing.loads(token, salt=VERIFICATION_SALT, max_age=settings.BOOKING_VERIFICATION_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+def MakeCancelToken(booking):
+    # The timeslot is included, so the token does not match a later booking reusing the id
+    return signing.dumps([booking.pk, int(booking.timeslot.timestamp())], salt=CANCEL_SALT)
+
+def ReadCancelToken(token):
+    """
+    Return (booking id, timeslot as epoch seconds) of a valid cancel token,
+    else None
+    """
+    try:
+        booking_id, timeslot = signing.loads(token, salt=CANCEL_SALT, max_age=settings.BOOKING_CANCEL_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return booking_id, timeslot
+
+FEED_SALT = 'booking.feed'
+
+def MakeFeedToken(email):
+    # Calendar subscriptions are long lived, the feed token does not expire
+    return signing.dumps(email.lower(), salt=FEED_SALT)
+
+def ReadFeedToken(token):
+    """
+    Return the email address of a valid calendar feed token, else None
+    """
+    try:
+        return signing.loads(token, salt=FEED_SALT)
+    except signing.BadSignature:
+        return None
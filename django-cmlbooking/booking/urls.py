@@ -1,14 +1,35 @@
+from django.conf import settings
 from django.urls import path
 from django.views.generic import RedirectView
 
 from . import views
 
+# Async views are only worth it under ASGI, under WSGI every request would
+# pay for an event loop
+if settings.BOOKING_ASYNC_VIEWS:
+    booking_view = views.CreateNewBookingAsync
+    cancel_view = views.CancelBookingAsync
+    verification_view = views.VerificationAsync
+else:
+    booking_view = views.CreateNewBooking
+    cancel_view = views.CancelBooking
+    verification_view = views.Verification
+
 urlpatterns = [
     path('', views.RenderCalendar, name='index'),
     path('booking/', RedirectView.as_view(url='/')),
-    path('booking/<int:day>/', views.CreateNewBooking),
-    path('booking/<int:day>/<int:slot>/', views.CreateNewBooking),
-    path('cancel/<str:cancelcode>/', views.CancelBooking),
+    path('booking/<int:day>/', booking_view),
+    path('booking/<int:day>/<int:slot>/', booking_view),
+    path('cancel/<str:cancelcode>/', cancel_view),
     path('verification/', RedirectView.as_view(url='/')),
-    path('verification/<str:verificationcode>/', views.Verification)
+    path('verification/<str:verificationcode>/', verification_view),
+    path('status/<str:reference>/', views.JobStatus),
+    path('calendar/<str:token>.ics', views.CalendarFeed),
+    path('metrics/', views.Metrics),
+    path('healthz/', views.Healthz),
+    path('readyz/', views.Readyz),
 ]
+
+# Live calendar updates keep a connection open per browser, ASGI only
+if settings.BOOKING_LIVE_UPDATES:
+    urlpatterns.append(path('live/', views.CalendarEvents))
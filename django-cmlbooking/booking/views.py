@@ -1,69 +1,48 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
-from django.template.loader import render_to_string
 from django.utils.formats import date_format
 from django.conf import settings
-from booking.models import Booking, VerifiedEmail, Maintenance
+from django.views.decorators.http import condition
+from booking.models import Booking, VerifiedEmail, CmlJob
 from .forms import BookingForm
-from datetime import date, datetime, timedelta, time
-from django.utils import timezone
-from . import cml
+from .maintenance import MaintenanceIndex
+from .breaker import cml_breaker
+from . import clock
+from . import emails
+from . import feed
+from . import metrics
+from . import poller
+from . import rollups
+from . import tokens
+from . import ratelimit
+from .ratelimit import Limit
+from datetime import datetime, timedelta, time
+from asgiref.sync import sync_to_async
 import logging
 logger = logging.getLogger(__name__)
 
-def BlockedByMaintenance(date):
-    # Check if date is in range of a maintenance
-    maintenance = Maintenance.objects.filter(start__lte=date.astimezone(), end__gte=date.astimezone())
-    if maintenance.count():
-        return True
-    else:
-        return False
-
-def GetMaintenanceMessages():
-    startdate = timezone.now()
-    enddate = startdate+timedelta(days=5)
-
-    # Empty list
-    messages = []
-
-    # Check all maintenances
-    maintenances = Maintenance.objects.filter(start__gte=startdate, start__lte=enddate)
+def GetMaintenanceIndex(numberofdays=5):
+    # All maintenance from the start of today until the calendar ends
+    startdate = datetime.combine(clock.Today(), time.min).astimezone()
+    return MaintenanceIndex(startdate, clock.Now() + timedelta(days=numberofdays))
 
-    # Append to list if any
-    if maintenances.count():
-        for maintenance in maintenances:
-            messages.append(maintenance.reason)
-
-    # Return messages
-    return messages
-
-def BlockedByMaintenance(date):
+def BlockedByMaintenance(date, maintenance=None):
     # Check if date is in range of a maintenance
-    maintenance = Maintenance.objects.filter(start__lte=date.astimezone(), end__gte=date.astimezone())
-    if maintenance.count():
-        return True
-    else:
-        return False
+    if maintenance is None:
+        maintenance = MaintenanceIndex(date, date)
+    return maintenance.Blocked(date)
 
-def GetMaintenanceMessages():
-    startdate = timezone.now()
+def GetMaintenanceMessages(maintenance=None):
+    startdate = clock.Now()
     enddate = startdate+timedelta(days=5)
 
-    # Empty list
-    messages = []
-
-    # Check all maintenances
-    maintenances = Maintenance.objects.filter(start__gte=startdate, start__lte=enddate)
-
-    # Append to list if any
-    if maintenances.count():
-        for maintenance in maintenances:
-            messages.append(maintenance.reason)
-
-    # Return messages
-    return messages
+    # Reasons of all maintenances starting within the next days
+    if maintenance is None:
+        maintenance = MaintenanceIndex(startdate, enddate)
+    return maintenance.Messages(startdate, enddate)
 
-def GetValidTimeslots(date):
+def GetValidTimeslots(date, maintenance=None):
     # Possible timeslots each day
     timeslots = [0,3,6,9,12,15,18,21]
     validtimeslots = {}
@@ -73,26 +52,26 @@ def GetValidTimeslots(date):
         
         # Exclude slots in maintenance
         checkdate = datetime.combine(date.date(),time(slot,00))
-        if BlockedByMaintenance(checkdate):
+        if BlockedByMaintenance(checkdate, maintenance):
             validtimeslots[slot] = 'invalid'
 
         else:
             # Exclude past dates
-            if(date.date() < datetime.today().date()):
+            if(date.date() < clock.LocalNow().date()):
                 validtimeslots[slot] = 'invalid'
 
             # Exclude todays timeslots that has passed
-            elif(date.date() == datetime.today().date()):
+            elif(date.date() == clock.LocalNow().date()):
                 # Slot later today
-                if(datetime.now().hour < slot):
+                if(clock.LocalNow().hour < slot):
                     validtimeslots[slot] = 'valid'
 
                 # Ongoing slot, 1st or 2nd hour
-                elif(datetime.now().hour == slot or datetime.now().hour-1 == slot):
+                elif(clock.LocalNow().hour == slot or clock.LocalNow().hour-1 == slot):
                     validtimeslots[slot] = 'valid'
 
                 # Ongoing slot, 3rd hour. Booking not possible last 30 minutes
-                elif(datetime.now().hour-2 == slot and datetime.now().minute < 30):
+                elif(clock.LocalNow().hour-2 == slot and clock.LocalNow().minute < 30):
                     validtimeslots[slot] = 'valid'
 
                 # Passed slot
@@ -117,9 +96,9 @@ def GetBookedSlots(date):
     return booked
 
 
-def GetSlotStatus(date):
+def GetSlotStatus(date, maintenance=None):
     # Get all possible slots for this date
-    allslots = GetValidTimeslots(date)
+    allslots = GetValidTimeslots(date, maintenance)
     bookedslots = GetBookedSlots(date)
 
     slotstatus = {}
@@ -136,238 +115,389 @@ def GetSlotStatus(date):
     return slotstatus
 
 
-def CreateNewBooking(request,day=None,slot=None):
+def AllowedDomainsText():
+    # Human readable list of allowed domains, e.g. "@a.no, @b.no eller @c.no"
+    allowed_list = [f"@{d}" for d in settings.BOOKING_ALLOWED_DOMAIN]
+    if len(allowed_list) == 1:
+        return allowed_list[0]
+    return f"{', '.join(allowed_list[:-1])} eller {allowed_list[-1]}"
+
+
+def VerifyEmail(verificationcode):
+    """
+    Mark the email address of a verification link as verified. Accepts
+    signed tokens and the stored codes of older links.
+
+    Returns the email address, or None if the code is not valid.
+    """
+    email = tokens.ReadVerificationToken(verificationcode)
+    if email:
+        if not VerifiedEmail.objects.filter(email=email).update(verified=True, modified=clock.Now()):
+            VerifiedEmail.objects.create(email=email, verified=True)
+        return email
+
+    # Link sent before signed tokens
+    verification = VerifiedEmail.objects.filter(verificationcode=verificationcode).first()
+    if verification:
+        VerifiedEmail.objects.filter(pk=verification.pk).update(verified=True, modified=clock.Now())
+        return verification.email
+    return None
+
+def BookingsForCancelCode(cancelcode):
+    # Booking of a signed cancel token, or of the stored code of older links
+    found = tokens.ReadCancelToken(cancelcode)
+    if found:
+        booking_id, timeslot = found
+        return Booking.objects.filter(pk=booking_id, timeslot=datetime.fromtimestamp(timeslot).astimezone())
+    return Booking.objects.filter(cancelcode=cancelcode)
+
+class Outcome:
+    """
+    What a booking, verification or cancel request ends in. Decided by the
+    helpers below, shared by the sync and async views, which add the message,
+    send the email and then render the booking form or redirect.
+    """
+    def __init__(self, redirect='/', message=None, email=None, context=None, retry_after=None):
+        self.redirect = redirect
+        # (level, text) of the message shown on the next page
+        self.message = message
+        # (address, subject, body) of the email to send
+        self.email = email
+        # Context of the booking form, rendered instead of the redirect
+        self.context = context
+        # Seconds until the email budget allows another request, answered with a 429
+        self.retry_after = retry_after
+
+def SlotOutcome(day, slot):
     # Valid timeslots
     timeslots = [0,3,6,9,12,15,18,21]
 
-    if request.method == 'POST':
-        form = BookingForm(request.POST)
-
-        # Check whether it's valid:
-        if form.is_valid():
+    # If values are set
+    if not (day >= 0 and day < 5 and (slot in timeslots)):
+        logger.error("CreateNewBooking: Invalid values provided")
+        return Outcome(message=(messages.ERROR, 'Ugyldige verdier oppgitt.'))
 
-            # Get email from form
-            email = form.cleaned_data['email']
+    # Convert to datetime
+    todaysdate = datetime.combine(clock.Today(), datetime.min.time())
+    bookingtime = todaysdate + timedelta(days=day, hours=slot)
 
-            # Get domain from email
-            domain = (email.split('@')[-1] or "").strip().lower()
-            logger.info(f"CreateNewBooking: Started booking for {email}")
+    # Blocked by maintenance
+    if BlockedByMaintenance(bookingtime):
+        logger.error("CreateNewBooking: Blocked by ongoing maintenance")
+        return Outcome()
 
-            # Invalid domain or email
-            if domain not in settings.BOOKING_ALLOWED_DOMAIN:
-                allowed_list = [f"@{d}" for d in settings.BOOKING_ALLOWED_DOMAIN]
-                if len(allowed_list) == 1:
-                    allowed_str = allowed_list[0]
-                else:
-                    allowed_str = f"{', '.join(allowed_list[:-1])} eller {allowed_list[-1]}"
-
-                messages.add_message(
-                    request,
-                    messages.WARNING,
-                    f'E-postadressen du benyttet er ugyldig. Det er kun mulig å reservere med {allowed_str} e-postadresser.')
-                logger.error(f"CreateNewBooking: Invalid domain {domain}")
-                return redirect(f'/booking/{day}/{slot}/')
-            
-            # Check if user has active booking
-            elif(Booking.objects.filter(email=email,timeslot__gte=datetime.now().astimezone()-timedelta(hours=3))):
-                messages.add_message(request, messages.ERROR, 'Det finnes allerede en reservasjon for e-postadresse din! For å gi alle mulighet til å bruke miljøet, er det kun mulig å ha én aktiv reservasjon per bruker.')
-                logger.error(f"CreateNewBooking: User {email} already have an active booking")
-                return redirect(f'/booking/{day}/{slot}/')
-
-            else:
-                # Check if user email has an verified email
-                user = VerifiedEmail.objects.filter(email=email).first()
-                verified = False
-
-                if(user):
-                    # User exist
-                    if(user.verified):
-                        # Email is verified
-                        verified = True
-
-                # User email has been verified previously, so go ahead and get this booked!
-                if(verified):
-                    logger.info(f"CreateNewBooking: E-mail {email} already verified")
-                    # Convert to datetime
-                    todaysdate = datetime.combine(date.today(), datetime.min.time())
-                    bookingtime = todaysdate + timedelta(days=day, hours=slot)
-    
-                    # Save data and print success-message
-                    booking = Booking(timeslot=bookingtime.astimezone(), email=email)
-                    booking.save()
-                    messages.add_message(request, messages.SUCCESS, f'Din reservasjon for {bookingtime.date()} fra {"{:02}".format(bookingtime.hour)}:00-{"{:02}".format(bookingtime.hour+3)}:00 er bekreftet! Du vil straks motta en e-post med informasjon, i tillegg til en ny e-post med brukernavn og passord når din tidsperiode starter.')
-                    logger.info(f"CreateNewBooking: Booking successfully created for {email} for timeslot {bookingtime.astimezone()}")
-
-                    # Send info email using template
-                    context = {
-                        'booking_date': bookingtime.date(),
-                        'timeslot_from': '{:02}'.format(bookingtime.hour),
-                        'timeslot_to': '{:02}'.format(bookingtime.hour+3),
-                        'cancelcode': booking.cancelcode,
-                        'cml_url': settings.CML_URL,
-                        'booking_url': settings.BOOKING_URL,
-                    }
-                    body = render_to_string('booking/email_info.html', context)
-                    logger.info(f"CreateNewBooking: Sending booking confirmation email to {email}")
-                    statuscode = cml.SendEmail(email, 'Community Network - CML reservasjon', body)
-    
-                    # If booking of ongoing slot, create temporary password right away as scheduler will not catch this booking
-                    if(bookingtime.astimezone() <= datetime.now().astimezone()):
-                        logger.info(f"CreateNewBooking: Booking is for ongoing timeslot, creating password for {booking.email}")
-                        cml.CreateTempUser(booking.email, booking.password)
-    
-                    # Return to home
-                    return redirect('/')
-                
-                # User not verified, so send email and redirect to homepage with warning message
-                else:
-                    # Check first if user has an unverified entry in database
-                    logger.warning(f"CreateNewBooking: Verification needed for {email}")
-
-                    if (user):
-                        # Old unverified entry found, reusing
-                        logger.info(f"CreateNewBooking: Verification code reused for unverified {email}")
-                        context = {
-                            'verificationcode': user.verificationcode,
-                            'cml_url': settings.CML_URL,
-                            'booking_url': settings.BOOKING_URL,
-                        }
-                        
-                    else: 
-                        # Create entry in verification database
-                        verification = VerifiedEmail(email=email)
-                        verification.save()
-                        logger.info(f"CreateNewBooking: New verification code created for {email}")
-
-                        context = {
-                            'verificationcode': verification.verificationcode,
-                            'cml_url': settings.CML_URL,
-                            'booking_url': settings.BOOKING_URL,
-                        }
-                    
-                    # Send verification email using template
-                    logger.info(f"CreateNewBooking: Sending verification code to {email}")
-                    body = render_to_string('booking/email_verification.html', context)
-                    statuscode = cml.SendEmail(email, 'Din e-postadresse må verifiseres!', body)
-
-                    # Return home with warning message
-                    messages.add_message(request, messages.ERROR, 'Din e-postadresse må verifiseres før du kan reservere tid! Du mottar straks en epost med instruksjoner for hvordan du verifiserer deg.')
-                    return redirect('/')
-                
-    else:
-        # If values are set
-        if(day >= 0 and day < 5 and (slot in timeslots)):
-            
-            # Check if timeslot is valid, else redirect to home
-            if slot not in timeslots:
-                return redirect('/')
-            
-            # Convert to datetime
-            todaysdate = datetime.combine(date.today(), datetime.min.time())
-            bookingtime = todaysdate + timedelta(days=day, hours=slot)
-
-            # Blocked by maintenance
-            if BlockedByMaintenance(bookingtime):
-                logger.error(f"CreateNewBooking: Blocked by ongoing maintenance")
-                return redirect('/')
-    
-            # Check if booking exist for requested date
-            if(Booking.objects.filter(timeslot=bookingtime.astimezone())):
-                messages.add_message(request, messages.ERROR, 'Det finnes allerede en reservasjon for denne datoen og tidsrommet.')
-                logger.error(f"CreateNewBooking: Already an booking for this timeslot")
-                return redirect('/')
-    
-            # Render form
-            form = BookingForm()
-            context = {
-                'day': day,
-                'slot': slot,
-                'bookingtime': bookingtime,
-                'form': form,
-            }
-            return render(request, 'booking/booking.html', context)
+    # Check if booking exist for requested date
+    if Booking.objects.filter(timeslot=bookingtime.astimezone()).exists():
+        logger.error("CreateNewBooking: Already an booking for this timeslot")
+        return Outcome(message=(messages.ERROR, 'Det finnes allerede en reservasjon for denne datoen og tidsrommet.'))
 
-        else:
-            # Redirect to home
-            messages.add_message(request, messages.ERROR, 'Ugyldige verdier oppgitt.')
-            logger.error(f"CreateNewBooking: Invalid values provided")
-            return redirect('/')
+    # Render form
+    context = {
+        'day': day,
+        'slot': slot,
+        'bookingtime': bookingtime,
+        'form': BookingForm(),
+    }
+    return Outcome(context=context)
+
+def BookingOutcome(day, slot, data, ip):
+    form = BookingForm(data)
+    if not form.is_valid():
+        return Outcome(redirect=f'/booking/{day}/{slot}/')
+
+    # Get email and domain from form
+    email = form.cleaned_data['email']
+    domain = (email.split('@')[-1] or "").strip().lower()
+    logger.info("CreateNewBooking: Started booking for %s", email)
+
+    # Invalid domain or email
+    if domain not in settings.BOOKING_ALLOWED_DOMAIN:
+        logger.error("CreateNewBooking: Invalid domain %s", domain)
+        message = f'E-postadressen du benyttet er ugyldig. Det er kun mulig å reservere med {AllowedDomainsText()} e-postadresser.'
+        return Outcome(redirect=f'/booking/{day}/{slot}/', message=(messages.WARNING, message))
+
+    # Only valid addresses are charged to the email budgets
+    wait = ratelimit.TakeEmail(ip, email, f'/booking/{day}/{slot}/')
+    if wait:
+        return Outcome(retry_after=wait)
+
+    # Check if user has active booking
+    if Booking.objects.filter(email=email,timeslot__gte=clock.LocalNow().astimezone()-timedelta(hours=3)).exists():
+        logger.error("CreateNewBooking: User %s already have an active booking", email)
+        message = 'Det finnes allerede en reservasjon for e-postadresse din! For å gi alle mulighet til å bruke miljøet, er det kun mulig å ha én aktiv reservasjon per bruker.'
+        return Outcome(redirect=f'/booking/{day}/{slot}/', message=(messages.ERROR, message))
+
+    # Check if user email has an verified email
+    user = VerifiedEmail.objects.filter(email=email).first()
+
+    # User email has been verified previously, so go ahead and get this booked!
+    if user and user.verified:
+        logger.info("CreateNewBooking: E-mail %s already verified", email)
+        # Convert to datetime
+        todaysdate = datetime.combine(clock.Today(), datetime.min.time())
+        bookingtime = todaysdate + timedelta(days=day, hours=slot)
+
+        # Save data and print success-message
+        booking = Booking(timeslot=bookingtime.astimezone(), email=email)
+        booking.save()
+        message = f'Din reservasjon for {bookingtime.date()} fra {"{:02}".format(bookingtime.hour)}:00-{"{:02}".format(bookingtime.hour+3)}:00 er bekreftet! Du vil straks motta en e-post med informasjon, i tillegg til en ny e-post med brukernavn og passord når din tidsperiode starter.'
+        logger.info("CreateNewBooking: Booking successfully created for %s for timeslot %s", email, bookingtime.astimezone())
+
+        # Info email using template
+        context = {
+            'booking_date': bookingtime.date(),
+            'timeslot_from': '{:02}'.format(bookingtime.hour),
+            'timeslot_to': '{:02}'.format(bookingtime.hour+3),
+            'cancelcode': tokens.MakeCancelToken(booking),
+            'feed_token': tokens.MakeFeedToken(booking.email),
+            'cml_url': settings.CML_URL,
+            'booking_url': settings.BOOKING_URL,
+        }
+        body = emails.Render('booking/email_info.html', context)
+        logger.info("CreateNewBooking: Sending booking confirmation email to %s", email)
+        outcome = Outcome(message=(messages.SUCCESS, message), email=(email, 'Community Network - CML reservasjon', body))
+
+        # If booking of ongoing slot, create temporary password right away as scheduler will not catch this booking.
+        # This runs in the background, the user can follow the progress on the status page
+        if(bookingtime.astimezone() <= clock.LocalNow().astimezone()):
+            from . import jobs
+            logger.info("CreateNewBooking: Booking is for ongoing timeslot, creating password for %s", booking.email)
+            job = jobs.SubmitJob(CmlJob.SETUP, booking.email, booking.password, booking)
+            outcome.redirect = f'/status/{job.reference}/'
+        return outcome
+
+    # User not verified, so send email and redirect to homepage with warning message
+    logger.warning("CreateNewBooking: Verification needed for %s", email)
+    if not user:
+        # Create entry in verification database
+        VerifiedEmail.objects.create(email=email)
+        logger.info("CreateNewBooking: Unverified entry created for %s", email)
+
+    # The link carries a signed token with the email address
+    context = {
+        'verificationcode': tokens.MakeVerificationToken(email),
+        'cml_url': settings.CML_URL,
+        'booking_url': settings.BOOKING_URL,
+    }
+    logger.info("CreateNewBooking: Sending verification code to %s", email)
+    body = emails.Render('booking/email_verification.html', context)
+    message = 'Din e-postadresse må verifiseres før du kan reservere tid! Du mottar straks en epost med instruksjoner for hvordan du verifiserer deg.'
+    return Outcome(message=(messages.ERROR, message), email=(email, 'Din e-postadresse må verifiseres!', body))
+
+def VerificationOutcome(verificationcode):
+    if not verificationcode:
+        return Outcome()
+
+    logger.info("Verification: Looking for verification with code %s", verificationcode)
+    email = VerifyEmail(verificationcode)
+    if email:
+        logger.info("Verification: User %s verified", email)
+        return Outcome(message=(messages.SUCCESS, 'Din e-postadresse er nå verifisert! Du kan nå reservere ønsket tidspunkt under.'))
+
+    # Not found. Display warning message
+    logger.error("Verification: Verification code %s NOT found", verificationcode)
+    return Outcome(message=(messages.WARNING, 'Det ser ikke ut til at det finnes en e-postadresse i databasen med oppgitt verifikasjonskode.'))
+
+def CancelOutcome(cancelcode):
+    if not cancelcode:
+        return Outcome()
+
+    # Find booking with cancellation code
+    booking = BookingsForCancelCode(cancelcode).first()
+    logger.info("CancelBooking: Looking for booking with cancel code %s", cancelcode)
+    if not booking:
+        logger.error("CancelBooking: No booking found booking with cancel code %s", cancelcode)
+        return Outcome(message=(messages.WARNING, 'Det ser ikke ut til at det finnes en reservasjoner i databasen med den kanselleringskoden. Ingen reservasjoner ble derfor slettet.'))
+
+    logger.info("CancelBooking: Found booking %s matching cancel code %s", booking.timeslot.astimezone(), cancelcode)
+    logger.info("CancelBooking: This slot is booked by %s", booking.email)
+
+    # Booking in the past
+    if(booking.timeslot.astimezone() <= clock.LocalNow().astimezone()-timedelta(hours=3)):
+        logger.warning("CancelBooking: Trying to cancel booking in the past, ignoring")
+        return Outcome(message=(messages.WARNING, 'Reservasjon funnet, men det er ikke mulig å kansellere reservasjoner som er gjort i fortiden.'))
+
+    cancelled = (messages.SUCCESS, 'Din reservasjon ble kansellert! Takk for at du kansellerte og gav andre muligheten til å reservere!')
+
+    # If ongoing timeslot, clean up in the background. The booking is
+    # deleted by the job when the cleanup is done
+    if(booking.timeslot.astimezone() <= clock.LocalNow().astimezone()):
+        job = CmlJob.objects.filter(booking=booking, kind=CmlJob.CLEANUP).first()
+        if not job:
+            from . import jobs
+            logger.info("CancelBooking: Ongoing timeslot, starting cleanup for booking %s", booking.timeslot.astimezone())
+            job = jobs.SubmitJob(CmlJob.CLEANUP, booking.email, booking.password, booking)
+            rollups.BookingCancelled(booking)
+        return Outcome(redirect=f'/status/{job.reference}/', message=cancelled)
+
+    # Delete future bookings
+    booking.delete()
+    rollups.BookingCancelled(booking)
+    logger.info("CancelBooking: Deleted booking %s", booking.timeslot.astimezone())
+    return Outcome(message=cancelled)
+
+def Respond(request, outcome):
+    # Carry out the outcome in a sync view
+    if outcome.retry_after:
+        return ratelimit.Throttled(outcome.retry_after)
+    if outcome.message:
+        messages.add_message(request, *outcome.message)
+    if outcome.email:
+        from . import cml
+        cml.SendEmail(*outcome.email)
+    if outcome.context is not None:
+        return render(request, 'booking/booking.html', outcome.context)
+    return redirect(outcome.redirect)
+
+@Limit
+def CreateNewBooking(request,day=None,slot=None):
+    if request.method == 'POST':
+        return Respond(request, BookingOutcome(day, slot, request.POST, ratelimit.ClientIp(request)))
+    return Respond(request, SlotOutcome(day, slot))
 
+@Limit
 def Verification(request, verificationcode=None):
-    if verificationcode:
-        # Find entry with this verificationcode
-        verification = VerifiedEmail.objects.filter(verificationcode=verificationcode).first()
-        logger.info(f"Verification: Looking for verification with code {verificationcode}")
-        
-        if verification:
-            # Found! Set to verified and save
-            logger.info(f"Verification: Verification code {verificationcode} matching with user {verification.email}")
-            verification.verified = True
-            verification.save()
-            logger.info(f"Verification: User {verification.email} verified")
-            messages.add_message(request, messages.SUCCESS, f'Din e-postadresse er nå verifisert! Du kan nå reservere ønsket tidspunkt under.')
-
-        else:
-            # Not found. Display warning message
-            messages.add_message(request, messages.WARNING, f'Det ser ikke ut til at det finnes en e-postadresse i databasen med oppgitt verifikasjonskode.')
-            logger.error(f"Verification: Verification code {verificationcode} NOT found")
-        
-    # Redirect to home
-    return redirect('/')
+    return Respond(request, VerificationOutcome(verificationcode))
 
+@Limit
 def CancelBooking(request, cancelcode=None):
-    if cancelcode:
-        # Find booking with cancellation code
-        booking = Booking.objects.filter(cancelcode=cancelcode).first()
-        logger.info(f"CancelBooking: Looking for booking with cancel code {cancelcode}")
-        if booking:
-            # Booking found
-            logger.info(f"CancelBooking: Found booking {booking.timeslot.astimezone()} matching cancel code {cancelcode}")
-            logger.info(f"CancelBooking: This slot is booked by {booking.email}")
-
-            # If booking in the future
-            if(booking.timeslot.astimezone() > datetime.now().astimezone()-timedelta(hours=3)):
-
-                # If ongoing timeslot, clean up
-                if(booking.timeslot.astimezone() <= datetime.now().astimezone()):
-                    # Clean up
-                    logger.info(f"CancelBooking: Ongoing timeslot, starting cleanup for booking {booking.timeslot.astimezone()}")
-                    cml.CleanUp(booking.email, booking.password)
-
-                # Delete ongoing or future bookings
-                booking.delete()
-                messages.add_message(request, messages.SUCCESS, f'Din reservasjon ble kansellert! Takk for at du kansellerte og gav andre muligheten til å reservere!')
-                logger.info(f"CancelBooking: Deleted booking {booking.timeslot.astimezone()}")
-            else:
-                # Booking in the past
-                messages.add_message(request, messages.WARNING, f'Reservasjon funnet, men det er ikke mulig å kansellere reservasjoner som er gjort i fortiden.')
-                logger.warning(f"CancelBooking: Trying to cancel booking in the past, ignoring")
-        else:
-            # Not found, print warning
-            messages.add_message(request, messages.WARNING, f'Det ser ikke ut til at det finnes en reservasjoner i databasen med den kanselleringskoden. Ingen reservasjoner ble derfor slettet.')
-            logger.error(f"CancelBooking: No booking found booking with cancel code {cancelcode}")
+    return Respond(request, CancelOutcome(cancelcode))
+
+def JobStatus(request, reference):
+    # Lightweight status page for background CML jobs, polled by the user
+    job = get_object_or_404(CmlJob, reference=reference)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'kind': job.kind,
+            'status': job.status,
+            'created': job.created,
+            'started': job.started,
+            'finished': job.finished,
+        })
+
+    return render(request, 'booking/status.html', {'job': job})
+
+# Async versions of the booking, verification and cancel views. They are
+# routed instead of the sync views when BOOKING_ASYNC_VIEWS is enabled and
+# the app runs under ASGI. The outcome is decided by the same helpers in a
+# worker thread, emails go through booking.acml without blocking the event
+# loop and CML operations run as background jobs.
+
+async def RespondAsync(request, outcome):
+    # Carry out the outcome in an async view
+    if outcome.retry_after:
+        return ratelimit.Throttled(outcome.retry_after)
+    if outcome.message:
+        messages.add_message(request, *outcome.message)
+    if outcome.email:
+        from . import acml
+        await acml.SendEmail(*outcome.email)
+    if outcome.context is not None:
+        return render(request, 'booking/booking.html', outcome.context)
+    return redirect(outcome.redirect)
+
+@Limit
+async def CreateNewBookingAsync(request,day=None,slot=None):
+    if request.method == 'POST':
+        outcome = await sync_to_async(BookingOutcome)(day, slot, request.POST, ratelimit.ClientIp(request))
+    else:
+        outcome = await sync_to_async(SlotOutcome)(day, slot)
+    return await RespondAsync(request, outcome)
 
-    # Redirect to home
-    return redirect('/')
+@Limit
+async def VerificationAsync(request, verificationcode=None):
+    return await RespondAsync(request, await sync_to_async(VerificationOutcome)(verificationcode))
 
-def RenderCalendar(request):
+@Limit
+async def CancelBookingAsync(request, cancelcode=None):
+    return await RespondAsync(request, await sync_to_async(CancelOutcome)(cancelcode))
+
+def GetCalendarData(numberofdays=5, maintenance=None):
     data = {}
-    numberofdays = 5
+    if maintenance is None:
+        maintenance = GetMaintenanceIndex(numberofdays)
 
     # Get data for the next X days
     for i in range(numberofdays):
-        daydate = datetime.today().astimezone() + timedelta(days=i)
+        daydate = clock.LocalNow().astimezone() + timedelta(days=i)
         data[i] = {
             'dayid': i,
             'dayname': date_format(daydate, 'l'),
             'daydate': daydate.strftime("%d.%m"),
             'daydatestr': daydate.strftime("%Y-%d-%m"),
-            'bookingdata': GetSlotStatus(datetime.today().astimezone() + timedelta(days=i)),
+            'bookingdata': GetSlotStatus(clock.LocalNow().astimezone() + timedelta(days=i), maintenance),
         }
 
+    return data
+
+def RenderCalendar(request):
+    maintenance = GetMaintenanceIndex()
     context = {
-        'calendardata': data,
-        'maintenance_messages': GetMaintenanceMessages()
+        'calendardata': GetCalendarData(maintenance=maintenance),
+        'maintenance_messages': GetMaintenanceMessages(maintenance),
+        'cml_unavailable': cml_breaker.is_open or poller.Unreachable(),
+        'live_updates': settings.BOOKING_LIVE_UPDATES,
     }
     
     return render(request, 'booking/index.html', context)
+
+async def CalendarEvents(request):
+    """
+    Server-sent events with changes to the calendar, see live.py. Needs ASGI.
+    """
+    from . import live
+    response = StreamingHttpResponse(live.Stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Do not let nginx buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    # GZipMiddleware would buffer the events, it skips encoded responses
+    response['Content-Encoding'] = 'identity'
+    return response
+
+def _FeedState(request, token):
+    # ETag and Last-Modified of the feed, computed once per request
+    if not hasattr(request, 'feed_state'):
+        email = tokens.ReadFeedToken(token)
+        request.feed_state = feed.State(email) if email else (None, None)
+    return request.feed_state
+
+def FeedEtag(request, token):
+    return _FeedState(request, token)[0]
+
+def FeedLastModified(request, token):
+    return _FeedState(request, token)[1]
+
+@condition(etag_func=FeedEtag, last_modified_func=FeedLastModified)
+def CalendarFeed(request, token):
+    """
+    iCalendar feed with the bookings of the user in the token and upcoming
+    maintenance, see feed.py. Unchanged feeds are answered with a 304.
+    """
+    email = tokens.ReadFeedToken(token)
+    if not email:
+        return HttpResponse('Ugyldig kalenderlenke.', status=404, content_type='text/plain; charset=utf-8')
+
+    response = HttpResponse(feed.Calendar(email), content_type='text/calendar; charset=utf-8')
+    response['Cache-Control'] = f'private, max-age={settings.BOOKING_FEED_TTL_MINUTES * 60}'
+    return response
+
+def Metrics(request):
+    # Prometheus metrics for this process
+    return HttpResponse(metrics.Render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def Healthz(request):
+    # Liveness: the process answers requests
+    return HttpResponse('ok', content_type='text/plain')
+
+def Readyz(request):
+    """
+    Readiness, from the cached background health check. Returns 503 if the
+    database is not reachable. Scheduler and CML problems are reported as
+    degraded, as bookings can still be made.
+    """
+    from . import health
+    status = health.Status()
+    if status is None:
+        return JsonResponse({'ready': False, 'error': 'Health check has not completed yet'}, status=503)
+    return JsonResponse(status, status=200 if status['ready'] else 503)
@@ -0,0 +1,77 @@
+"""
+Queue based logging for cmlbooking.
+
+Request threads and scheduler threads only put log records on an in-memory
+queue. A single listener thread owns the rotating log file and does all
+formatting, writing and rotation, so callers never block on disk I/O.
+"""
+
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+
+
+class QueuedTimedRotatingFileHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that feeds a TimedRotatingFileHandler running in a
+    background QueueListener thread.
+
+    Takes the same arguments as TimedRotatingFileHandler so it can be used
+    as a drop-in replacement in settings.LOGGING. The formatter configured
+    for this handler is applied by the listener thread, not the caller.
+    """
+
+    def __init__(self, filename, when='h', interval=1, backupCount=0, encoding=None, delay=False, utc=False):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.handlers.TimedRotatingFileHandler(
+            filename, when=when, interval=interval, backupCount=backupCount,
+            encoding=encoding, delay=delay, utc=utc)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # Formatting happens in the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Do not format in the calling thread. Only resolve exception info,
+        as the traceback must be captured while it is still current.
+        """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        # Drain the queue before closing the file
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.target.close()
+        super().close()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as one JSON object per line
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
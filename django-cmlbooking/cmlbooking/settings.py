@@ -49,6 +49,7 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'django.middleware.gzip.GZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -70,11 +71,23 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'booking.context_processors.Assets',
             ],
         },
     },
 ]
 
+# Keep compiled templates in memory in production. In development the
+# templates are read again on every render, so edits show up right away.
+if not DEBUG:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'cmlbooking.wsgi.application'
 
 
@@ -142,6 +155,19 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# Serve static files with WhiteNoise: content hashed file names with far
+# future cache headers, plus gzip and (with brotli installed) brotli
+# variants created by collectstatic. Needs collectstatic to run on deploy,
+# without it every page using {% static %} fails, so it is off by default.
+SERVE_STATIC = config('SERVE_STATIC', cast=bool, default=False)
+if SERVE_STATIC:
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.security.SecurityMiddleware') + 1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+    STORAGES = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+    }
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -157,6 +183,15 @@ MESSAGE_TAGS = {
     message_constants.ERROR: 'danger'
     }
 
+# Lean mode: keep sessions and flash messages in signed cookies, so page
+# views never read or write the session table. Messages that do not fit in
+# the cookie are dropped instead of spilling over into the session. Only the
+# admin uses sessions, and its session lives in a cookie as well.
+BOOKING_LEAN_MODE = config('BOOKING_LEAN_MODE', cast=bool, default=False)
+if BOOKING_LEAN_MODE:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+    MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
 # APSCHEDULER
 SCHEDULER_CONFIG = {
     "apscheduler.jobstores.default": {
@@ -166,25 +201,118 @@ SCHEDULER_CONFIG = {
         "type": "threadpool"
     },
 }
-SCHEDULER_AUTOSTART = True
+SCHEDULER_AUTOSTART = config('SCHEDULER_AUTOSTART', cast=bool, default=True)
+# The scheduler is started by runserver and by gunicorn, daphne, uvicorn,
+# hypercorn and uwsgi. Set this in the environment of other application
+# servers (e.g. mod_wsgi), never for scripts or management commands.
+SCHEDULER_SERVER = config('SCHEDULER_SERVER', cast=bool, default=False)
 
 # CML
 CML_API_BASE_URL = config('CML_API_BASE_URL')
 CML_USERNAME = config('CML_USERNAME')
 CML_PASSWORD = config('CML_PASSWORD')
 CML_URL = config('CML_URL')
+# Timeouts (seconds) for CML API calls
+CML_CONNECT_TIMEOUT = config('CML_CONNECT_TIMEOUT', cast=float, default=5)
+CML_TIMEOUT = config('CML_TIMEOUT', cast=float, default=30)
+# Circuit breaker, opens after this many consecutive failures and probes
+# CML_PROBE_PATH in the background until CML answers again
+CML_BREAKER_THRESHOLD = config('CML_BREAKER_THRESHOLD', cast=int, default=3)
+CML_BREAKER_RESET_SECONDS = config('CML_BREAKER_RESET_SECONDS', cast=float, default=30)
+CML_PROBE_PATH = config('CML_PROBE_PATH', default='system_information')
+# How long a discovered CML endpoint variant is trusted before re-probing
+CML_CAPABILITY_TTL_HOURS = config('CML_CAPABILITY_TTL_HOURS', cast=float, default=24)
+# Teardown deadline. Scheduled teardowns must be done this many seconds
+# before the next timeslot starts, other cleanups (cancellations) get
+# CML_TEARDOWN_BUDGET_SECONDS. CML_TEARDOWN_STEP_SECONDS is the estimated
+# duration of one essential API call, used to decide if there is time left
+# for lab exports.
+CML_TEARDOWN_SAFETY_SECONDS = config('CML_TEARDOWN_SAFETY_SECONDS', cast=float, default=10)
+CML_TEARDOWN_BUDGET_SECONDS = config('CML_TEARDOWN_BUDGET_SECONDS', cast=float, default=170)
+CML_TEARDOWN_STEP_SECONDS = config('CML_TEARDOWN_STEP_SECONDS', cast=float, default=2)
+# A cleanup whose heartbeat is older than this is considered interrupted
+# and is resumed by the scheduler
+CML_TEARDOWN_STALE_MINUTES = config('CML_TEARDOWN_STALE_MINUTES', cast=int, default=5)
+# Minutes between lab checkpoints during a booked slot, 0 disables checkpoints
+CML_CHECKPOINT_INTERVAL = config('CML_CHECKPOINT_INTERVAL', cast=int, default=0)
+# Seconds between polls of the CML state (labs and node states), 0 disables polling
+CML_POLL_SECONDS = config('CML_POLL_SECONDS', cast=int, default=60)
+# Health checks behind /readyz run in the background at most this often.
+# The scheduler counts as down when no job has run for HEALTH_SCHEDULER_STALE_SECONDS.
+HEALTH_CHECK_SECONDS = config('HEALTH_CHECK_SECONDS', cast=float, default=10)
+HEALTH_CHECK_TIMEOUT = config('HEALTH_CHECK_TIMEOUT', cast=float, default=5)
+HEALTH_SCHEDULER_STALE_SECONDS = config('HEALTH_SCHEDULER_STALE_SECONDS', cast=int, default=300)
 BOOKING_URL = config('BOOKING_URL')
 BOOKING_ALLOWED_DOMAIN = [
     d.strip().lower() for d in config('BOOKING_ALLOWED_DOMAIN', default='').split(',') 
     if d.strip()
 ]
 
-
+# Route the booking, cancel and verification URLs to the async views.
+# Only enable when running under ASGI (cmlbooking/asgi.py).
+BOOKING_ASYNC_VIEWS = config('BOOKING_ASYNC_VIEWS', cast=bool, default=False)
+# Lifetime in seconds of the signed links in verification and booking emails
+BOOKING_VERIFICATION_MAX_AGE = config('BOOKING_VERIFICATION_MAX_AGE', cast=int, default=7 * 24 * 3600)
+BOOKING_CANCEL_MAX_AGE = config('BOOKING_CANCEL_MAX_AGE', cast=int, default=7 * 24 * 3600)
+# How often calendar clients should refresh the .ics feed of a user
+BOOKING_FEED_TTL_MINUTES = config('BOOKING_FEED_TTL_MINUTES', cast=int, default=60)
+# Rate limits per client IP for the booking, verification and cancel views,
+# as requests/period (s, m, h, d or seconds). Booking requests that send an
+# email also use RATELIMIT_EMAIL per email address and RATELIMIT_EMAIL_IP per
+# client IP, only charged for addresses that passed validation. The IP limit
+# is higher as a whole campus may share one address behind NAT.
+RATELIMIT_ENABLED = config('RATELIMIT_ENABLED', cast=bool, default=True)
+RATELIMIT_GET = config('RATELIMIT_GET', default='60/m')
+RATELIMIT_POST = config('RATELIMIT_POST', default='10/m')
+RATELIMIT_EMAIL = config('RATELIMIT_EMAIL', default='5/h')
+RATELIMIT_EMAIL_IP = config('RATELIMIT_EMAIL_IP', default='100/h')
+RATELIMIT_CACHE = config('RATELIMIT_CACHE', default='default')
+# META key of the header with the client address when behind a proxy, e.g. HTTP_X_FORWARDED_FOR
+RATELIMIT_IP_HEADER = config('RATELIMIT_IP_HEADER', default='')
+# Number of proxies in front of the application adding to RATELIMIT_IP_HEADER.
+# The client address is the entry the outermost of them added, counted from the
+# right, as the entries to the left of it are sent by the client.
+RATELIMIT_TRUSTED_PROXIES = config('RATELIMIT_TRUSTED_PROXIES', cast=int, default=1)
+# Push calendar changes to open browsers over server-sent events (/live/).
+# Every open page keeps a connection, so this also requires ASGI.
+BOOKING_LIVE_UPDATES = config('BOOKING_LIVE_UPDATES', cast=bool, default=BOOKING_ASYNC_VIEWS)
+# Recompute the calendar at least this often to catch changes from other processes
+LIVE_REFRESH_SECONDS = config('LIVE_REFRESH_SECONDS', cast=float, default=60)
+LIVE_KEEPALIVE_SECONDS = config('LIVE_KEEPALIVE_SECONDS', cast=float, default=25)
+# Streams are closed after this many seconds and the browser reconnects
+LIVE_MAX_SECONDS = config('LIVE_MAX_SECONDS', cast=float, default=600)
+LIVE_RETRY_MS = config('LIVE_RETRY_MS', cast=int, default=5000)
+LIVE_QUEUE_SIZE = config('LIVE_QUEUE_SIZE', cast=int, default=20)
+
+# Background jobs for CML setup/cleanup started from web requests
+CML_JOB_WORKERS = config('CML_JOB_WORKERS', cast=int, default=2)
+CML_JOB_STALE_MINUTES = config('CML_JOB_STALE_MINUTES', cast=int, default=30)
+
+
+
+# Retention, see booking/retention.py. Days after which bookings, unverified
+# email addresses and finished jobs, teardowns, checkpoints and alerts are
+# deleted, 0 keeps them forever. Lab files are deleted after
+# RETENTION_LAB_FILE_HOURS. Rows are deleted RETENTION_BATCH_SIZE at a time,
+# and appended to JSON lines files in RETENTION_ARCHIVE_DIR first if set.
+RETENTION_BOOKING_DAYS = config('RETENTION_BOOKING_DAYS', cast=int, default=180)
+RETENTION_UNVERIFIED_DAYS = config('RETENTION_UNVERIFIED_DAYS', cast=int, default=14)
+RETENTION_HISTORY_DAYS = config('RETENTION_HISTORY_DAYS', cast=int, default=30)
+RETENTION_LAB_FILE_HOURS = config('RETENTION_LAB_FILE_HOURS', cast=int, default=24)
+RETENTION_BATCH_SIZE = config('RETENTION_BATCH_SIZE', cast=int, default=500)
+RETENTION_ARCHIVE_DIR = config('RETENTION_ARCHIVE_DIR', default='')
+
+# Days of booking and teardown rollups the nightly job recomputes from the
+# source tables, see booking/rollups.py. Keep below RETENTION_BOOKING_DAYS.
+ROLLUP_RECONCILE_DAYS = config('ROLLUP_RECONCILE_DAYS', cast=int, default=7)
 
 # SENDGRID
 #SENDGRID_API_KEY = config('SENDGRID_API_KEY')
 #SENDGRID_FROM_EMAIL = config('SENDGRID_FROM_EMAIL')
 SENDGRID_BCC_EMAIL = config('SENDGRID_BCC_EMAIL')
+# Failure alerts to SENDGRID_BCC_EMAIL are collected and sent as one digest
+# every ALERT_DIGEST_MINUTES, see booking/alerts.py. 0 sends every alert right away.
+ALERT_DIGEST_MINUTES = config('ALERT_DIGEST_MINUTES', cast=int, default=60)
 
 # ANYMAIL with BREVO (formerly Sendinblue)
 EMAIL_BACKEND = "anymail.backends.brevo.EmailBackend"
@@ -197,6 +325,11 @@ ANYMAIL_BCC_EMAIL = config('ANYMAIL_BCC_EMAIL')
 SERVER_EMAIL = DEFAULT_FROM_EMAIL # for django error mails
 
 # LOGGING
+# Records are queued by the calling thread and written by a background
+# listener thread, see cmlbooking/logqueue.py
+LOG_LEVEL = config('DJANGO_LOG_LEVEL', default='INFO')
+LOG_JSON = config('DJANGO_LOG_JSON', cast=bool, default=False)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -209,28 +342,30 @@ LOGGING = {
             'format': '{asctime} {levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'cmlbooking.logqueue.JsonFormatter',
+        },
     },
     'handlers': {
         'logfile': {
-            'level': 'INFO',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'level': LOG_LEVEL,
+            'class': 'cmlbooking.logqueue.QueuedTimedRotatingFileHandler',
             'filename': 'logs/cmlbooking.log',
             'when': 'midnight',
             'interval': 1,
             'backupCount': 30,
-            'formatter': 'verbose',
+            'formatter': 'json' if LOG_JSON else 'verbose',
         },
     },
     'loggers': {
         'django': {
-            'handlers': ['logfile'],
             'level': 'INFO',
             'propagate': True,
         },
         '': {
             'handlers': ['logfile'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
-}
\ No newline at end of file
+}